@@ -1,10 +1,18 @@
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from functools import lru_cache
+from operator import itemgetter
 import pandas as pd
 import re
 import string
 from typing import Callable, Dict, List, Tuple
 import pkg_resources
+import lxml.html
+from lxml import etree
+
+try:
+    # linear time regex engine, guards the citation regex against catastrophic backtracking
+    import re2
+except ImportError:
+    re2 = None
 
 
 def add_word_token_annotations(inputs: Dict[str, Dict]) -> Dict[str, Dict]:
@@ -204,6 +212,10 @@ def prune_overlapping_metamap_details(mm_d: List[Dict]) -> List[Dict]:
 
 # === LINKS ===========================================================================================================
 
+_RE_LINK = re.compile(
+    r'\b(?:(?:https?|ftp|file):\/\/|www\.|ftp\.)[-A-Za-z0-9+&@#/%=~_|$?!:,.]*[A-Za-z0-9+&@#/%=~_|$]')
+
+
 def amend_content_with_link_plain_text(inputs: Dict[str, Dict]) -> Dict[str, Dict]:
     for id in inputs:
         inputs[id]['content'] = replace_links_with_plain_text(inputs[id]['content'])
@@ -220,8 +232,7 @@ def replace_links_with_plain_text(input_str: str) -> str:
     Returns: string with links replaced with "thisisalink".
 
     """
-    r = r'\b(?:(?:https?|ftp|file):\/\/|www\.|ftp\.)[-A-Za-z0-9+&@#/%=~_|$?!:,.]*[A-Za-z0-9+&@#/%=~_|$]'
-    return re.sub(r, 'thisisalink', input_str)
+    return _RE_LINK.sub('thisisalink', input_str)
 
 
 # === NER =============================================================================================================
@@ -336,18 +347,41 @@ def add_inline_citations_annotations(inputs: Dict[str, Dict]) -> Dict[str, Dict]
     return inputs
 
 
-def apply_inline_citation_regex(text):
+def _build_inline_citation_regex():
     year_num = r"(?:19|20)[0-9][0-9]"
     author_with_year = r"[^()\d]*" + year_num
     multiple_authors = author_with_year + r"(?:;\s*" + author_with_year + r")*"
     author_either_bracket_type = r"\(" + multiple_authors + r"\)|\[" + multiple_authors + r"\]"
     citation_number_in_square_brackets = r"\[\d+(?:[-,\s]+\d+)*\]"
     regex = author_either_bracket_type + r"|" + citation_number_in_square_brackets
+    if re2 is not None:
+        return re2.compile(regex)
+    return re.compile(regex)
+
 
-    matches = re.findall(regex, text)
+# compiled once, as it is applied to every sentence. With python's re, unclosed brackets followed by many
+#  "author year;" groups make the match time grow exponentially, which re2 avoids.
+_RE_INLINE_CITATION = _build_inline_citation_regex()
+
+
+@lru_cache(maxsize=4096)
+def _find_inline_citations(text: str) -> Tuple[str, ...]:
+    """Return the inline citations in text. Pages share boilerplate sentences (disclaimers, footers, reference lists),
+    so results are cached. """
+    return tuple(_RE_INLINE_CITATION.findall(text))
+
+
+def apply_inline_citation_regex(text):
+    # every citation starts with a bracket, skip the regex (and the cache) for the many sentences without one
+    if '(' not in text and '[' not in text:
+        return []
+    matches = list(_find_inline_citations(text))
     return matches
 
 
+_REFERENCE_KEYWORDS = ['references', 'citations', 'bibliography']
+
+
 def extract_potential_references(text: str) -> List[str]:
     """
     Find the last-most instance of a reference keywords in an html heading, and retrieve all text following the heading.
@@ -357,26 +391,77 @@ def extract_potential_references(text: str) -> List[str]:
     Returns: List[str]. List of potential citations found under the heading, split into a list based on line breaks.
 
     """
-    soup = BeautifulSoup(text, features="html.parser")
+    # most pages have no reference section, skip parsing them when no keyword occurs anywhere in the html
+    lower_text = text.lower()
+    if not any(keyword in lower_text for keyword in _REFERENCE_KEYWORDS):
+        return []
 
-    reference_keywords = ['references', 'citations', 'bibliography']
+    try:
+        # parse the utf-8 bytes, as lxml refuses str input with an xml encoding declaration
+        document = lxml.html.document_fromstring(text.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except etree.ParserError:
+        # empty document
+        return []
 
     # iterate backwards through all headers
-    header_tags = soup.find_all(['h1', 'h2', 'h3', 'h4'])
+    header_tags = list(document.iter('h1', 'h2', 'h3', 'h4'))
     for tag in header_tags[-1:]:
         # if any single word in header matches a ref keyword
-        if tag.string is not None and any(h in tag.string.lower().split(' ') for h in reference_keywords):
+        tag_string = _get_single_string(tag)
+        if tag_string is not None and any(h in tag_string.lower().split(' ') for h in _REFERENCE_KEYWORDS):
             # return the remainder of the document
             potential_citations = []
-            for sibling_tag in tag.next_siblings:
-                if type(sibling_tag) == Tag:
-                    sibling_text = sibling_tag.get_text()
+            for sibling_tag in tag.itersiblings():
+                # skip comments and processing instructions
+                if isinstance(sibling_tag.tag, str):
+                    sibling_text = _get_element_text(sibling_tag)
                     text_split = [line for line in sibling_text.split('\n') if line.strip() != '']
                     potential_citations.extend(text_split)
             return potential_citations
     return []
 
 
+# text nodes of an element, leaving out the contents of nested script, style and template tags (like bs4's get_text)
+_XPATH_RENDERED_TEXT = etree.XPath('.//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+_XPATH_ALL_TEXT = etree.XPath('.//text()')
+
+
+def _get_element_text(element: lxml.html.HtmlElement) -> str:
+    """Equivalent of bs4's Tag.get_text() for an element of an lxml tree. """
+    if element.tag in {'script', 'style', 'template'}:
+        strings = _XPATH_ALL_TEXT(element)
+    else:
+        strings = _XPATH_RENDERED_TEXT(element)
+    return ''.join(_collapse_blank_string(s) for s in strings)
+
+
+def _collapse_blank_string(s: str) -> str:
+    """Replace a whitespace-only string outside of pre and textarea tags by a single line break or space, like bs4. """
+    if s.strip(' \n\t\f\r') != '':
+        return s
+    parent = s.getparent()
+    if s.is_tail:
+        parent = parent.getparent()
+    if parent is not None and (parent.tag in {'pre', 'textarea'} or
+                               any(True for __ in parent.iterancestors('pre', 'textarea'))):
+        return s
+    return '\n' if '\n' in s else ' '
+
+
+def _get_single_string(element: lxml.html.HtmlElement):
+    """Equivalent of bs4's Tag.string: the element's only string, looking through elements with a single child. """
+    while True:
+        children = list(element)
+        if len(children) == 0:
+            return element.text
+        if element.text is not None or len(children) > 1 or children[0].tail is not None:
+            return None
+        element = children[0]
+        if not isinstance(element.tag, str):
+            # a lone comment or processing instruction
+            return element.text
+
+
 def annotate_potential_references(potential_references: List[str]) -> List[Tuple[str, List[str]]]:
     """Placeholder function for annotating candidate reference strings.
     TODO: use NeuralParsCit here
@@ -400,10 +485,11 @@ def evaluate_potential_references(potential_references: List[Tuple[str, List[str
 
     Returns: A subset of potential_references with the same data structure.
     """
+    required_annotation_types = {'title', 'author'}
     selected_references = []
     for orig_ref_string, ref_annotations in potential_references:
-        annotation_types = set([annotation for token, annotation in ref_annotations])
-        if 'title' in annotation_types and 'author' in annotation_types:
+        annotation_types = set(map(itemgetter(1), ref_annotations))
+        if required_annotation_types <= annotation_types:
             selected_references.append((orig_ref_string, ref_annotations))
     return selected_references
 
@@ -1,18 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import dill
+from functools import lru_cache
 from git import Repo
 import glob
 import inspect
+import lz4.frame
 import os
 import pkg_resources
 import pandas as pd
 import pickle
 from pathlib import Path
 import subprocess
-from typing import Any, Callable, Dict
+from typing import Any, Callable, Dict, Tuple
 import yaml
 
-import autodiscern.transformations as adt
+# buffer size for pickle/dill file handles: pickle issues many small reads/writes, which a large buffer batches into
+# few syscalls
+PICKLE_BUFFER_SIZE = 1 << 20
+# highest pickle protocol every supported interpreter can read. pickle.HIGHEST_PROTOCOL is 5 from python 3.8 on, which
+# python 3.6 and 3.7 cannot load, so shared caches are written with a fixed protocol
+PICKLE_PROTOCOL = 4
+
+
+def _read_csv(path) -> pd.DataFrame:
+    """Read a csv with pandas' multithreaded pyarrow engine, falling back to the default C engine if pyarrow (or a
+    pandas version that supports it) is not available."""
+    try:
+        return pd.read_csv(path, engine='pyarrow')
+    except (ImportError, ValueError):
+        return pd.read_csv(path)
 
 
 class DataManager:
@@ -26,6 +43,9 @@ class DataManager:
            On windows OS, the backslash in the string should be escaped!!
     """
 
+    # set once the git repo has been found to have no uncommitted changes, see check_for_uncommitted_git_changes
+    _git_clean_checked = False
+
     def __init__(self, path_hint):
         """
         Initialize a DataManager pointing at a project data_path. Can refer to ~/.data_manager.yaml, which has format:
@@ -74,14 +94,21 @@ class DataManager:
         self._load_articles('html_articles')
         self._load_responses()
         print("Building data dicts...")
-        data_list_of_dicts = self.data['html_articles'].to_dict('records')
-        data_dict = adt.convert_list_of_dicts_to_dict_of_dicts(data_list_of_dicts)
-
+        # one pass straight to {entity_id: record}; drop=False keeps entity_id in each record for downstream use
+        data_dict = self.data['html_articles'].set_index('entity_id', drop=False).to_dict('index')
+
+        # pivot all responses in one groupby, then slice out each entity's questionID x uid table by index lookup.
+        # dropna mirrors pd.pivot_table, which only keeps the uids (and questions) that have answers for that entity
+        responses_by_id = self.data['responses_by_id']
+        responses_pivoted = responses_by_id.groupby(['entity_id', 'questionID', 'uid'])['answer'].median()
+        responses_pivoted = responses_pivoted.unstack('uid')
         for id in data_dict:
-            entity_responses = self.data['responses'][self.data['responses']['entity_id'] == id]
-            responses_pivoted = pd.pivot_table(entity_responses, index='questionID', columns='uid', values='answer',
-                                               aggfunc='median')
-            data_dict[id]['responses'] = responses_pivoted
+            if id in responses_by_id.index:
+                entity_responses = responses_pivoted.xs(id, level='entity_id')
+                entity_responses = entity_responses.dropna(axis=1, how='all').dropna(axis=0, how='all')
+            else:
+                entity_responses = pd.DataFrame()
+            data_dict[id]['responses'] = entity_responses
 
         ids = list(data_dict.keys())
         print(" ... {} data dicts built".format(len(ids)))
@@ -93,7 +120,6 @@ class DataManager:
 
         print("Loading articles...")
 
-        articles = pd.DataFrame(columns=['entity_id', 'content'])
         articles_path = Path(self.data_path, "data/{}/*".format(version_id))
 
         files = glob.glob(articles_path.__str__())
@@ -101,29 +127,69 @@ class DataManager:
         if len(files) == 0:
             print("WARNING: no files found at {}".format(articles_path))
 
-        for file in files:
-            # to enforce encoding -- it generates errors without it!
-            with open(file, 'r', encoding='utf-8') as f:
-                # keep what's after the last / and before the .
-                entity_id = os.path.basename(file).split('.')[0]
-                content = f.read()
-                articles = articles.append({'entity_id': int(entity_id), 'content': content}, ignore_index=True)
+        # reads are I/O bound, so run them on a thread pool, then build the DataFrame once from the collected rows
+        rows = []
+        if len(files) > 0:
+            with ThreadPoolExecutor(max_workers=min(32, len(files))) as executor:
+                rows = list(executor.map(self._read_article, files))
+        articles = pd.DataFrame.from_records(rows, columns=['entity_id', 'content'])
+        try:
+            # store the article bodies in one contiguous arrow buffer instead of as individual python objects
+            articles['content'] = articles['content'].astype('string[pyarrow]')
+        except (ImportError, TypeError):
+            # pyarrow string dtype not supported by the installed pandas/pyarrow, keep the object column
+            pass
 
         # only keep articles listed in the target_ids file
-        target_ids = pd.read_csv(Path(self.data_path, "data/target_ids.csv"))
-        articles['entity_id'] = articles['entity_id'].astype(int)
-        articles = pd.merge(articles, target_ids, on='entity_id')
+        target_ids = self._read_csv_cached(str(Path(self.data_path, "data/target_ids.csv")))
+        # give the join key the same int64 dtype in all three frames, so the merges compare keys without upcasting and
+        # the public entity_id column keeps its int64 dtype. assign() returns copies, leaving the cached lookup frames
+        # untouched
+        articles['entity_id'] = articles['entity_id'].astype('int64')
+        target_ids = target_ids.assign(entity_id=target_ids['entity_id'].astype('int64'))
+        if list(target_ids.columns) == ['entity_id']:
+            # nothing to add from target_ids, so a membership filter is enough (no hash join, no copy of articles)
+            articles = articles[articles['entity_id'].isin(set(target_ids['entity_id']))]
+        else:
+            articles = articles.merge(target_ids, on='entity_id', how='inner', sort=False, copy=False)
 
         # add the article urls
-        article_urls = pd.read_csv(Path(self.data_path, "data/urls.csv"))
-        articles = pd.merge(articles, article_urls, on='entity_id')
+        article_urls = self._read_csv_cached(str(Path(self.data_path, "data/urls.csv")))
+        article_urls = article_urls.assign(entity_id=article_urls['entity_id'].astype('int64'))
+        articles = articles.merge(article_urls, on='entity_id', how='inner', sort=False, copy=False)
 
         print(" ... {} articles loaded".format(articles.shape[0]))
         self.data[version_id] = articles
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _read_csv_cached(path: str) -> pd.DataFrame:
+        """Read a csv once per process; used for the id and url lookup files shared by every article version.
+        The returned DataFrame is shared between callers and must not be modified in place."""
+        return _read_csv(path)
+
+    @staticmethod
+    def _read_article(file: str) -> Tuple[int, str]:
+        """Read one article file, returning its entity_id (the file name before the first .) and its content."""
+        # keep what's after the last / and before the .
+        entity_id = os.path.basename(file).split('.')[0]
+        # read the whole file with a single read() into one buffer and decode it in one go
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            raw = os.read(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        # to enforce encoding -- it generates errors without it!
+        content = raw.decode('utf-8')
+        # apply the same universal newline translation as reading in text mode
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+        return int(entity_id), content
+
     def _load_responses(self) -> None:
         print("Loading responses...")
-        self.data['responses'] = pd.read_csv(Path(self.data_path, "data/responses.csv"))
+        self.data['responses'] = _read_csv(Path(self.data_path, "data/responses.csv"))
+        # also keep the responses indexed by entity_id, so lookups by id are index probes rather than column scans
+        self.data['responses_by_id'] = self.data['responses'].set_index('entity_id').sort_index()
         print(" ... {} responses loaded".format(self.data['responses'].shape[0]))
 
     def _articles(self, version) -> pd.DataFrame:
@@ -139,7 +205,7 @@ class DataManager:
     @classmethod
     def generate_filename_for_file(cls, tag: str = None) -> str:
         repo_path = cls.get_repo_path()
-        git_hash = cls._get_git_hash(repo_path)
+        git_hash = cls._git_hash_cached(repo_path)
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         if tag:
             filename = "{}_{}_{}".format(timestamp, git_hash, tag)
@@ -165,8 +231,8 @@ class DataManager:
 
         filename = self.generate_filename_for_file(tag)
         filepath = Path(self.data_path, "data/transformed_data", "{}.pkl".format(filename))
-        with open(filepath, "wb+") as f:
-            pickle.dump(data, f)
+        with open(filepath, "wb", buffering=PICKLE_BUFFER_SIZE) as f:
+            pickle.dump(data, f, protocol=PICKLE_PROTOCOL)
         print("Saved data to {}".format(filepath))
         return filepath
 
@@ -189,7 +255,7 @@ class DataManager:
             filepath = Path(self.data_path, "data/transformed_data/{}".format(filename))
         else:
             filepath = Path(self.data_path, "data/transformed_data/{}.pkl".format(filename))
-        with open(filepath, "rb+") as f:
+        with open(filepath, "rb", buffering=PICKLE_BUFFER_SIZE) as f:
             return pickle.load(f)
 
     def load_cached_data_processor(self, file_name: str) -> 'DataProcessor':
@@ -200,20 +266,23 @@ class DataManager:
         """Load the most recent pickled data dictionary from the data/transformed directory,
         as determined by the timestamp in the filename. """
 
-        filepath = Path(self.data_path, "data/transformed_data/*")
-        files = glob.glob(filepath.__str__())
+        filepath = Path(self.data_path, "data/transformed_data")
+        # file names start with a timestamp, so the most recent is the max by name: one pass, no sort
+        with os.scandir(filepath) as entries:
+            chosen_one = max((entry.name for entry in entries if entry.is_file()), default=None)
 
-        if len(files) == 0:
+        if chosen_one is None:
             print("ERROR: no files found at {}".format(filepath))
             return
 
-        filenames = [os.path.basename(file) for file in files]
-        filenames.sort()
-        chosen_one = filenames[-1]
         print("Loading {}".format(chosen_one))
         return self.load_transformed_data(chosen_one)
 
     def save_experiment(self, experiment_object: Any, file_name: str) -> str:
+        """Save an experiment object to the experiment_objects directory.
+        The file format is chosen from file_name's extension, and defaults to dill, which (unlike pickle and joblib)
+        can serialize the preprocessing functions that experiments hold. For array-heavy objects without such
+        functions, e.g. a bare trained sklearn model, use a `.joblib` file name."""
         data_interface = DataInterfaceManager.select(file_name, default_file_type='dill')
         file_dir_path = Path(self.data_path, 'experiment_objects')
         data_interface.save(experiment_object, file_name=file_name, file_dir_path=file_dir_path)
@@ -229,7 +298,7 @@ class DataManager:
         return experiment_object
 
     @classmethod
-    def _get_git_hash(cls, path: str) -> str:
+    def _get_git_hash(cls, path: str, repo: Repo = None) -> str:
         """
         Get the short hash of latest git commit, first checking that all changes have been committed.
         If there are uncommitted changes, raise an error.
@@ -237,19 +306,42 @@ class DataManager:
 
         Arguments:
             path (str): Path to git repo.
+            repo (Repo): Optional, an already constructed Repo for `path`. If given, the hash is read in-process
+                instead of by running `git rev-parse`.
 
         Returns:
             git_hash (str): Short hash of latest commit on the active branch of the git repo.
         """
+        if repo is not None:
+            return repo.head.commit.hexsha[:7]
+
         git_hash_raw = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
                                                cwd=path)
         git_hash = git_hash_raw.strip().decode("utf-8")
         return git_hash
 
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _git_hash_cached(path: str) -> str:
+        """Memoized `_get_git_hash`, so a batch of saves only shells out to git once. See `invalidate_git_cache`."""
+        return DataManager._get_git_hash(path, repo=Repo(path, search_parent_directories=True))
+
     @classmethod
     def check_for_uncommitted_git_changes(cls):
+        """Check the repo for uncommitted changes. Once the repo has been found clean, later calls skip the check until
+        `invalidate_git_cache` is called."""
+        if cls._git_clean_checked:
+            return False
         repo_path = cls.get_repo_path()
-        return cls._check_for_uncommitted_git_changes_at_path(repo_path)
+        result = cls._check_for_uncommitted_git_changes_at_path(repo_path)
+        DataManager._git_clean_checked = True
+        return result
+
+    @staticmethod
+    def invalidate_git_cache() -> None:
+        """Forget the cached git hash and clean-repo check, e.g. after committing new changes in a running session."""
+        DataManager._git_hash_cached.cache_clear()
+        DataManager._git_clean_checked = False
 
     @classmethod
     def _check_for_uncommitted_git_changes_at_path(cls, repo_path: str) -> bool:
@@ -264,22 +356,17 @@ class DataManager:
         """
         repo = Repo(repo_path, search_parent_directories=True)
 
-        try:
-            # get list of gitignore filenames and extensions as these wouldn't have been code synced over
-            # and therefore would appears as if they were uncommitted changes
-            with open(os.path.join(repo.working_tree_dir, '.gitignore'), 'r') as f:
-                gitignore = [line.strip() for line in f.readlines() if not line.startswith('#') and line != '\n']
-        except FileNotFoundError:
-            gitignore = []
-
-        gitignore_files = [item for item in gitignore if not item.startswith('*')]
-        gitignore_ext = [item.strip('*') for item in gitignore if item.startswith('*')]
-
-        # get list of changed files, but ignore ones in gitignore (either by filename match or extension match)
-        changed_files = [item.a_path for item in repo.index.diff(None)
-                         if os.path.basename(item.a_path) not in gitignore_files]
-        changed_files = [item for item in changed_files
-                         if not any([item.endswith(ext) for ext in gitignore_ext])]
+        changed_files = [item.a_path for item in repo.index.diff(None)]
+        if len(changed_files) == 0:
+            return False
+
+        # files matching .gitignore wouldn't have been code synced over and therefore would appear as if they were
+        # uncommitted changes. Let git match them all in one call; --no-index so tracked files are matched too
+        check_ignore = subprocess.run(['git', 'check-ignore', '--no-index', '--stdin', '-z'],
+                                      input='\0'.join(changed_files).encode('utf-8'), stdout=subprocess.PIPE,
+                                      cwd=repo.working_tree_dir)
+        ignored_files = set(check_ignore.stdout.decode('utf-8').split('\0'))
+        changed_files = [item for item in changed_files if item not in ignored_files]
 
         if len(changed_files) > 0:
             raise RuntimeError('There are uncommitted changes in files: {}'
@@ -315,7 +402,7 @@ class DataManager:
     def _load_metamap_semantics(self):
         metamap_semantics_path = pkg_resources.resource_filename('autodiscern',
                                                                  'data/metamap_semantics/metamap_semantics.csv')
-        self.data['metamap_semantics'] = pd.read_csv(metamap_semantics_path)
+        self.data['metamap_semantics'] = _read_csv(metamap_semantics_path)
 
     @property
     def metamap_semantics(self) -> pd.DataFrame:
@@ -418,17 +505,23 @@ class DataProcessorCacheManager:
         return data_file_extension
 
     def list_cached_data_processors(self, file_dir_path: str):
-        # glob for all processor files
-        processors_path = Path("{}/*{}.{}".format(file_dir_path, self.processor_designation,
-                                                  self.processor_data_interface.file_extension))
-        processor_files = glob.glob(processors_path.__str__())
-        processor_names = [os.path.basename(file).split('.')[0] for file in processor_files]
+        """List the names of the data processors cached in file_dir_path, i.e. the file names without the processor
+        designation and file extension."""
+        suffix = "{}.{}".format(self.processor_designation, self.processor_data_interface.file_extension)
+        with os.scandir(file_dir_path) as entries:
+            processor_names = [entry.name[:-len(suffix)] for entry in entries if entry.name.endswith(suffix)]
         return processor_names
 
 
 class DataInterface:
 
     file_extension = None
+    _dot_ext = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # cache the '.ext' suffix once per interface, rather than formatting it on every save/load
+        cls._dot_ext = '.{}'.format(cls.file_extension)
 
     @classmethod
     def construct_file_path(cls, file_name: str, file_dir_path: str) -> Path:
@@ -442,10 +535,10 @@ class DataInterface:
         Returns: Path
 
         """
-        if '.{}'.format(cls.file_extension) in file_name:
+        if file_name.endswith(cls._dot_ext):
             return Path(file_dir_path, file_name)
         else:
-            return Path(file_dir_path, "{}.{}".format(file_name, cls.file_extension))
+            return Path(file_dir_path, file_name + cls._dot_ext)
 
     @classmethod
     def save(cls, data: Any, file_name: str, file_dir_path: str) -> None:
@@ -472,30 +565,61 @@ class PickleDataInterface(DataInterface):
 
     @classmethod
     def _interface_specific_save(cls, data: Any, file_path) -> None:
-        with open(file_path, "wb+") as f:
-            pickle.dump(data, f)
+        with open(file_path, "wb", buffering=PICKLE_BUFFER_SIZE) as f:
+            pickle.dump(data, f, protocol=PICKLE_PROTOCOL)
 
     @classmethod
     def _interface_specific_load(cls, file_path) -> Any:
-        with open(file_path, "rb+") as f:
+        with open(file_path, "rb", buffering=PICKLE_BUFFER_SIZE) as f:
             return pickle.load(f)
 
 
+LZ4_FRAME_MAGIC_NUMBER = b'\x04\x22\x4d\x18'
+
+
+def _is_lz4_compressed(file_path) -> bool:
+    with open(file_path, "rb") as f:
+        return f.read(len(LZ4_FRAME_MAGIC_NUMBER)) == LZ4_FRAME_MAGIC_NUMBER
+
+
 class DillDataInterface(DataInterface):
+    """Dill files, LZ4 frame compressed. Uncompressed files (written before compression was added) are detected on load
+    by the absence of the LZ4 frame magic number."""
 
     file_extension = 'dill'
 
     @classmethod
     def _interface_specific_save(cls, data: Any, file_path) -> None:
-        with open(file_path, "wb+") as f:
-            dill.dump(data, f)
+        with lz4.frame.open(file_path, "wb") as f:
+            dill.dump(data, f, protocol=PICKLE_PROTOCOL)
 
     @classmethod
     def _interface_specific_load(cls, file_path) -> Any:
-        with open(file_path, "rb+") as f:
+        if not _is_lz4_compressed(file_path):
+            with open(file_path, "rb", buffering=PICKLE_BUFFER_SIZE) as f:
+                return dill.load(f)
+
+        with lz4.frame.open(file_path, "rb") as f:
             return dill.load(f)
 
 
+class JoblibDataInterface(DataInterface):
+    """Joblib files, for array-heavy objects such as trained sklearn models. Arrays are written as raw buffers rather
+    than through the pickle VM, and the file is LZ4 compressed."""
+
+    file_extension = 'joblib'
+
+    @classmethod
+    def _interface_specific_save(cls, data: Any, file_path) -> None:
+        import joblib
+        joblib.dump(data, file_path, compress=('lz4', 3), protocol=PICKLE_PROTOCOL)
+
+    @classmethod
+    def _interface_specific_load(cls, file_path) -> Any:
+        import joblib
+        return joblib.load(file_path)
+
+
 class CSVDataInterface(DataInterface):
 
     file_extension = 'csv'
@@ -509,6 +633,31 @@ class CSVDataInterface(DataInterface):
         return pd.read_csv(file_path)
 
 
+class FeatherDataInterface(DataInterface):
+    """Columnar storage for DataFrames, via pyarrow (the `feather` extra). The DataFrame must have a default index."""
+
+    file_extension = 'feather'
+
+    @classmethod
+    def _interface_specific_save(cls, data, file_path):
+        cls._check_pyarrow_for(file_path)
+        data.to_feather(file_path)
+
+    @classmethod
+    def _interface_specific_load(cls, file_path):
+        cls._check_pyarrow_for(file_path)
+        return pd.read_feather(file_path)
+
+    @staticmethod
+    def _check_pyarrow_for(file_path):
+        """Raise a clear error if pyarrow, which pandas needs for feather files, is not installed. """
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("{} is a feather file, which requires the pyarrow package. Install it with "
+                              "'pip install autodiscern[feather]'.".format(file_path))
+
+
 class TextDataInterface(DataInterface):
 
     file_extension = 'txt'
@@ -532,6 +681,8 @@ class DataInterfaceManager:
         'pkl': PickleDataInterface,
         'csv': CSVDataInterface,
         'dill': DillDataInterface,
+        'feather': FeatherDataInterface,
+        'joblib': JoblibDataInterface,
         'txt': TextDataInterface,
     }
 
@@ -555,8 +706,8 @@ class DataInterfaceManager:
         Returns: A DataInterface.
 
         """
-        if '.' in file_hint:
-            file_name, file_extension = file_hint.split('.')
+        file_name, sep, file_extension = file_hint.rpartition('.')
+        if sep and file_extension in cls.registered_interfaces:
             return cls.create(file_extension)
         elif file_hint in cls.registered_interfaces:
             return cls.create(file_hint)
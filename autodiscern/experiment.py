@@ -1,9 +1,10 @@
+import copy
+from joblib import Memory, Parallel, cpu_count, delayed, effective_n_jobs, parallel_backend
 import numpy as np
 import pandas as pd
-import random
 from scipy.sparse import coo_matrix
 from sklearn.base import clone
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
 from sklearn.feature_selection import RFECV
 from sklearn.model_selection import RandomizedSearchCV, StratifiedKFold
 from sklearn.metrics import f1_score
@@ -23,7 +24,8 @@ class PartitionedExperiment:
 
     def __init__(self, name: str, data_dict: Dict, label_key: str, preprocessing_func: Callable,
                  model_run_class: "ModelRun", model, hyperparams: Dict, n_partitions: int = 5, stratify_by='label',
-                 feature_subset=None, reduce_features=False, verbose=False):
+                 feature_subset=None, reduce_features=False, verbose=False, n_jobs: int = -1,
+                 n_jobs_search: int = None, cache_dir: str = None, random_state: int = None):
         """
 
         Args:
@@ -39,6 +41,12 @@ class PartitionedExperiment:
             feature_subset: Subset of features to use. If not used, None is passed.
             reduce_features: Whether to use recursive feature elimination to reduce features.
             verbose: Whether to display verbose messages.
+            n_jobs: Number of partitions to run in parallel. -1 means using all processors.
+            n_jobs_search: Number of jobs to use for the hyperparameter search (and feature elimination) within each
+                partition. If None, the cores are split between the partitions running in parallel, so the nested
+                jobs do not oversubscribe the CPU.
+            cache_dir: Directory to cache trained encoders and feature matrices in. If None, nothing is cached.
+            random_state: Seed for the shuffle of the unstratified partitions, for reproducible partitions.
         """
 
         if n_partitions < 2:
@@ -54,8 +62,19 @@ class PartitionedExperiment:
         self.hyperparams = hyperparams
         self.feature_subset = feature_subset
         self.reduce_features = reduce_features
+        self.n_jobs = n_jobs
+        if n_jobs_search is None:
+            n_parallel_partitions = min(effective_n_jobs(n_jobs), n_partitions)
+            n_jobs_search = max(1, cpu_count() // n_parallel_partitions)
+        self.n_jobs_search = n_jobs_search
+        self.cache_dir = cache_dir
+        self.random_state = random_state
 
         self.n_partitions = n_partitions
+        # index the entity_ids once, so each partition is materialized with one vectorized membership test
+        self._entity_index = self.build_entity_index(data_dict)
+        # per-document data computed by model_run_class.precompute, refreshed on each run
+        self._precomputed = {}
 
         document_ids, doc_labels = self.build_doc_id_and_label_lists(data_dict, model_run_class, label_key)
         if stratify_by == 'label':
@@ -64,7 +83,8 @@ class PartitionedExperiment:
             doc_categories = [self.data_dict[doc_id]['categoryName'] for doc_id in self.data_dict]
             self.partitions_by_ids = self.partition_document_ids_by_category(document_ids, doc_categories, category_key)
         else:
-            self.partitions_by_ids = self.partition_document_ids(document_ids, self.n_partitions)
+            self.partitions_by_ids = self.partition_document_ids(document_ids, self.n_partitions,
+                                                                 random_state=self.random_state)
 
         self.model_runs = {}
         self.all_run_results = []
@@ -90,36 +110,51 @@ class PartitionedExperiment:
             partitions_to_run = partitions_to_run[:num_partitions_to_run]
             print("Running only partitions {}".format(", ".join(partitions_to_run)))
 
-        for partition_name in self.partitions_by_ids:
-            if partition_name in partitions_to_run:
-                print("Running partition {}...".format(partition_name))
-                model_run = self.run_experiment_on_one_partition(data_dict=self.data_dict,
-                                                                 label_key=self.label_key,
-                                                                 partition_ids=self.partitions_by_ids[partition_name],
-                                                                 preprocessing_func=self.preprocessing_func,
-                                                                 model_run_class=self.model_run_class,
-                                                                 model=self.model,
-                                                                 hyperparams=self.hyperparams,
-                                                                 run_hyperparam_search=run_hyperparam_search,
-                                                                 feature_subset=self.feature_subset,
-                                                                 reduce_features=self.reduce_features)
-                self.model_runs[partition_name] = model_run
+        self._precomputed = self.model_run_class.precompute(self._entity_index[1], previous=self._precomputed)
+
+        # partitions are independent, so run them in parallel worker processes. The partitions are materialized here,
+        # so each worker is only sent its own train and test sets, not the whole data_dict
+        tasks = []
+        for partition_name in partitions_to_run:
+            print("Running partition {}...".format(partition_name))
+            train_set, test_set = self.materialize_partition(self.partitions_by_ids[partition_name], self.data_dict,
+                                                             entity_index=self._entity_index)
+            train_set = self.model_run_class.attach_precomputed(train_set, self._precomputed)
+            test_set = self.model_run_class.attach_precomputed(test_set, self._precomputed)
+            tasks.append(delayed(self.run_experiment_on_one_partition)(
+                train_set=train_set,
+                test_set=test_set,
+                label_key=self.label_key,
+                preprocessing_func=self.preprocessing_func,
+                model_run_class=self.model_run_class,
+                model=self.model,
+                hyperparams=self.hyperparams,
+                run_hyperparam_search=run_hyperparam_search,
+                feature_subset=self.feature_subset,
+                reduce_features=self.reduce_features,
+                n_jobs_search=self.n_jobs_search,
+                cache_dir=self.cache_dir))
+        # cap BLAS/OpenMP threads in the workers, the parallelism comes from the partitions and the CV fits
+        with parallel_backend('loky', inner_max_num_threads=1):
+            model_runs = Parallel(n_jobs=self.n_jobs, pre_dispatch='2*n_jobs')(tasks)
+        for partition_name, model_run in zip(partitions_to_run, model_runs):
+            self.model_runs[partition_name] = model_run
 
         print("Compiling results")
         self.experiment_results = self.summarize_runs(self.model_runs)
         return self.experiment_results
 
     @classmethod
-    def run_experiment_on_one_partition(cls, data_dict: Dict, label_key: str, partition_ids: List[int],
+    def run_experiment_on_one_partition(cls, train_set: List[Dict], test_set: List[Dict], label_key: str,
                                         preprocessing_func: Callable, model_run_class: "ModelRun", model,
                                         hyperparams: Dict, run_hyperparam_search: bool, feature_subset: List[str],
-                                        reduce_features: bool):
-        train_set, test_set = cls.materialize_partition(partition_ids, data_dict)
+                                        reduce_features: bool, n_jobs_search: int = -1, cache_dir: str = None):
         mr = model_run_class(train_set=train_set, test_set=test_set, label_key=label_key, model=model,
                              preprocessing_func=preprocessing_func, hyperparams=hyperparams,
-                             feature_subset=feature_subset, reduce_features=reduce_features)
+                             feature_subset=feature_subset, reduce_features=reduce_features,
+                             n_jobs_search=n_jobs_search, cache_dir=cache_dir)
         mr.run(run_hyperparam_search=run_hyperparam_search)
-        return mr
+        return mr.to_summary()
 
     @staticmethod
     def build_doc_id_and_label_lists(data_dict: Dict[int, Dict], model_run_class, label_key):
@@ -136,28 +171,33 @@ class PartitionedExperiment:
 
         """
         document_labels = {}
-        for d in data_dict:
-            document_labels[data_dict[d]['entity_id']] = model_run_class.build_y_vector([data_dict[d]], label_key)
+        if model_run_class.build_y_vector.__func__ is ModelRun.build_y_vector.__func__:
+            # the default build_y_vector just reads the label, so skip the per-document call
+            for d in data_dict.values():
+                document_labels[d['entity_id']] = d[label_key]
+        else:
+            for d in data_dict.values():
+                document_labels[d['entity_id']] = model_run_class.build_y_vector([d], label_key)
         document_ids = list(document_labels.keys())
         doc_labels = [document_labels[id] for id in document_ids]
         return document_ids, doc_labels
 
     @classmethod
-    def partition_document_ids(cls, doc_list: List[int], n: int) -> Dict[str, List[int]]:
-        """Randomly shuffle and split the doc_list into n roughly equal lists."""
-        random.shuffle(doc_list)
-        return {'Partition {}'.format(i): doc_list[i::n] for i in range(n)}
+    def partition_document_ids(cls, doc_list: List[int], n: int, random_state: int = None) -> Dict[str, List[int]]:
+        """Randomly shuffle and split the doc_list into n roughly equal lists, seeding the shuffle with random_state."""
+        shuffled = np.random.RandomState(random_state).permutation(np.asarray(doc_list, dtype=np.int64))
+        return {'Partition {}'.format(i): p.tolist() for i, p in enumerate(np.array_split(shuffled, n))}
 
     @classmethod
     def partition_document_ids_stratified(cls, doc_list: List[int], label_list: List[int], n: int) -> \
             Dict[str, List[int]]:
         """Randomly shuffle and split the doc_list into n roughly equal lists, stratified by label."""
-        skf = StratifiedKFold(n_splits=n, random_state=42, shuffle=True)
-        x = np.zeros(len(label_list))  # split takes a X argument for backwards compatibility and is not used
-        partition_indexes = [test_index for train_index, test_index in skf.split(x, label_list)]
+        doc_arr = np.asarray(doc_list)
         partitions = {}
-        for p_id, p in enumerate(partition_indexes):
-            partitions['Partition {}'.format(p_id)] = [doc_list[i] for i in p]
+        skf = StratifiedKFold(n_splits=n, random_state=42, shuffle=True)
+        # split takes a X argument for backwards compatibility and only uses its length, so pass the labels again
+        for p_id, (_, test_index) in enumerate(skf.split(label_list, label_list)):
+            partitions['Partition {}'.format(p_id)] = doc_arr[test_index].tolist()
         return partitions
 
     @classmethod
@@ -173,89 +213,107 @@ class PartitionedExperiment:
 
         Returns: List of List of ints, representing each partition
         """
-        categories = np.unique(category_list)
+        category_arr = np.asarray(category_list)
+        doc_arr = np.asarray(doc_list)
         partitions = {}
-        for cat_id in categories:
-            partitions[category_key[cat_id]] = [doc_list[i] for i, val in enumerate(category_list) if val == cat_id]
+        for cat_id in np.unique(category_arr):
+            partitions[category_key[cat_id]] = doc_arr[category_arr == cat_id].tolist()
         return partitions
 
+    @staticmethod
+    def build_entity_index(data_dict: Dict) -> Tuple[np.ndarray, List[Dict]]:
+        """Return an array of the `entity_id` of each data dict, and the list of data dicts in the same order."""
+        records = list(data_dict.values())
+        entity_ids = np.fromiter((d['entity_id'] for d in records), dtype=np.int64, count=len(records))
+        return entity_ids, records
+
     @classmethod
-    def materialize_partition(cls, partition_ids: List[int], data_dict: Dict) -> Tuple[List[Dict], List[Dict]]:
-        """Create trainng and testing dataset based on the partition, which indicated the ids for the test set."""
+    def materialize_partition(cls, partition_ids: List[int], data_dict: Dict,
+                              entity_index: Tuple[np.ndarray, List[Dict]] = None) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Create trainng and testing dataset based on the partition, which indicated the ids for the test set.
+
+        Args:
+            partition_ids: The entity_ids of the test set.
+            data_dict: Dictionary of the dataset (data dicts).
+            entity_index: Optional output of `build_entity_index(data_dict)`, to reuse across partitions.
 
-        train_set = [data_dict[d] for d in data_dict if data_dict[d]['entity_id'] not in partition_ids]
-        test_set = [data_dict[d] for d in data_dict if data_dict[d]['entity_id'] in partition_ids]
+        Returns: Tuple of the train set and test set, as lists of data dicts.
 
+        """
+        if entity_index is None:
+            entity_index = cls.build_entity_index(data_dict)
+        entity_ids, records = entity_index
+
+        in_test = np.isin(entity_ids, np.asarray(partition_ids, dtype=np.int64))
+        train_set = [records[i] for i in np.flatnonzero(~in_test)]
+        test_set = [records[i] for i in np.flatnonzero(in_test)]
         return train_set, test_set
 
     @classmethod
     def report_partition_stats(cls, partitions_by_ids: Dict[str, List[int]], document_ids: List[int],
                                doc_labels: List[int]):
-        labels_dict = {}
-        for i, doc_id in enumerate(document_ids):
-            labels_dict[doc_id] = doc_labels[i]
+        # labels may be scalars or 1-element lists, as built by `build_y_vector`
+        label_arr = np.asarray(doc_labels).reshape(len(doc_labels), -1)[:, 0]
+        doc_id_arr = np.asarray(document_ids)
 
         for partition_name in partitions_by_ids:
-            p_ids = partitions_by_ids[partition_name]
-            labels_train = pd.DataFrame([labels_dict[d] for d in document_ids if d not in p_ids])
-            labels_test = pd.DataFrame([labels_dict[d] for d in document_ids if d in p_ids])
+            in_test = np.isin(doc_id_arr, np.asarray(partitions_by_ids[partition_name]))
+            labels_train = label_arr[~in_test]
+            labels_test = label_arr[in_test]
+            n_train = labels_train.shape[0]
+            n_test = labels_test.shape[0]
 
             print('\n-Partition {}-'.format(partition_name))
-            print("Train: {:,.0f} data points".format(labels_train.shape[0]))
-            print("Test: {:,.0f} data points".format(labels_test.shape[0]))
+            print("Train: {:,.0f} data points".format(n_train))
+            print("Test: {:,.0f} data points".format(n_test))
 
-            train_positive = labels_train[labels_train[0] == 1].shape[0] / labels_train.shape[0]
-            train_negative = labels_train[labels_train[0] == 0].shape[0] / labels_train.shape[0]
-            test_positive = labels_test[labels_test[0] == 1].shape[0] / labels_test.shape[0]
-            test_negative = labels_test[labels_test[0] == 0].shape[0] / labels_test.shape[0]
+            train_positive = np.count_nonzero(labels_train == 1) / n_train
+            train_negative = np.count_nonzero(labels_train == 0) / n_train
+            test_positive = np.count_nonzero(labels_test == 1) / n_test
+            test_negative = np.count_nonzero(labels_test == 0) / n_test
 
             print("Train Set: {:.0%} pos - {:.0%} neg".format(train_positive, train_negative))
             print("Test Set: {:.0%} pos - {:.0%} neg".format(test_positive, test_negative))
 
     @classmethod
     def summarize_runs(cls, run_results: Dict):
-        first_key_name = list(run_results.keys())[0]
-        if issubclass(type(run_results[first_key_name]), ModelRun):
-            return [run_results[mr].evaluation for mr in run_results]
-        elif type(run_results[first_key_name]) == dict:
-            return [{key: run_results[mr][key].evaluation} for mr in run_results for key in run_results[mr]]
+        first_run = next(iter(run_results.values()))
+        if isinstance(first_run, ModelRun):
+            return [model_run.evaluation for model_run in run_results.values()]
+        elif isinstance(first_run, dict):
+            # one row per partition and model level, with a column per evaluation metric
+            rows = [dict(partition=partition_id, level=level, **level_run.evaluation)
+                    for partition_id, level_runs in run_results.items() for level, level_run in level_runs.items()]
+            return pd.DataFrame(rows)
         else:
-            print("Unknown type stored in passed run_results: {}".format(type(run_results[first_key_name])))
+            print("Unknown type stored in passed run_results: {}".format(type(first_run)))
 
     def show_feature_importances(self):
-        all_feature_importances = pd.DataFrame()
+        frames = []
         for partition_id in self.model_runs:
-            partition_feature_importances = self.model_runs[partition_id].get_feature_importances()
+            feature_importances = self.model_runs[partition_id].get_feature_importances()
 
             # if the model has no feature importances, just exit now
-            if partition_feature_importances.shape[0] == 0:
+            if feature_importances.shape[0] == 0:
                 return pd.DataFrame()
 
-            partition_feature_importances.columns = [partition_id]
-            all_feature_importances = pd.merge(all_feature_importances, partition_feature_importances, how='outer',
-                                               left_index=True, right_index=True)
+            frames.append(feature_importances.rename(columns={0: partition_id}))
+        # outer-joins the partitions on feature name in one go, instead of merging them one at a time
+        all_feature_importances = pd.concat(frames, axis=1, join='outer')
         all_feature_importances['median'] = all_feature_importances.median(axis=1)
         return all_feature_importances.sort_values('median', ascending=False)
 
     def get_selected_hyperparams(self):
-        all_hyperparams = pd.DataFrame()
-        for partition_id in self.model_runs:
-            partition_hyperparams = self.model_runs[partition_id].get_selected_hyperparams(partition_id)
-            all_hyperparams = pd.concat([all_hyperparams, partition_hyperparams])
-        return all_hyperparams
+        frames = [self.model_runs[partition_id].get_selected_hyperparams(partition_id)
+                  for partition_id in self.model_runs]
+        return pd.concat(frames, axis=0)
 
     def show_evaluation(self, metric: str = 'accuracy'):
         all_accuracy = {}
         for partition_id in self.model_runs:
             all_accuracy[partition_id] = self.model_runs[partition_id].evaluation[metric]
-        all_accuracy_df = pd.DataFrame(all_accuracy, index=[self.name])
-        median = all_accuracy_df.median(axis=1)
-        mean = all_accuracy_df.mean(axis=1)
-        stddev = all_accuracy_df.std(axis=1)
-        all_accuracy_df['mean'] = mean
-        all_accuracy_df['median'] = median
-        all_accuracy_df['stddev'] = stddev
-        return all_accuracy_df.sort_values('median', ascending=False)
+        return self.summarize_scores(all_accuracy, self.name)
 
     def show_accuracy(self):
         res = {}
@@ -268,14 +326,26 @@ class PartitionedExperiment:
         all_accuracy = {}
         for partition_id in self.model_runs:
             all_accuracy['partition{}'.format(partition_id)] = self.model_runs[partition_id][level].evaluation[metric]
-        all_accuracy_df = pd.DataFrame(all_accuracy, index=[self.name])
-        median = all_accuracy_df.median(axis=1)
-        mean = all_accuracy_df.mean(axis=1)
-        stddev = all_accuracy_df.std(axis=1)
-        all_accuracy_df['mean'] = mean
-        all_accuracy_df['median'] = median
-        all_accuracy_df['stddev'] = stddev
-        return all_accuracy_df.sort_values('median', ascending=False)
+        return self.summarize_scores(all_accuracy, self.name)
+
+    @staticmethod
+    def summarize_scores(scores_by_partition: Dict, name: str) -> pd.DataFrame:
+        """
+        Build a one row DataFrame of the per-partition scores, with their mean, median and standard deviation.
+
+        Args:
+            scores_by_partition: Dictionary of partition name to score.
+            name: Index label for the row.
+
+        Returns: pd.DataFrame
+
+        """
+        scores = np.fromiter(scores_by_partition.values(), dtype=np.float64, count=len(scores_by_partition))
+        row = dict(scores_by_partition)
+        row['mean'] = scores.mean()
+        row['median'] = np.median(scores)
+        row['stddev'] = scores.std(ddof=1)
+        return pd.DataFrame(row, index=[name], columns=list(row))
 
     def generate_predictor(self, partition=0):
         """
@@ -292,8 +362,15 @@ class PartitionedExperiment:
 
 class ModelRun:
 
+    # one ModelRun is kept per partition (and per level in the two-level experiments), so skip the per-instance dict
+    __slots__ = ('train_set', 'test_set', 'label_key', 'encoders', 'model', 'hyperparams', 'feature_subset',
+                 '_feature_subset_set', 'reduce_features', 'n_jobs_search', 'cache_dir', 'retain_matrices',
+                 'x_train', 'x_test', 'y_train', 'y_test', 'y_train_predicted', 'y_test_predicted', 'feature_cols',
+                 'evaluation', 'rfecv', 'preprocessing_func')
+
     def __init__(self, train_set: List[Dict], test_set: List[Dict], label_key: str, model, hyperparams: Dict,
-                 preprocessing_func: Callable, feature_subset=None, reduce_features=False):
+                 preprocessing_func: Callable, feature_subset=None, reduce_features=False, n_jobs_search: int = -1,
+                 cache_dir: str = None, retain_matrices: bool = False):
         self.train_set = train_set
         self.test_set = test_set
         self.label_key = label_key
@@ -301,7 +378,11 @@ class ModelRun:
         self.model = clone(model)
         self.hyperparams = hyperparams
         self.feature_subset = feature_subset
+        self._feature_subset_set = frozenset(feature_subset) if feature_subset else None
         self.reduce_features = reduce_features
+        self.n_jobs_search = n_jobs_search
+        self.cache_dir = cache_dir
+        self.retain_matrices = retain_matrices
 
         self.x_train = None
         self.x_test = None
@@ -315,13 +396,38 @@ class ModelRun:
 
         self.preprocessing_func = preprocessing_func
 
+    def __setstate__(self, state):
+        """Restore a pickled ModelRun, including ones pickled before `__slots__` were introduced.
+
+        Those were pickled with their instance `__dict__` as state and lack the attributes added since, which are set
+        to their defaults.
+        """
+        if isinstance(state, tuple):
+            # (instance dict, slots dict), as pickled for slotted objects
+            dict_state, slots_state = state
+            state = dict(dict_state or {}, **(slots_state or {}))
+        else:
+            state = dict(state)
+        state.setdefault('n_jobs_search', -1)
+        state.setdefault('cache_dir', None)
+        state.setdefault('retain_matrices', False)
+        if '_feature_subset_set' not in state:
+            feature_subset = state.get('feature_subset')
+            state['_feature_subset_set'] = frozenset(feature_subset) if feature_subset else None
+        for key, value in state.items():
+            setattr(self, key, value)
+
     def run(self, run_hyperparam_search: bool = True):
         self.x_train, self.x_test, self.y_train, self.y_test, self.feature_cols, self.encoders = self.build_data(
-            self.train_set, self.test_set, self.label_key, self.feature_subset)
+            self.train_set, self.test_set, self.label_key, self._feature_subset_set, cache_dir=self.cache_dir)
+        # the hyperparameter search (and RFECV) refit the best estimator on the full train set already
+        already_fit = run_hyperparam_search
         if run_hyperparam_search:
-            self.model = self.search_hyperparameters(self.model, self.hyperparams, self.x_train, self.y_train)
+            self.model = self.search_hyperparameters(self.model, self.hyperparams, self.x_train, self.y_train,
+                                                     n_jobs=self.n_jobs_search)
             if self.reduce_features:
-                self.rfecv = self.train_feature_reducer(self.model, self.x_train, self.y_train)
+                self.rfecv = self.train_feature_reducer(self.model, self.x_train, self.y_train,
+                                                        n_jobs=self.n_jobs_search)
                 self.model = self.rfecv.estimator_
                 self.feature_cols = self.rebuild_feature_cols_from_rfecv(self.feature_cols, self.rfecv.support_)
         if self.reduce_features:
@@ -329,10 +435,15 @@ class ModelRun:
             self.y_test_predicted = self.rfecv.predict(self.x_test)
             self.evaluation = self.evaluate_model(self.rfecv, self.x_test, self.y_test, self.y_test_predicted)
         else:
-            self.model.fit(self.x_train, self.y_train)
+            if not already_fit:
+                self.model.fit(self.x_train, self.y_train)
             self.y_train_predicted = self.model.predict(self.x_train)
             self.y_test_predicted = self.model.predict(self.x_test)
             self.evaluation = self.evaluate_model(self.model, self.x_test, self.y_test, self.y_test_predicted)
+        if not self.retain_matrices:
+            # the feature matrices are only needed for fitting and evaluation, free them unless asked to keep them
+            self.x_train = None
+            self.x_test = None
         return self.evaluation
 
     @classmethod
@@ -344,15 +455,17 @@ class ModelRun:
         return new_feature_cols
 
     @classmethod
-    def build_data(cls, train_set: List[Dict], test_set: List[Dict], label_key: str, feature_subset: List[str]) -> \
-            Tuple[coo_matrix, coo_matrix, List, List, List, Dict]:
+    def build_data(cls, train_set: List[Dict], test_set: List[Dict], label_key: str, feature_subset: List[str],
+                   cache_dir: str = None) -> Tuple[coo_matrix, coo_matrix, List, List, List, Dict]:
         """Orchestrates the construction of train and test x matrices, and train and test y vectors.
 
         `build_data` takes as input:
             - train_set: List
             - test_set: List
             - label_key: str. key to use in data dicts for label
-            - feature_subset: List of str, or None if NA. Subset of features to use.
+            - feature_subset: Collection of str, or None if NA. Subset of features to use.
+            - cache_dir: str, or None. Directory in which to memoize the trained encoders and feature matrices, keyed
+            on the content of the data sets. The cache must be cleared when the feature code changes.
 
         `build_data` returns a Tuple of the following:
             - x_train: Matrix
@@ -365,15 +478,22 @@ class ModelRun:
 
         """
 
-        encoders = cls.train_encoders(train_set)
+        train_encoders = _train_encoders
+        build_x_features = _build_x_features
+        if cache_dir is not None:
+            memory = Memory(cache_dir, verbose=0)
+            train_encoders = memory.cache(train_encoders)
+            build_x_features = memory.cache(build_x_features)
 
-        x_train, feature_cols = cls.build_x_features(train_set, encoders)
-        x_test, feature_cols = cls.build_x_features(test_set, encoders)
+        encoders = train_encoders(cls, train_set)
+
+        x_train, feature_cols = build_x_features(cls, train_set, encoders)
+        x_test, feature_cols = build_x_features(cls, test_set, encoders)
 
         if feature_subset:
             x_train = cls.restrict_features_to_subset(x_train, feature_cols, feature_subset)
             x_test = cls.restrict_features_to_subset(x_test, feature_cols, feature_subset)
-            feature_cols = feature_subset
+            feature_cols = [col for col in feature_cols if col in feature_subset]
 
         y_train = cls.build_y_vector(train_set, label_key)
         y_test = cls.build_y_vector(test_set, label_key)
@@ -382,18 +502,52 @@ class ModelRun:
 
     @classmethod
     def restrict_features_to_subset(cls, df, old_columns, feature_subset):
-        # column_mask = [col in feature_subset for col in old_columns]
-        column_mask = []
-        for i, col_name in enumerate(old_columns):
-            if col_name in feature_subset:
-                column_mask.append(i)
-        df = df.tocsr()
-        print("type: {}".format(type(df)))
-        # df = df[:,column_mask].todense().copy()
-        df = pd.DataFrame(df[:, column_mask].todense())
-        df.columns = feature_subset
-        print(df.shape)
-        return df
+        """
+        Select the columns of a sparse feature matrix that are in `feature_subset`. The result stays sparse.
+
+        Args:
+            df: Sparse feature matrix.
+            old_columns: List of the column names of `df`.
+            feature_subset: Collection of column names to keep.
+
+        Returns: csr_matrix with only the selected columns, in their original order.
+
+        """
+        if not isinstance(feature_subset, (set, frozenset)):
+            feature_subset = frozenset(feature_subset)
+        col_idx = np.fromiter((i for i, col in enumerate(old_columns) if col in feature_subset), dtype=np.int64)
+        return df.tocsr()[:, col_idx]
+
+    @classmethod
+    def precompute(cls, data_set: List[Dict], previous: Dict = None) -> Dict:
+        """
+        Hook to compute, once, per-document data that `build_x_features` needs in every partition.
+
+        Runs in the parent process before the partitions are dispatched to the workers. The result is kept by the
+        experiment and handed to `attach_precomputed` with each materialized partition. Computes nothing by default.
+
+        Args:
+            data_set: All data dicts of the experiment.
+            previous: The mapping returned by the previous call, whose still valid entries may be reused.
+
+        Returns:
+            Dict of the precomputed data.
+        """
+        return {}
+
+    @classmethod
+    def attach_precomputed(cls, data_set: List[Dict], precomputed: Dict) -> List[Dict]:
+        """
+        Hook to add the output of `precompute` to the data dicts of one partition, without modifying them.
+
+        Args:
+            data_set: Data dicts of a train or test set.
+            precomputed: Mapping returned by `precompute`.
+
+        Returns:
+            List of data dicts. By default, `data_set` itself.
+        """
+        return data_set
 
     @classmethod
     def train_encoders(cls, train_set: List[Dict]):
@@ -425,30 +579,37 @@ class ModelRun:
                                   "with the `build_x_features` function implemented.")
 
     @classmethod
-    def build_y_vector(cls, data_set: List[Dict], label_key: str) -> List:
+    def build_y_vector(cls, data_set: List[Dict], label_key: str) -> np.ndarray:
         """
-        Extract the labels from each data dict and compile into one y vector.
+        Extract the integer class labels from each data dict and compile into one y vector.
         Args:
             data_set: List of data dicts.
             label_key: The key int he data dicts under which the label is stored.
 
         Returns:
-            Array-type
+            np.ndarray
         """
-        return [entity_dict[label_key] for entity_dict in data_set]
+        return np.fromiter((entity_dict[label_key] for entity_dict in data_set), dtype=np.int32, count=len(data_set))
 
     @classmethod
-    def search_hyperparameters(cls, model, hyperparams, x_train, y_train):
+    def search_hyperparameters(cls, model, hyperparams, x_train, y_train, n_jobs: int = -1):
         random_search = RandomizedSearchCV(estimator=model, param_distributions=hyperparams, n_iter=5, cv=2, verbose=2,
-                                           random_state=42, n_jobs=-1, scoring='f1_macro')
-        random_search.fit(x_train, y_train)
+                                           random_state=42, n_jobs=n_jobs, scoring='f1_macro', refit=True,
+                                           pre_dispatch='2*n_jobs')
+        # the sklearn trees and libsvm release the GIL, so threads avoid pickling the folds to worker processes.
+        # loky is kept for the outer partition loop
+        with parallel_backend('threading', n_jobs=n_jobs):
+            random_search.fit(x_train, y_train)
         print(random_search.best_params_)
         return random_search.best_estimator_
 
     @classmethod
-    def train_feature_reducer(cls, model, x_train, y_train):
-        rfecv = RFECV(estimator=model, step=0.05, scoring='f1_macro', n_jobs=-1)  # , cv=StratifiedKFold)
-        rfecv.fit(x_train, y_train)
+    def train_feature_reducer(cls, model, x_train, y_train, n_jobs: int = -1):
+        # eliminating 10% of the features per step halves the number of refits compared to 5%
+        rfecv = RFECV(estimator=model, step=max(1, int(0.1 * x_train.shape[1])), cv=StratifiedKFold(3),
+                      scoring='f1_macro', n_jobs=n_jobs, min_features_to_select=10)
+        with parallel_backend('threading', n_jobs=n_jobs):
+            rfecv.fit(x_train, y_train)
         print("Optimal number of features : %d" % rfecv.n_features_)
         print("Params: {}".format(rfecv.get_params()))
         return rfecv
@@ -525,3 +686,75 @@ class ModelRun:
             Predictor
         """
         return Predictor(self.model, self.encoders, self.preprocessing_func, self.build_x_features)
+
+    def to_summary(self) -> "ModelRun":
+        """
+        Return a lightweight copy of the ModelRun without the data sets and feature matrices, keeping the trained
+        model, encoders, labels, predictions and evaluation. Used to keep the results sent back from the partition
+        worker processes small.
+
+        Returns: ModelRun
+
+        """
+        summary = copy.copy(self)
+        summary.train_set = None
+        summary.test_set = None
+        summary.x_train = None
+        summary.x_test = None
+        return summary
+
+
+def calc_bucket_means(df: pd.DataFrame, value_col: str, n_parts: int = 10, grouped=None) -> pd.DataFrame:
+    """
+    Split each document's sentences into `n_parts` consecutive buckets of equal size and average `value_col` within
+    each bucket. Trailing buckets that receive no sentences get 0.
+
+    Args:
+        df: Sentence level DataFrame with a `doc_id` column, in sentence order.
+        value_col: The column to average.
+        n_parts: Number of buckets per document.
+        grouped: Optional `df.groupby('doc_id')`, to reuse a grouping the caller already has.
+
+    Returns: pd.DataFrame with one row per doc_id and one column per bucket.
+
+    """
+    doc_ids = df['doc_id']
+    if grouped is None:
+        grouped = df.groupby('doc_id')
+    position = grouped.cumcount()
+    bucket_size = np.ceil(doc_ids.map(doc_ids.value_counts()) / n_parts).astype(int)
+    buckets = df.assign(bucket=(position // bucket_size).values)
+    bucket_means = buckets.groupby(['doc_id', 'bucket'])[value_col].mean().unstack('bucket', fill_value=0)
+    bucket_means = bucket_means.reindex(columns=range(n_parts), fill_value=0)
+    return bucket_means.rename_axis(index=None, columns=None)
+
+
+def predict_from_proba(model, x, proba_prediction: np.ndarray) -> np.ndarray:
+    """
+    Predict the class of each row of `x`, given the model's `predict_proba(x)` output.
+
+    A forest predicts the class with the highest mean probability, so for forests the class is derived from
+    `proba_prediction` instead of scoring `x` a second time. Other models, such as an `SVC` whose probabilities come
+    from Platt scaling, can disagree with their own probabilities and are asked for `predict(x)`.
+
+    Args:
+        model: Fitted classifier.
+        x: Feature matrix.
+        proba_prediction: `model.predict_proba(x)`.
+
+    Returns: np.ndarray of predicted classes.
+
+    """
+    if isinstance(model, (RandomForestClassifier, ExtraTreesClassifier)):
+        return model.classes_[np.argmax(proba_prediction, axis=1)]
+    return model.predict(x)
+
+
+def _train_encoders(model_run_class: "ModelRun", train_set: List[Dict]):
+    """Module level wrapper around `ModelRun.train_encoders`, so it can be memoized with joblib.Memory."""
+    return model_run_class.train_encoders(train_set)
+
+
+def _build_x_features(model_run_class: "ModelRun", data_set: List[Dict], encoders: Dict):
+    """Module level wrapper around `ModelRun.build_x_features`, so it can be memoized with joblib.Memory."""
+    return model_run_class.build_x_features(data_set, encoders)
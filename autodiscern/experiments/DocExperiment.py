@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from scipy.sparse import hstack, coo_matrix
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -22,6 +23,32 @@ from autodiscern import experiment, model, lemmatization
 
 class DocLevelModelRun(experiment.ModelRun):
 
+    @classmethod
+    def precompute(cls, data_set: List[Dict], previous: Dict = None) -> Dict:
+        """
+        Lemmatize each document once, keyed on (entity_id, content), reusing the lemmas of `previous` for documents
+        whose content is unchanged.
+        """
+        previous = previous or {}
+        lemmas = {}
+        lemmatizer = None
+        for entity_dict in data_set:
+            key = (entity_dict['entity_id'], entity_dict['content'])
+            if key in lemmas:
+                continue
+            if key in previous:
+                lemmas[key] = previous[key]
+            else:
+                if lemmatizer is None:
+                    lemmatizer = lemmatization.Lemmatizer()
+                lemmas[key] = lemmatizer.lemmatize(entity_dict['content'])
+        return lemmas
+
+    @classmethod
+    def attach_precomputed(cls, data_set: List[Dict], precomputed: Dict) -> List[Dict]:
+        return [dict(entity_dict, content_lemmas=precomputed[(entity_dict['entity_id'], entity_dict['content'])])
+                for entity_dict in data_set]
+
     @classmethod
     def train_encoders(cls, train_set: List[Dict]):
         corpus_train = [entity_dict['content'] for entity_dict in train_set]
@@ -34,10 +61,12 @@ class DocLevelModelRun(experiment.ModelRun):
 
     @classmethod
     def build_x_features(cls, data_set: List[Dict], encoders):
-        corpus = [entity_dict['content'] for entity_dict in data_set]
-
-        lemmatizer = lemmatization.Lemmatizer()
-        corpus_lemmas = lemmatizer.lemmatize_list_of_texts(corpus)
+        if all('content_lemmas' in entity_dict for entity_dict in data_set):
+            corpus_lemmas = [entity_dict['content_lemmas'] for entity_dict in data_set]
+        else:
+            corpus = [entity_dict['content'] for entity_dict in data_set]
+            lemmatizer = lemmatization.Lemmatizer()
+            corpus_lemmas = lemmatizer.lemmatize_list_of_texts(corpus)
 
         x_tfidf = encoders['vectorizer'].transform(corpus_lemmas)
         feature_vec = pd.concat([entity_dict['feature_vec'] for entity_dict in data_set], axis=0)
@@ -49,7 +78,7 @@ class DocLevelModelRun(experiment.ModelRun):
         return x_all, feature_cols
 
     @classmethod
-    def build_y_vector(cls, data_set: List[Dict], label_key: str) -> List:
+    def build_y_vector(cls, data_set: List[Dict], label_key: str) -> np.ndarray:
         """
         Extract the labels from each data dict and compile into one y vector.
         Args:
@@ -57,7 +86,7 @@ class DocLevelModelRun(experiment.ModelRun):
             label_key: The key int he data dicts under which the label is stored.
 
         Returns:
-            Array-type
+            np.ndarray
         """
-        return [model.zero_one_category(model.get_score_for_question(entity_dict, label_key)) for entity_dict in
-                data_set]
+        return np.fromiter((model.zero_one_category(model.get_score_for_question(entity_dict, label_key))
+                            for entity_dict in data_set), dtype=np.int32, count=len(data_set))
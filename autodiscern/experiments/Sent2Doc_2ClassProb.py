@@ -10,15 +10,14 @@ from autodiscern.experiments.TwoLevelSentenceExperiment import SentenceLevelMode
 class Sent2Doc_2ClassProb_Experiment(ade.PartitionedExperiment):
 
     @classmethod
-    def run_experiment_on_one_partition(cls, data_dict: Dict, label_key: str, partition_ids: List[int],
+    def run_experiment_on_one_partition(cls, train_set: List[Dict], test_set: List[Dict], label_key: str,
                                         preprocessing_func: Callable, model_run_class: ade.ModelRun, model,
-                                        hyperparams: Dict, run_hyperparam_search: bool):
-
-        train_set, test_set = cls.materialize_partition(partition_ids, data_dict)
+                                        hyperparams: Dict, run_hyperparam_search: bool, **kwargs):
 
         # run SentenceLevelModel
         sl_mr = SentenceLevelModelRun(train_set=train_set, test_set=test_set, label_key=label_key, model=model,
-                                      preprocessing_func=preprocessing_func, hyperparams=hyperparams)
+                                      preprocessing_func=preprocessing_func, hyperparams=hyperparams,
+                                      retain_matrices=True)
         sl_mr.run(run_hyperparam_search=run_hyperparam_search)
 
         # use predictions from SentenceLevelModel to create training set for SentenceToDocModel
@@ -29,20 +28,21 @@ class Sent2Doc_2ClassProb_Experiment(ade.PartitionedExperiment):
                                            model=model, preprocessing_func=preprocessing_func, hyperparams=hyperparams)
         dl_mr.run(run_hyperparam_search=run_hyperparam_search)
 
-        return {'sentence_level': sl_mr,
-                'doc_level': dl_mr}
+        return {'sentence_level': sl_mr.to_summary(),
+                'doc_level': dl_mr.to_summary()}
 
     @classmethod
     def create_sent_to_doc_data_set(cls, model, x_feature_set, data_set: List, label_key: str):
-        cat_prediction = model.predict(x_feature_set)
         proba_prediction = model.predict_proba(x_feature_set)
+        cat_prediction = ade.predict_from_proba(model, x_feature_set, proba_prediction)
         new_data_set = pd.DataFrame({
-            'doc_id': [d['entity_id'] for d in data_set],
-            'sub_id': [d['sub_id'] for d in data_set],
-            'sub_prediction': cat_prediction,
-            'proba_0': [i[0] for i in proba_prediction],
-            'proba_1': [i[1] for i in proba_prediction],
-            'label': [admodel.zero_one_category(admodel.get_score_for_question(d, label_key)) for d in data_set],
+            'doc_id': np.fromiter((d['entity_id'] for d in data_set), dtype=np.int32, count=len(data_set)),
+            'sub_id': np.fromiter((d['sub_id'] for d in data_set), dtype=np.int32, count=len(data_set)),
+            'sub_prediction': cat_prediction.astype(np.int8),
+            'proba_0': proba_prediction[:, 0].astype(np.float32),
+            'proba_1': proba_prediction[:, 1].astype(np.float32),
+            'label': np.fromiter((admodel.zero_one_category(admodel.get_score_for_question(d, label_key))
+                                  for d in data_set), dtype=np.int8, count=len(data_set)),
         })
         return new_data_set
 
@@ -51,22 +51,18 @@ class Sent2Doc_2ClassProb_Experiment(ade.PartitionedExperiment):
               "Use `show_sent_feature_importances` or `show_doc_feature_importances`.")
 
     def show_sent_feature_importances(self):
-        all_feature_importances = pd.DataFrame()
-        for partition_id in self.model_runs:
-            partition_feature_importances = self.model_runs[partition_id]['sentence_level'].get_feature_importances()
-            partition_feature_importances.columns = [partition_id]
-            all_feature_importances = pd.merge(all_feature_importances, partition_feature_importances, how='outer',
-                                               left_index=True, right_index=True)
+        frames = [self.model_runs[partition_id]['sentence_level'].get_feature_importances().rename(
+                      columns={0: partition_id})
+                  for partition_id in self.model_runs]
+        all_feature_importances = pd.concat(frames, axis=1, join='outer')
         all_feature_importances['median'] = all_feature_importances.median(axis=1)
         return all_feature_importances.sort_values('median', ascending=False)
 
     def show_doc_feature_importances(self):
-        all_feature_importances = pd.DataFrame()
-        for partition_id in self.model_runs:
-            partition_feature_importances = self.model_runs[partition_id]['doc_level'].get_feature_importances()
-            partition_feature_importances.columns = [partition_id]
-            all_feature_importances = pd.merge(all_feature_importances, partition_feature_importances, how='outer',
-                                               left_index=True, right_index=True)
+        frames = [self.model_runs[partition_id]['doc_level'].get_feature_importances().rename(
+                      columns={0: partition_id})
+                  for partition_id in self.model_runs]
+        all_feature_importances = pd.concat(frames, axis=1, join='outer')
         all_feature_importances['median'] = all_feature_importances.median(axis=1)
         return all_feature_importances.sort_values('median', ascending=False)
 
@@ -75,22 +71,15 @@ class Sent2Doc_2ClassProb_Experiment(ade.PartitionedExperiment):
         if 'doc' in model_level:
             level_key = 'doc_level'
 
-        all_hyperparams = pd.DataFrame()
-        for partition_id in self.model_runs:
-            partition_hyperparams = self.model_runs[partition_id][level_key].get_selected_hyperparams(partition_id)
-            all_hyperparams = pd.concat([all_hyperparams, partition_hyperparams])
-        return all_hyperparams
+        frames = [self.model_runs[partition_id][level_key].get_selected_hyperparams(partition_id)
+                  for partition_id in self.model_runs]
+        return pd.concat(frames, axis=0)
 
     def show_evaluation(self, metric: str = 'accuracy'):
         all_accuracy = {}
         for partition_id in self.model_runs:
             all_accuracy[partition_id] = self.model_runs[partition_id]['doc_level'].evaluation[metric]
-        all_accuracy_df = pd.DataFrame(all_accuracy, index=[self.name])
-        median = all_accuracy_df.median(axis=1)
-        stddev = all_accuracy_df.std(axis=1)
-        all_accuracy_df['median'] = median
-        all_accuracy_df['stddev'] = stddev
-        return all_accuracy_df.sort_values('median', ascending=False)
+        return self.summarize_scores(all_accuracy, self.name)
 
     def generate_predictor(self, partition=0):
         """
@@ -113,6 +102,8 @@ class Sent2Doc_2ClassProb_Experiment(ade.PartitionedExperiment):
 
 class SentenceToDocProbaModelRun(ade.ModelRun):
 
+    __slots__ = ()
+
     @classmethod
     def train_encoders(cls, train_set: List[Dict]):
         return None
@@ -125,38 +116,9 @@ class SentenceToDocProbaModelRun(ade.ModelRun):
 
     @classmethod
     def build_y_vector(cls, data_set: pd.DataFrame, label_key: str) -> List:
-        return data_set.groupby('doc_id')['label'].median()
+        # all sentences of a document carry the document's 0/1 label, so the rounded mean equals the median
+        return data_set.groupby('doc_id')['label'].mean().round().astype(np.int8)
 
     @classmethod
     def sents_to_doc_buckets_mean(cls, df: pd.DataFrame):
-        series_of_list_of_bucket_avgs = df.groupby('doc_id')['sub_prediction'].apply(calc_avg_over_ten_parts)
-        df = series_of_list_to_df_columns(series_of_list_of_bucket_avgs)
-        return df
-
-
-def mean_0_when_empty(p):
-    if len(p) == 0:
-        return 0
-    else:
-        return sum(p)/len(p)
-
-
-def calc_avg_over_equal_parts(the_list, n_partitions):
-    n = int(np.ceil(len(the_list)/n_partitions))
-    partitions = [the_list[i*n:i*n+n] for i in range(n_partitions)]
-    return [mean_0_when_empty(p) for p in partitions]
-
-
-def calc_avg_over_ten_parts(the_list):
-    return calc_avg_over_equal_parts(the_list, 10)
-
-
-def series_of_list_to_df_columns(a_series_of_lists):
-    df = pd.DataFrame()
-    for ix in a_series_of_lists.index:
-        d = {}
-        #     d['doc_id'] = ix
-        for col_i, value in enumerate(a_series_of_lists[ix]):
-            d[col_i] = value
-        df = pd.concat([df, pd.DataFrame(d, index=[ix])])
-    return df
+        return ade.calc_bucket_means(df, 'sub_prediction')
@@ -11,15 +11,14 @@ from autodiscern import model
 class TwoLevelSentenceExperiment(ade.PartitionedExperiment):
 
     @classmethod
-    def run_experiment_on_one_partition(cls, data_dict: Dict, label_key: str, partition_ids: List[int],
+    def run_experiment_on_one_partition(cls, train_set: List[Dict], test_set: List[Dict], label_key: str,
                                         preprocessing_func: Callable, model_run_class: ade.ModelRun, model,
-                                        hyperparams: Dict, run_hyperparam_search: bool):
-
-        train_set, test_set = cls.materialize_partition(partition_ids, data_dict)
+                                        hyperparams: Dict, run_hyperparam_search: bool, **kwargs):
 
         # run SentenceLevelModel
         sl_mr = SentenceLevelModelRun(train_set=train_set, test_set=test_set, label_key=label_key, model=model,
-                                      preprocessing_func=preprocessing_func, hyperparams=hyperparams)
+                                      preprocessing_func=preprocessing_func, hyperparams=hyperparams,
+                                      retain_matrices=True)
         sl_mr.run(run_hyperparam_search=run_hyperparam_search)
 
         # use predictions from SentenceLevelModel to create training set for SentenceToDocModel
@@ -30,20 +29,20 @@ class TwoLevelSentenceExperiment(ade.PartitionedExperiment):
                                       model=model, preprocessing_func=preprocessing_func, hyperparams=hyperparams)
         dl_mr.run(run_hyperparam_search=run_hyperparam_search)
 
-        return {'sentence_level': sl_mr,
-                'doc_level': dl_mr}
+        return {'sentence_level': sl_mr.to_summary(),
+                'doc_level': dl_mr.to_summary()}
 
     @classmethod
     def create_sent_to_doc_data_set(cls, model, x_feature_set, data_set: List):
-        cat_prediction = model.predict(x_feature_set)
         proba_prediction = model.predict_proba(x_feature_set)
+        cat_prediction = ade.predict_from_proba(model, x_feature_set, proba_prediction)
         new_data_set = pd.DataFrame({
-            'doc_id': [d['entity_id'] for d in data_set],
-            'sub_id': [d['sub_id'] for d in data_set],
+            'doc_id': np.fromiter((d['entity_id'] for d in data_set), dtype=np.int32, count=len(data_set)),
+            'sub_id': np.fromiter((d['sub_id'] for d in data_set), dtype=np.int32, count=len(data_set)),
             'sub_prediction': cat_prediction,
-            'proba_0': [i[0] for i in proba_prediction],
-            'proba_1': [i[1] for i in proba_prediction],
-            'proba_2': [i[2] for i in proba_prediction],
+            'proba_0': proba_prediction[:, 0].astype(np.float32),
+            'proba_1': proba_prediction[:, 1].astype(np.float32),
+            'proba_2': proba_prediction[:, 2].astype(np.float32),
             'label': [d['label'] for d in data_set],
         })
         return new_data_set
@@ -62,7 +61,7 @@ class SentenceLevelModelRun(ade.ModelRun):
         return
 
     @classmethod
-    def build_y_vector(cls, data_set: List[Dict], label_key: str) -> List:
+    def build_y_vector(cls, data_set: List[Dict], label_key: str) -> np.ndarray:
         """
         Extract the labels from each data dict and compile into one y vector.
         Args:
@@ -70,10 +69,10 @@ class SentenceLevelModelRun(ade.ModelRun):
             label_key: The key int he data dicts under which the label is stored.
 
         Returns:
-            Array-type
+            np.ndarray
         """
-        return [model.zero_one_category(model.get_score_for_question(entity_dict, label_key)) for entity_dict in
-                data_set]
+        return np.fromiter((model.zero_one_category(model.get_score_for_question(entity_dict, label_key))
+                            for entity_dict in data_set), dtype=np.int32, count=len(data_set))
 
     @classmethod
     def build_data(cls, train_set: List[Dict], test_set: List[Dict], label_key: str) -> \
@@ -106,15 +105,13 @@ class SentenceLevelModelRun(ade.ModelRun):
                                                                                                TfidfVectorizer]:
         """Given a list of sentences, combine the sentences back to their document representation and train a
         TF/IDF model. Return a dict of doc: TF'IDF vector. """
-        train_document_ids = list(set([d['entity_id'] for d in train_set]))
-        train_documents = []
-        for doc_id in train_document_ids:
-            train_documents.append(" ".join([d['content'] for d in train_set if d['entity_id'] == doc_id]))
+        train_sentences_by_doc = group_content_by_entity_id(train_set)
+        train_document_ids = list(train_sentences_by_doc.keys())
+        train_documents = [" ".join(sentences) for sentences in train_sentences_by_doc.values()]
 
-        test_document_ids = list(set([d['entity_id'] for d in test_set]))
-        test_documents = []
-        for doc_id in test_document_ids:
-            test_documents.append(" ".join([d['content'] for d in test_set if d['entity_id'] == doc_id]))
+        test_sentences_by_doc = group_content_by_entity_id(test_set)
+        test_document_ids = list(test_sentences_by_doc.keys())
+        test_documents = [" ".join(sentences) for sentences in test_sentences_by_doc.values()]
 
         # print("Some example documents:")
         # for i in train_documents[:2]:
@@ -187,35 +184,13 @@ class SentenceToDocModelRun(ade.ModelRun):
         return
 
 
-def sents_to_doc_buckets_mean(df):
-    series_of_list_of_bucket_avgs = df.groupby('doc_id')['pred_num'].apply(calc_avg_over_ten_parts)
-    df = series_of_list_to_df_columns(series_of_list_of_bucket_avgs)
-    return df
-
-
-def mean_0_when_empty(p):
-    if len(p) == 0:
-        return 0
-    else:
-        return sum(p)/len(p)
-
+def group_content_by_entity_id(data_set: List[Dict]) -> Dict[int, List[str]]:
+    """Collect the content of each entity_id's sentences in one pass, in order of first appearance."""
+    content_by_entity_id = {}
+    for d in data_set:
+        content_by_entity_id.setdefault(d['entity_id'], []).append(d['content'])
+    return content_by_entity_id
 
-def calc_avg_over_equal_parts(the_list, n_partitions):
-    n = int(np.ceil(len(the_list)/n_partitions))
-    partitions = [the_list[i*n:i*n+n] for i in range(n_partitions)]
-    return [mean_0_when_empty(p) for p in partitions]
 
-
-def calc_avg_over_ten_parts(the_list):
-    return calc_avg_over_equal_parts(the_list, 10)
-
-
-def series_of_list_to_df_columns(a_series_of_lists):
-    df = pd.DataFrame()
-    for ix in a_series_of_lists.index:
-        d = {}
-        #     d['doc_id'] = ix
-        for col_i, value in enumerate(a_series_of_lists[ix]):
-            d[col_i] = value
-        df = pd.concat([df, pd.DataFrame(d, index=[ix])])
-    return df
+def sents_to_doc_buckets_mean(df):
+    return ade.calc_bucket_means(df, 'pred_num')
@@ -45,25 +45,23 @@ class Sent2Doc_2ClassProb_Experiment(ade.PartitionedExperiment):
 
     @classmethod
     def create_sent_to_doc_data_set(cls, model, x_feature_set, data_set: List):
-        cat_prediction = model.predict(x_feature_set)
         proba_prediction = model.predict_proba(x_feature_set)
+        cat_prediction = ade.predict_from_proba(model, x_feature_set, proba_prediction)
         new_data_set = pd.DataFrame({
-            'doc_id': [d['entity_id'] for d in data_set],
-            'sub_id': [d['sub_id'] for d in data_set],
+            'doc_id': np.fromiter((d['entity_id'] for d in data_set), dtype=np.int32, count=len(data_set)),
+            'sub_id': np.fromiter((d['sub_id'] for d in data_set), dtype=np.int32, count=len(data_set)),
             'sub_prediction': cat_prediction,
-            'proba_0': [i[0] for i in proba_prediction],
-            'proba_1': [i[1] for i in proba_prediction],
+            'proba_0': proba_prediction[:, 0].astype(np.float32),
+            'proba_1': proba_prediction[:, 1].astype(np.float32),
             'label': [d['label'] for d in data_set],
         })
         return new_data_set
 
     def show_feature_importances(self, level):
-        all_feature_importances = pd.DataFrame()
-        for partition_id in self.model_runs:
-            partition_feature_importances = self.model_runs[partition_id][level].get_feature_importances()
-            partition_feature_importances.columns = ['partition{}'.format(partition_id)]
-            all_feature_importances = pd.merge(all_feature_importances, partition_feature_importances, how='outer',
-                                               left_index=True, right_index=True)
+        frames = [self.model_runs[partition_id][level].get_feature_importances().rename(
+                      columns={0: 'partition{}'.format(partition_id)})
+                  for partition_id in self.model_runs]
+        all_feature_importances = pd.concat(frames, axis=1, join='outer')
         all_feature_importances['median'] = all_feature_importances.median(axis=1)
         return all_feature_importances.sort_values('median', ascending=False)
 
@@ -74,11 +72,15 @@ class SentenceToDocProbaModelRun(ade.ModelRun):
     def build_features(cls, train_set: pd.DataFrame, test_set: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, List,
                                                                                       List, List, Dict]:
 
-        x_train = cls.sents_to_doc_buckets_mean(train_set)
-        x_test = cls.sents_to_doc_buckets_mean(test_set)
+        # group each set once for both the bucket features and the labels
+        grouped_train = train_set.groupby('doc_id', sort=True)
+        grouped_test = test_set.groupby('doc_id', sort=True)
 
-        y_train = train_set.groupby('doc_id')['label'].median()
-        y_test = test_set.groupby('doc_id')['label'].median()
+        x_train = ade.calc_bucket_means(train_set, 'sub_prediction', grouped=grouped_train)
+        x_test = ade.calc_bucket_means(test_set, 'sub_prediction', grouped=grouped_test)
+
+        y_train = grouped_train['label'].median()
+        y_test = grouped_test['label'].median()
 
         feature_cols = x_train.columns
         encoders = {}
@@ -87,34 +89,4 @@ class SentenceToDocProbaModelRun(ade.ModelRun):
 
     @classmethod
     def sents_to_doc_buckets_mean(cls, df):
-        series_of_list_of_bucket_avgs = df.groupby('doc_id')['sub_prediction'].apply(calc_avg_over_ten_parts)
-        df = series_of_list_to_df_columns(series_of_list_of_bucket_avgs)
-        return df
-
-
-def mean_0_when_empty(p):
-    if len(p) == 0:
-        return 0
-    else:
-        return sum(p)/len(p)
-
-
-def calc_avg_over_equal_parts(the_list, n_partitions):
-    n = int(np.ceil(len(the_list)/n_partitions))
-    partitions = [the_list[i*n:i*n+n] for i in range(n_partitions)]
-    return [mean_0_when_empty(p) for p in partitions]
-
-
-def calc_avg_over_ten_parts(the_list):
-    return calc_avg_over_equal_parts(the_list, 10)
-
-
-def series_of_list_to_df_columns(a_series_of_lists):
-    df = pd.DataFrame()
-    for ix in a_series_of_lists.index:
-        d = {}
-        #     d['doc_id'] = ix
-        for col_i, value in enumerate(a_series_of_lists[ix]):
-            d[col_i] = value
-        df = pd.concat([df, pd.DataFrame(d, index=[ix])])
-    return df
+        return ade.calc_bucket_means(df, 'sub_prediction')
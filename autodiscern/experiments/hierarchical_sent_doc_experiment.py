@@ -54,11 +54,8 @@ class SentenceLevelModelRun(ade.ModelRun):
         document_ids.sort()
 
         data_dict = SentenceLevelModelRun.data_dict
-        train_ids = list(set([int(entity_dict['entity_id']) for entity_dict in train_set]))
-        test_ids = list(set([int(entity_dict['entity_id']) for entity_dict in test_set]))
-
-        train_ids.sort()
-        test_ids.sort()
+        train_ids = sorted({int(entity_dict['entity_id']) for entity_dict in train_set})
+        test_ids = sorted({int(entity_dict['entity_id']) for entity_dict in test_set})
 
         print('build_features method..')
         print(train_ids)
@@ -130,34 +127,4 @@ class SentenceToDocModelRun(ade.ModelRun):
 
 
 def sents_to_doc_buckets_mean(df):
-    series_of_list_of_bucket_avgs = df.groupby('doc_id')['pred_num'].apply(calc_avg_over_ten_parts)
-    df = series_of_list_to_df_columns(series_of_list_of_bucket_avgs)
-    return df
-
-
-def mean_0_when_empty(p):
-    if len(p) == 0:
-        return 0
-    else:
-        return sum(p)/len(p)
-
-
-def calc_avg_over_equal_parts(the_list, n_partitions):
-    n = int(np.ceil(len(the_list)/n_partitions))
-    partitions = [the_list[i*n:i*n+n] for i in range(n_partitions)]
-    return [mean_0_when_empty(p) for p in partitions]
-
-
-def calc_avg_over_ten_parts(the_list):
-    return calc_avg_over_equal_parts(the_list, 10)
-
-
-def series_of_list_to_df_columns(a_series_of_lists):
-    df = pd.DataFrame()
-    for ix in a_series_of_lists.index:
-        d = {}
-        #     d['doc_id'] = ix
-        for col_i, value in enumerate(a_series_of_lists[ix]):
-            d[col_i] = value
-        df = pd.concat([df, pd.DataFrame(d, index=[ix])])
-    return df
+    return ade.calc_bucket_means(df, 'pred_num')
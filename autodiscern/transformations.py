@@ -1,15 +1,103 @@
-import html
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from html.parser import HTMLParser
 import re
 import tldextract
+from functools import lru_cache
 from bs4 import BeautifulSoup, Comment, CData, ProcessingInstruction, Declaration, Doctype
-from bs4.element import Tag
+from bs4.element import NavigableString, Tag
 from nltk.tokenize.punkt import PunktSentenceTokenizer
-from typing import Callable, Dict, List, Tuple, Set
+from typing import Callable, Dict, List, Pattern, Tuple, Set
 
 
 TransformType = Callable[[str], str]
 
+# the C-based lxml parser is much faster than the pure-Python "html.parser"
+HTML_PARSER = "lxml"
+
+# regexes used by the string-based helper functions, compiled once
+_RE_MULTISPACE = re.compile(r' {2,}')
+# a '.', '?' or '!' followed by a run of 2+ of '.', ' ' or '\n', or a run of 2+ spaces
+_RE_PUNCTUATION_AND_WHITE_SPACE = re.compile(r"([.?!])([. \n]{2,})| {2,}")
+_RE_BR = re.compile(r'<br[/]*>')
+_RE_WS_NL = re.compile(r"[ \n]{2,}")
+
+# str.translate tables for the single character replacements
+_WS_TABLE = str.maketrans({'\t': ' ', '\xa0': ' '})
+_NL_TABLE = str.maketrans({'\n': ' '})
+
+# strings in the soup that are not rendered text, removed by remove_other_xml
+_NON_RENDERED = (Comment, CData, ProcessingInstruction, Declaration, Doctype)
+
+# characters that html parsing changes in text without any tags: markup, entities, and characters the parsers
+#  normalize or drop
+_RE_NEEDS_HTML_PARSER = re.compile('[<&\r\x00\ufeff]')
+
+# plaintext stand-ins for html tags, inserted by the html cleaning transforms and removed by the annotations
+_RE_HEADER_PLAINTEXT_TAGS = re.compile(r'thisisah[1-4]tag')
+_RE_ROW_PLAINTEXT_TAGS = re.compile(r'thisisalistitemtag|thisisatablerowtag')
+_RE_PLAINTEXT_TAGS = re.compile(r'thisisah[1-4]tag|thisisalinktag|thisisalistitemtag|thisisatablerowtag')
+_RE_LINK_PLAINTEXT_TAG = re.compile(r'thisisalinktag([^ ]*)')
+
+
+@lru_cache(maxsize=100000)
+def _extract_domain(url: str) -> str:
+    """Return the registered domain of a url. Pages link to the same hosts over and over, so results are cached. """
+    return tldextract.extract(url).domain
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Stream an html string into a list of text pieces, emitting replacement strings for each tag's start and end.
+
+    Style and script contents, comments, doctypes and processing instructions are dropped. Entities are decoded by
+    the parser. Tags are closed by their end tag, by the end tag of an enclosing tag, or at the end of the input.
+    """
+
+    VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+                     'track', 'wbr'}
+
+    def __init__(self, get_tag_replacement: Callable[[str, Dict, bool], Tuple[str, str]]):
+        super().__init__(convert_charrefs=True)
+        self.get_tag_replacement = get_tag_replacement
+        self.skip_depth = 0
+        self.out = []
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('style', 'script'):
+            self.skip_depth += 1
+            return
+        is_empty_element = tag in self.VOID_ELEMENTS
+        start_tag_replacement, end_tag_replacement = self.get_tag_replacement(tag, dict(attrs), is_empty_element)
+        self.out.append(start_tag_replacement)
+        if is_empty_element:
+            self.out.append(end_tag_replacement)
+        else:
+            self.open_tags.append((tag, end_tag_replacement))
+
+    def handle_endtag(self, tag):
+        if tag in ('style', 'script'):
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if not any(name == tag for name, _ in self.open_tags):
+            # stray end tag
+            return
+        while True:
+            name, end_tag_replacement = self.open_tags.pop()
+            self.out.append(end_tag_replacement)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skip_depth == 0:
+            self.out.append(data)
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.out.append(self.open_tags.pop()[1])
+
 
 class Transformer:
     """Run a set of transforms and annotations on any input.
@@ -25,7 +113,8 @@ class Transformer:
 
     def __init__(self, leave_some_html: bool = False, html_to_plain_text: bool = False, segment_into: str = None,
                  remove_newlines: bool = True, flatten: bool = False, annotate_html: bool = False,
-                 parallelism: bool = False, num_cores=8):
+                 parallelism: bool = False, num_cores=8, html_backend: str = 'bs4',
+                 sentence_backend: str = 'punkt', threading_backend: bool = False, min_parallel_inputs: int = 16):
         """
         Sets the parameters of the Transformer object.
 
@@ -40,6 +129,16 @@ class Transformer:
 
             parallelism: bool. Whether to run the transforms in parallel. Not compatible with sentence segmentation.
             num_cores: int. Number of cores to use when using multiprocessing.
+            threading_backend: bool. Run the parallel transforms in a thread pool instead of worker processes. Avoids
+                forking and pickling the documents, but only scales as far as the parsers and regexes release the GIL.
+            min_parallel_inputs: int. Inputs with fewer documents than this are run in series even when parallelism is
+                set, as starting the pool and shipping the documents to it costs more than it saves.
+            html_backend: str. How to parse the html: 'bs4' builds a BeautifulSoup tree with lxml, 'selectolax' parses
+                with the much faster selectolax (lexbor), and 'stream' converts in a single pass of the standard
+                library's html.parser without building a tree. The parsers repair broken html differently, so the
+                faster backends may differ slightly from the default 'bs4' output.
+            sentence_backend: str. Sentence segmenter to use: NLTK's 'punkt', or the faster 'pysbd' or 'blingfire'.
+                The segmenters split some sentences differently, e.g. around abbreviations.
 
         Returns: None
 
@@ -48,7 +147,13 @@ class Transformer:
         self.annotations = []
         self.parallelism = parallelism
         self.num_cores = num_cores
+        self.threading_backend = threading_backend
+        self.min_parallel_inputs = min_parallel_inputs
         self.flatten = flatten
+        if html_backend not in {'bs4', 'selectolax', 'stream'}:
+            raise ValueError("Invalid html_backend: {}".format(html_backend))
+        self.html_backend = html_backend
+        self._pool = None
 
         if leave_some_html and segment_into is not None and html_to_plain_text is False:
             print("WARNING: segmentation does not work well with html remaining in the sentence. Consider setting "
@@ -78,9 +183,19 @@ class Transformer:
         elif segment_into in {'s', 'sent', 'sents', 'sentence', 'sentences'}:
             self.transforms.append(self._to_sentences)
             self.segmentation_type = 'sentences'
+            self.sentence_backend = sentence_backend
             # nlp = spacy.load('en', disable=['ner'])
             # self.segmenter_helper_obj = nlp
-            self.segmenter_helper_obj = PunktSentenceTokenizer()
+            if sentence_backend == 'punkt':
+                self.segmenter_helper_obj = PunktSentenceTokenizer()
+            elif sentence_backend == 'pysbd':
+                import pysbd
+                self.segmenter_helper_obj = pysbd.Segmenter(language='en', clean=False)
+            elif sentence_backend == 'blingfire':
+                import blingfire
+                self.segmenter_helper_obj = blingfire
+            else:
+                raise ValueError("Invalid sentence_backend: {}".format(sentence_backend))
         elif segment_into in {'p', 'para', 'paragraph', 'paragraphs'}:
             self.transforms.append(self._to_paragraphs)
             self.segmentation_type = 'paragraphs'
@@ -120,13 +235,45 @@ class Transformer:
         """Create a new transformed object. """
         return self._apply_annotations_to_dict(obj)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        # the workers receive bound methods of this object, and a Pool cannot be pickled
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def _get_pool(self):
+        """Return the worker pool, creating it on first use so it is shared by transforms and annotations. """
+        if self._pool is None:
+            if self.threading_backend:
+                self._pool = ThreadPool(self.num_cores)
+            else:
+                self._pool = mp.Pool(self.num_cores)
+        return self._pool
+
+    def close(self) -> None:
+        """Shut down the worker pool, if one was started. """
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            self._pool = None
+
     def apply_in_parallel(self, input_list: List[Dict], worker: Callable) -> List:
         """Run all transforms on input_list in parallel. """
-        pool = mp.Pool(self.num_cores)
-        results = pool.map(worker, (i for i in input_list))
-        pool.close()
-        pool.join()
-        return results
+        if len(input_list) < self.min_parallel_inputs:
+            return self.apply_in_series(input_list, worker)
+        # hand each worker several items per round trip to amortize the pickling/IPC overhead
+        chunksize = max(1, len(input_list) // (self.num_cores * 4))
+        return self._get_pool().map(worker, input_list, chunksize=chunksize)
 
     def apply_in_series(self, input_list: List[Dict], worker: Callable) -> List:
         """Run all transforms on input_list in series. """
@@ -173,11 +320,6 @@ class Transformer:
     # === High Level Transformer functions =======================
 
     def _to_limited_html(self, x: str) -> str:
-        soup = BeautifulSoup(x, features="html.parser")
-        soup = self.remove_tags_and_contents(soup, ['style', 'script'])
-        soup = self.remove_other_xml(soup)
-        soup = self.reformat_html_link_tags(soup)
-
         tags_to_keep = {'h1', 'h2', 'h3', 'h4'}
         tags_to_keep_with_attr = {'a'}
         tags_to_replace = {
@@ -185,10 +327,10 @@ class Transformer:
             'p': ('\n', '\n'),
         }
         default_tag_replacement_str = ''
-        text = self.replace_html(soup, tags_to_keep, tags_to_keep_with_attr, tags_to_replace,
-                                 default_tag_replacement_str)
+        text = self.html_to_text_with_tags(x, tags_to_keep, tags_to_keep_with_attr, tags_to_replace,
+                                           default_tag_replacement_str, reformat_link_tags=True)
 
-        text = self.replace_chars(text, ['\t', '\xa0'], ' ')
+        text = text.translate(_WS_TABLE)
         text = self.regex_out_punctuation_and_white_space(text)
         text = self.condense_line_breaks(text)
 
@@ -196,9 +338,6 @@ class Transformer:
 
     def _to_limited_html_plain_text(self, x: str) -> str:
         clean_x = self.clear_non_rendered_html(x)
-        soup = BeautifulSoup(clean_x, features="html.parser")
-        soup = self.remove_tags_and_contents(soup, ['style', 'script'])
-        soup = self.remove_other_xml(soup)
 
         tags_to_keep = set()
         tags_to_keep_with_attr = set()
@@ -215,10 +354,10 @@ class Transformer:
             'div': ('. \n', '. \n'),
         }
         default_tag_replacement_str = ''
-        text = self.replace_html(soup, tags_to_keep, tags_to_keep_with_attr, tags_to_replace,
-                                 default_tag_replacement_str, include_link_domains=True)
+        text = self.html_to_text_with_tags(clean_x, tags_to_keep, tags_to_keep_with_attr, tags_to_replace,
+                                           default_tag_replacement_str, include_link_domains=True)
 
-        text = self.replace_chars(text, ['\t', '\xa0'], ' ')
+        text = text.translate(_WS_TABLE)
         text = self.regex_out_punctuation_and_white_space(text)
         text = self.condense_line_breaks(text)
 
@@ -226,9 +365,6 @@ class Transformer:
 
     def _to_text(self, x: str) -> str:
         clean_x = self.clear_non_rendered_html(x)
-        soup = BeautifulSoup(clean_x, features="html.parser")
-        soup = self.remove_tags_and_contents(soup, ['style', 'script'])
-        soup = self.remove_other_xml(soup)
 
         tags_to_keep = set()
         tags_to_keep_with_attr = set()
@@ -242,10 +378,10 @@ class Transformer:
             'div': ('\n', '. \n'),
         }
         default_tag_replacement_str = ''
-        text = self.replace_html(soup, tags_to_keep, tags_to_keep_with_attr, tags_to_replace,
-                                 default_tag_replacement_str)
+        text = self.html_to_text_with_tags(clean_x, tags_to_keep, tags_to_keep_with_attr, tags_to_replace,
+                                           default_tag_replacement_str)
 
-        text = self.replace_chars(text, ['\t', '\xa0'], ' ')
+        text = text.translate(_WS_TABLE)
         text = self.regex_out_punctuation_and_white_space(text)
         text = self.condense_line_breaks(text)
 
@@ -262,8 +398,16 @@ class Transformer:
         # nlp = self.segmenter_helper_obj
         # doc = nlp(x)
         # result = [sent.string.strip() for sent in doc.sents]
-        tokenizer = self.segmenter_helper_obj
-        result = [sent.strip() for sent in tokenizer.tokenize(x)]
+        if self.sentence_backend == 'pysbd':
+            sentences = self.segmenter_helper_obj.segment(x)
+        elif self.sentence_backend == 'blingfire':
+            sentences = self.segmenter_helper_obj.text_to_sentences(x).split('\n')
+        else:
+            sentences = self.segmenter_helper_obj.tokenize(x)
+        result = [sent.strip() for sent in sentences]
+        if self.sentence_backend != 'punkt':
+            # pysbd keeps whitespace-only segments, and blingfire returns '' for empty text
+            result = [sent for sent in result if sent != '']
         return result
 
     def _to_paragraphs(self, x: str) -> List[str]:
@@ -274,8 +418,10 @@ class Transformer:
     def _flatten_text_dicts(list_of_dicts: List[Dict]) -> List[Dict]:
         output = []
         for parent_dict in list_of_dicts:
+            # filter out the parent's content once, and copy the rest for each child
+            base_dict = {key: parent_dict[key] for key in parent_dict if key != 'content'}
             for num, i in enumerate(parent_dict['content']):
-                child_dict = {key: parent_dict[key] for key in parent_dict if key != 'content'}
+                child_dict = base_dict.copy()
                 child_dict['content'] = i
                 child_dict['sub_id'] = num
                 output.append(child_dict)
@@ -285,20 +431,15 @@ class Transformer:
     @staticmethod
     def remove_tags_and_contents(soup: BeautifulSoup, tags: List[str]) -> BeautifulSoup:
         """Remove specific tags from the html, including their entire contents."""
-        for tag in soup.find_all(True):
-            if tag.name in tags:
-                # delete tag and its contents
-                tag.decompose()
+        # let bs4 match the tag names rather than visiting every tag in python
+        for tag in soup.find_all(list(tags)):
+            # delete tag and its contents
+            tag.decompose()
         return soup
 
     @staticmethod
     def remove_other_xml(soup: BeautifulSoup) -> BeautifulSoup:
-        for tag in soup.find_all(string=lambda text: isinstance(text, Comment)
-                                 or isinstance(text, CData)
-                                 or isinstance(text, ProcessingInstruction)
-                                 or isinstance(text, Declaration)
-                                 or isinstance(text, Doctype)
-                                 ):
+        for tag in soup.find_all(string=lambda text: isinstance(text, _NON_RENDERED)):
             tag.extract()
         return soup
 
@@ -316,38 +457,73 @@ class Transformer:
         Returns: BeautifulSoup
 
         """
-        for tag in soup.find_all(True):
-            if tag.name == 'a':
-                attrs = dict(tag.attrs)
-                for attr in attrs:
-                    if attr in ['src', 'href']:
-                        url = tag.attrs[attr]
-                        domain = tldextract.extract(url).domain
-                        tag.attrs[attr] = domain
-                    else:
-                        del tag.attrs[attr]
+        for tag in soup.find_all('a'):
+            tag.attrs = {attr: _extract_domain(url) for attr, url in tag.attrs.items() if attr in ['src', 'href']}
         return soup
 
     @staticmethod
     def get_domain_from_link_tag(tag: Tag) -> str:
         """Extract the domain from a url. If no domain is found, assume link is a filepath, and return NA"""
-        attrs = dict(tag.attrs)
+        return Transformer.get_domain_from_link_attributes(tag.attrs)
+
+    @staticmethod
+    def get_domain_from_link_attributes(attrs: Dict[str, str]) -> str:
+        """Extract the domain from the src or href of a link's attributes. Return NA if no domain is found. """
         for attr in attrs:
             if attr in ['src', 'href']:
-                url = tag.attrs[attr]
-                domain = tldextract.extract(url).domain
+                domain = _extract_domain(attrs[attr] or '')
                 if domain != '':
                     return domain
                 else:
                     return 'NA'
         return 'NA'
 
+    def html_to_text_with_tags(self, x: str, tags_to_keep: Set[str], tags_to_keep_with_attr: Set[str],
+                               tags_to_replace_with_str: Dict[str, Tuple[str, str]], default_tag_replacement_str: str,
+                               include_link_domains=False, reformat_link_tags=False) -> str:
+        """
+        Parse an html string with the Transformer's html_backend, drop all non-rendered content, and replace/keep the
+        tags in accordance with args.
+
+        Args:
+            x: html string
+            tags_to_keep: html tags to leave but remove tag attributes
+            tags_to_keep_with_attr: html tags to leave intact
+            tags_to_replace_with_str: html tags to replace with strings defined in replacement Tuple(start_tag, end_tag)
+            default_tag_replacement_str: string to use if no replacement is defined in tags_to_replace_with_str
+            include_link_domains: bool. Append the domain of the linked url to the replacement tag
+            reformat_link_tags: bool. Reduce the attributes of kept link tags to the domain of their src or href
+
+        Returns: str
+
+        """
+        if not _RE_NEEDS_HTML_PARSER.search(x):
+            # plain text comes out of the parsers unchanged, apart from the leading white space they skip
+            return x.lstrip('\t\n\x0c ')
+
+        if self.html_backend == 'selectolax':
+            return self.replace_html_fast(x, tags_to_keep, tags_to_keep_with_attr, tags_to_replace_with_str,
+                                          default_tag_replacement_str, include_link_domains, reformat_link_tags)
+        if self.html_backend == 'stream':
+            return self.replace_html_stream(x, tags_to_keep, tags_to_keep_with_attr, tags_to_replace_with_str,
+                                            default_tag_replacement_str, include_link_domains, reformat_link_tags)
+
+        soup = BeautifulSoup(x, features=HTML_PARSER)
+        soup = self.remove_tags_and_contents(soup, ['style', 'script'])
+        soup = self.remove_other_xml(soup)
+        if reformat_link_tags:
+            soup = self.reformat_html_link_tags(soup)
+        return self.replace_html(soup, tags_to_keep, tags_to_keep_with_attr, tags_to_replace_with_str,
+                                 default_tag_replacement_str, include_link_domains)
+
     def replace_html(self, soup: BeautifulSoup, tags_to_keep: Set[str], tags_to_keep_with_attr: Set[str],
                      tags_to_replace_with_str: Dict[str, Tuple[str, str]], default_tag_replacement_str: str,
                      include_link_domains=False) -> str:
         """
         Finds all tags in an html BeautifulSoup object and replaces/keeps the tags in accordance with args.
 
+        The soup is not modified: the text is built in one in-order walk of the tree and joined at the end.
+
         Args:
             soup: BeautifulSoup object parsing an html
             tags_to_keep: html tags to leave but remove tag attributes
@@ -359,43 +535,151 @@ class Transformer:
         Returns: str
 
         """
+        default_replacement_tuple = (default_tag_replacement_str, default_tag_replacement_str)
+
+        pieces = []
+        # each level of the stack holds the iterator over a tag's children and the string to emit once it is done
+        stack = [(iter(soup.contents), '')]
+        while stack:
+            for node in stack[-1][0]:
+                if isinstance(node, Tag):
+                    start_tag_replacement, end_tag_replacement = self._get_tag_replacement(
+                        node.name, node.attrs, tags_to_keep, tags_to_keep_with_attr, tags_to_replace_with_str,
+                        default_replacement_tuple, include_link_domains, node.is_empty_element)
+                    pieces.append(start_tag_replacement)
+                    stack.append((iter(node.contents), end_tag_replacement))
+                    break
+                elif type(node) is NavigableString:
+                    pieces.append(str(node))
+                else:
+                    # comments, doctypes etc. that were not removed beforehand are kept as they are serialized
+                    pieces.append(node.output_ready(formatter=None))
+            else:
+                pieces.append(stack.pop()[1])
+
+        return ''.join(pieces)
+
+    def replace_html_fast(self, x: str, tags_to_keep: Set[str], tags_to_keep_with_attr: Set[str],
+                          tags_to_replace_with_str: Dict[str, Tuple[str, str]], default_tag_replacement_str: str,
+                          include_link_domains=False, reformat_link_tags=False) -> str:
+        """
+        Parse an html string with selectolax and replace/keep the tags in accordance with args, like replace_html.
+
+        Style and script tags and their contents, comments and doctypes are dropped along the way.
+
+        Args:
+            x: html string
+            tags_to_keep: html tags to leave but remove tag attributes
+            tags_to_keep_with_attr: html tags to leave intact
+            tags_to_replace_with_str: html tags to replace with strings defined in replacement Tuple(start_tag, end_tag)
+            default_tag_replacement_str: string to use if no replacement is defined in tags_to_replace_with_str
+            include_link_domains: bool. Append the domain of the linked url to the replacement tag
+            reformat_link_tags: bool. Reduce the attributes of kept link tags to the domain of their src or href,
+                like reformat_html_link_tags
+
+        Returns: str
+
+        """
+        from selectolax.lexbor import LexborHTMLParser
 
-        all_tags = set([tag.name for tag in soup.find_all()])
-        tags_to_replace = all_tags - tags_to_keep - tags_to_keep_with_attr
-        tags_to_replace = tags_to_replace | set(tags_to_replace_with_str.keys())
+        default_replacement_tuple = (default_tag_replacement_str, default_tag_replacement_str)
+        pieces = []
+
+        def visit(node):
+            tag = node.tag
+            if tag == '-text':
+                pieces.append(node.text(deep=False))
+                return
+            if tag is None or tag.startswith('-') or tag in ('style', 'script'):
+                # not rendered: comments, processing instructions, style and script tags
+                return
+
+            start_tag_replacement, end_tag_replacement = self._get_tag_replacement(
+                tag, node.attributes, tags_to_keep, tags_to_keep_with_attr, tags_to_replace_with_str,
+                default_replacement_tuple, include_link_domains, reformat_link_tags=reformat_link_tags)
+
+            pieces.append(start_tag_replacement)
+            for child in node.iter(include_text=True):
+                visit(child)
+            pieces.append(end_tag_replacement)
+
+        tree = LexborHTMLParser(x)
+        if tree.root is not None:
+            visit(tree.root)
+        return ''.join(pieces)
+
+    def replace_html_stream(self, x: str, tags_to_keep: Set[str], tags_to_keep_with_attr: Set[str],
+                            tags_to_replace_with_str: Dict[str, Tuple[str, str]], default_tag_replacement_str: str,
+                            include_link_domains=False, reformat_link_tags=False) -> str:
+        """
+        Convert an html string in one pass of the standard library's html.parser, replacing/keeping the tags in
+        accordance with args like replace_html, without building a tree.
 
+        Args:
+            x: html string
+            tags_to_keep: html tags to leave but remove tag attributes
+            tags_to_keep_with_attr: html tags to leave intact
+            tags_to_replace_with_str: html tags to replace with strings defined in replacement Tuple(start_tag, end_tag)
+            default_tag_replacement_str: string to use if no replacement is defined in tags_to_replace_with_str
+            include_link_domains: bool. Append the domain of the linked url to the replacement tag
+            reformat_link_tags: bool. Reduce the attributes of kept link tags to the domain of their src or href,
+                like reformat_html_link_tags
+
+        Returns: str
+
+        """
         default_replacement_tuple = (default_tag_replacement_str, default_tag_replacement_str)
 
-        for tag in soup.find_all(True):
-            if tag.name in tags_to_keep_with_attr:
-                # keep tag, including attributes
-                pass
-            elif tag.name in tags_to_keep:
-                # keep tag but clear all attributes
-                tag.attrs = {}
-            elif tag.name in tags_to_replace:
-                # if tag replacement is not specified, use the default
-                r = tags_to_replace_with_str.get(tag.name, default_replacement_tuple)
-                start_tag_replacement = r[0]
-                end_tag_replacement = r[1]
-
-                if tag.name == 'a' and include_link_domains:
-                    domain = self.get_domain_from_link_tag(tag)
-                    start_tag_replacement = start_tag_replacement.rstrip() + domain + ' '
-                tag.insert_before(start_tag_replacement)
-                tag.insert_after(end_tag_replacement)
-                # remove the tag without removing the tag's contents (text and children tags)
-                tag.unwrap()
-
-        text = self.soup_to_text_with_tags(soup)
-        return text
+        def get_tag_replacement(name: str, attrs: Dict, is_empty_element: bool) -> Tuple[str, str]:
+            return self._get_tag_replacement(name, attrs, tags_to_keep, tags_to_keep_with_attr,
+                                             tags_to_replace_with_str, default_replacement_tuple, include_link_domains,
+                                             is_empty_element, reformat_link_tags)
+
+        parser = _TextExtractor(get_tag_replacement)
+        parser.feed(x)
+        parser.close()
+        return ''.join(parser.out)
+
+    @classmethod
+    def _get_tag_replacement(cls, name: str, attrs: Dict, tags_to_keep: Set[str], tags_to_keep_with_attr: Set[str],
+                             tags_to_replace_with_str: Dict[str, Tuple[str, str]],
+                             default_replacement_tuple: Tuple[str, str], include_link_domains: bool,
+                             is_empty_element: bool = False, reformat_link_tags: bool = False) -> Tuple[str, str]:
+        """Return the strings to put in place of a tag's start and end, following the rules of replace_html. """
+        if name in tags_to_keep_with_attr:
+            # keep tag, including attributes
+            if reformat_link_tags and name == 'a':
+                attrs = {attr: _extract_domain(attrs[attr] or '') for attr in attrs if attr in ['src', 'href']}
+            attrs_str = ''.join(cls._attribute_to_str(attr, attrs[attr]) for attr in sorted(attrs))
+        elif name in tags_to_keep:
+            # keep tag but clear all attributes
+            attrs_str = ''
+        else:
+            # if tag replacement is not specified, use the default
+            start_tag_replacement, end_tag_replacement = tags_to_replace_with_str.get(name, default_replacement_tuple)
+            if name == 'a' and include_link_domains:
+                domain = cls.get_domain_from_link_attributes(attrs)
+                start_tag_replacement = start_tag_replacement.rstrip() + domain + ' '
+            return start_tag_replacement, end_tag_replacement
+
+        if is_empty_element:
+            return '<{}{}/>'.format(name, attrs_str), ''
+        return '<{}{}>'.format(name, attrs_str), '</{}>'.format(name)
+
+    @staticmethod
+    def _attribute_to_str(attr: str, value) -> str:
+        """Format an html attribute the way BeautifulSoup serializes it. BeautifulSoup also sorts the attributes. """
+        if value is None:
+            return ' {}'.format(attr)
+        if isinstance(value, list):
+            value = ' '.join(value)
+        return ' {}="{}"'.format(attr, value)
 
     @staticmethod
     def soup_to_text_with_tags(soup: BeautifulSoup) -> str:
         """Convert a BeautifulSoup object to a string while leaving the html tags in place."""
-        text = str(soup)
-        text = html.unescape(text)
-        return text
+        # the parser already decoded the entities; serialize without re-escaping them rather than unescaping afterwards
+        return soup.decode(formatter=None)
 
     # === String-Based Helper functions ==========================
 
@@ -408,16 +692,10 @@ class Transformer:
         """Clean up excess whitespace and punctuation."""
         text = text.replace('?.', '?')
 
-        # replaces multiple spaces wth a single space
-        text = re.sub(r' +', ' ',  text)
-        # replace occurences of '.' followed by any combination of '.', ' ', or '\n' with single '.'
-        #  for handling html -> '.' replacement.
-        text = re.sub(r"[.][. ]{2,}", '. ', text)
-        text = re.sub(r"[?][. ]{2,}", '? ', text)
-        text = re.sub(r"[!][. ]{2,}", '! ', text)
-        text = re.sub(r"[.][. \n]{2,}", '. \n', text)
-        text = re.sub(r"[?][. \n]{2,}", '? \n', text)
-        text = re.sub(r"[!][. \n]{2,}", '! \n', text)
+        # in a single scan, replace multiple spaces wth a single space, and replace occurences of '.', '?' or '!'
+        #  followed by any combination of '.', ' ', or '\n' with a single '.', '?' or '!' followed by ' ', or by ' \n'
+        #  if the run contained a line break. For handling html -> '.' replacement.
+        text = _RE_PUNCTUATION_AND_WHITE_SPACE.sub(Transformer._replace_punctuation_and_white_space, text)
 
         # if there is a period at the very start of the document, remove it (replace 1 time)
         text = text.lstrip()
@@ -426,28 +704,40 @@ class Transformer:
 
         return text
 
+    @staticmethod
+    def _replace_punctuation_and_white_space(match) -> str:
+        punctuation = match.group(1)
+        if punctuation is None:
+            return ' '
+        if '\n' in match.group(2):
+            return punctuation + ' \n'
+        return punctuation + ' '
+
     @staticmethod
     def condense_line_breaks(text: str) -> str:
         # replaces multiple spaces wth a single space
-        text = re.sub(r' +', ' ',  text).strip()
+        text = _RE_MULTISPACE.sub(' ', text).strip()
 
         # replace html line breaks with new line characters
-        text = re.sub(r'<br[/]*>', '\n', text)
+        text = _RE_BR.sub('\n', text)
 
         # replace any combination of ' ' and '\n' with single ' \n'
-        text = re.sub(r"[ \n]{2,}", ' \n', text)
+        text = _RE_WS_NL.sub(' \n', text)
         return text
 
     @staticmethod
     def replace_chars(x: str, chars_to_replace: List[str], replacement_char: str) -> str:
         """Replace all chars_to_replace with replacement_char. """
+        if all(len(p) == 1 for p in chars_to_replace):
+            # single characters can all be replaced in one pass
+            return x.translate(str.maketrans({p: replacement_char for p in chars_to_replace}))
         for p in chars_to_replace:
             x = x.replace(p, replacement_char)
         return x
 
     @classmethod
     def remove_newlines(cls, x: str) -> str:
-        return cls.replace_chars(x, ['\n'], ' ')
+        return x.translate(_NL_TABLE)
 
     # === Annotation Functions ==================================
 
@@ -460,6 +750,14 @@ class Transformer:
         cleaned_token = token.replace(tag_and_domain, '')
         return cleaned_token, domain
 
+    @staticmethod
+    def _remove_plaintext_tags(pattern: Pattern, text: str) -> str:
+        """Replace all plaintext tags matching pattern with a space, and strip the text if any were found. """
+        text, n_found = pattern.subn(' ', text)
+        if n_found > 0:
+            text = text.strip()
+        return text
+
     @classmethod
     def _annotate_and_clean_html(cls, d: Dict, extract_domains=True) -> Dict:
         tags = {
@@ -471,28 +769,23 @@ class Transformer:
             'thisisalistitemtag': 'li',
             'thisisatablerowtag': 'tr',
         }
-        found_tags = []
+        content = d['content']
         domains = []
-        for plaintexttag in tags:
-            if plaintexttag in d['content']:
-                if plaintexttag == 'thisisalinktag' and extract_domains:
-                    # TODO: this space splitting is not robust
-                    tokens = d['content'].split(' ')
-                    text_without_tags = ''
-                    for i, token in enumerate(tokens):
-                        if plaintexttag in token:
-                            cleaned_token, domain = cls._retrieve_domain_from_plaintexttag(token)
-                            domains.append(domain)
-                            if cleaned_token != '':
-                                text_without_tags += cleaned_token + ' '
-                        else:
-                            if token != '':
-                                text_without_tags += token + ' '
-                    d['content'] = text_without_tags.rstrip()
-                    found_tags.append(tags[plaintexttag])
-                else:
-                    d['content'] = d['content'].replace(plaintexttag, ' ').strip()
-                    found_tags.append(tags[plaintexttag])
+        if extract_domains and 'thisisalinktag' in content:
+            # header tags are removed before the link tags, list and table row tags after
+            found_tags = [tags[plaintexttag] for plaintexttag in list(tags)[:5] if plaintexttag in content]
+            content = cls._remove_plaintext_tags(_RE_HEADER_PLAINTEXT_TAGS, content)
+            # the domain is everything after the link tag up to the next space
+            domains = [domain.replace('thisisalinktag', '') for domain in _RE_LINK_PLAINTEXT_TAG.findall(content)]
+            content = _RE_LINK_PLAINTEXT_TAG.sub('', content)
+            # TODO: this space splitting is not robust
+            content = ' '.join(token for token in content.split(' ') if token != '').rstrip()
+            found_tags += [tags[plaintexttag] for plaintexttag in list(tags)[5:] if plaintexttag in content]
+            content = cls._remove_plaintext_tags(_RE_ROW_PLAINTEXT_TAGS, content)
+        else:
+            found_tags = [tags[plaintexttag] for plaintexttag in tags if plaintexttag in content]
+            content = cls._remove_plaintext_tags(_RE_PLAINTEXT_TAGS, content)
+        d['content'] = content
         d['html_tags'] = found_tags
         d['domains'] = domains
         return d
@@ -502,7 +795,7 @@ class Transformer:
         if 'url' not in d.keys():
             print("WARNING: text url is not available for linked domain comparison")
             return d
-        source_domain = tldextract.extract(d['url']).domain
+        source_domain = _extract_domain(d['url'])
         d['link_type'] = []
         for link in d['domains']:
             if link == 'NA':
@@ -519,10 +812,14 @@ class Transformer:
 # === Other non-class functions ==============================
 # ============================================================
 
+def get_id_key(d: Dict) -> str:
+    if 'id' not in d and 'entity_id' in d:
+        return 'entity_id'
+    return 'id'
+
+
 def get_id(d: Dict) -> str:
-    id_key = 'id'
-    if id_key not in d.keys() and 'entity_id' in d.keys():
-        id_key = 'entity_id'
+    id_key = get_id_key(d)
     identifier = d[id_key]
     if 'sub_id' in d:
         identifier = "{}-{}".format(d[id_key], d['sub_id'])
@@ -530,8 +827,16 @@ def get_id(d: Dict) -> str:
 
 
 def convert_list_of_dicts_to_dict_of_dicts(input_list: List[Dict]) -> Dict[str, Dict]:
+    if len(input_list) == 0:
+        return {}
+
+    # the dicts all come from the same corpus, so look up which key holds the id only once
+    id_key = get_id_key(input_list[0])
+    id_format = "{}-{}".format
     output_dict = {}
     for d in input_list:
-        id = get_id(d)
-        output_dict[id] = d
+        if 'sub_id' in d:
+            output_dict[id_format(d[id_key], d['sub_id'])] = d
+        else:
+            output_dict[d[id_key]] = d
     return output_dict
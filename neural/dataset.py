@@ -27,6 +27,15 @@ class DocDataTensor(Dataset):
     def __len__(self):
         return(self.num_samples)
 
+    def share_memory_(self):
+        """move the doc tensors to shared memory (in-place)
+
+           Spawned processes receiving this instance then attach to the same memory instead of each getting a copy.
+        """
+        for tensor in (self.docs_batch, self.docs_len, self.docs_sents_len, self.docs_attn_mask, self.docs_labels):
+            tensor.share_memory_()
+        return self
+
 
 class PartitionDataTensor(Dataset):
 
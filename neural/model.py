@@ -1,5 +1,7 @@
 import os
+from multiprocessing.pool import ThreadPool
 from .utilities import get_device, ReaderWriter
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence
@@ -81,6 +83,11 @@ class BertEmbedder(nn.Module):
         self.bert_train_flag = self.config.get('bert_train_flag', False)
         # for now we are taking the last layer hidden vectors
         self.bert_all_output = self.config.get('bert_all_output', False)
+        # if set, embed sentences in length-bucketed batches of at most this number of tokens (see :func:`bucket_sents`)
+        self.bert_max_batch_tokens = self.config.get('bert_max_batch_tokens')
+        # if set, the bucketed path runs a TorchScript trace of bert (inference only), traced on the first call
+        self.bert_jit_trace = self.config.get('bert_jit_trace', False) and not self.bert_train_flag
+        self.traced_bertmodel = None
 
         if not self.bert_train_flag:
             self.bertmodel.eval()
@@ -127,6 +134,9 @@ class BertEmbedder(nn.Module):
         TODO: add flags and logic to handle multiple layers embedding (i.e. 12 layers embedding)
         '''
 
+        if self.bert_max_batch_tokens:
+            return self._forward_bucketed(doc_tensor, attention_mask, num_sents)
+
         embed_layers_lst = []
 
         for sent_indx in range(num_sents):  # going over each sentenece one by one due to GPU limit :((
@@ -149,6 +159,166 @@ class BertEmbedder(nn.Module):
         # print("finished embedding sents using BERT!")
         return out
 
+    def _forward_bucketed(self, doc_tensor, attention_mask, num_sents):
+        out = None
+        with torch.set_grad_enabled(self.bert_train_flag):
+            for sents_indx, batch_len in bucket_sents(attention_mask, num_sents, self.bert_max_batch_tokens):
+                encoded_layers = self._embed_last_layer(doc_tensor[sents_indx, :batch_len],
+                                                        attention_mask[sents_indx, :batch_len])
+                if out is None:
+                    out = encoded_layers.new_zeros((num_sents, doc_tensor.size(1), encoded_layers.size(-1)))
+                # scatter back to the original sentence order
+                out[sents_indx, :batch_len] = encoded_layers
+        return out
+
+    def _embed_last_layer(self, input_ids, attention_mask):
+        if self.bert_jit_trace:
+            if self.traced_bertmodel is None:
+                # traced with the first inputs so that it matches the device and dtype the embedder was moved to
+                self.traced_bertmodel = torch.jit.trace(BertLastLayer(self.bertmodel), (input_ids, attention_mask))
+            return self.traced_bertmodel(input_ids, attention_mask)
+        encoded_layers, __ = self.bertmodel(input_ids, attention_mask=attention_mask, output_all_encoded_layers=False)
+        return encoded_layers
+
+
+def bucket_sents(attention_mask, num_sents, max_batch_tokens, len_multiple=8):
+    """Group the sentences of a doc into batches of similar length
+
+    Sentences are sorted by number of tokens (longest first) and greedily packed such that each batch, padded to its
+    longest sentence, holds at most `max_batch_tokens` tokens. The padded length is rounded up to `len_multiple` to
+    limit the number of distinct input shapes.
+
+    Args:
+        attention_mask: tensor, (sents, max_sent_len)
+        num_sents: int, actual number of sentences in the document
+        max_batch_tokens: int, token budget per batch (batch size * padded length)
+        len_multiple: int, padded lengths are rounded up to a multiple of this value
+
+    Returns:
+        list of (tensor of sentence indices, padded length) tuples
+    """
+    max_sent_len = attention_mask.size(1)
+    sents_len, sorted_indx = torch.sort(attention_mask[:num_sents].sum(dim=1), descending=True)
+    sents_len = sents_len.tolist()
+    buckets = []
+    start = 0
+    while start < num_sents:
+        batch_len = min(-(-sents_len[start] // len_multiple) * len_multiple, max_sent_len)
+        batch_size = max(1, max_batch_tokens // batch_len)
+        buckets.append((sorted_indx[start:start+batch_size], batch_len))
+        start += batch_size
+    return buckets
+
+
+class BertLastLayer(nn.Module):
+    """Exposes the last encoded layer of a BertModel with a plain tensor signature (as needed for onnx export)"""
+
+    def __init__(self, bertmodel):
+        super(BertLastLayer, self).__init__()
+        self.bertmodel = bertmodel
+
+    def forward(self, input_ids, attention_mask):
+        encoded_layers, __ = self.bertmodel(input_ids, attention_mask=attention_mask, output_all_encoded_layers=False)
+        return encoded_layers
+
+
+def build_onnx_embedder(bertmodel, onnx_path, seq_len=128):
+    """Export the last layer embedding of `bertmodel` to an onnx model
+
+    Args:
+        bertmodel: instance of :class:`BertModel`
+        onnx_path: string, file path where the onnx model will be written
+        seq_len: int, sequence length of the dummy input used for tracing (batch and sequence axes are dynamic)
+    """
+    bert_lastlayer = BertLastLayer(bertmodel.float().cpu()).eval()
+    dummy_ids = torch.zeros((1, seq_len), dtype=torch.int64)
+    dummy_mask = torch.ones((1, seq_len), dtype=torch.int64)
+    dynamic_axes = {'input_ids': {0: 'batch', 1: 'seq_len'},
+                    'attention_mask': {0: 'batch', 1: 'seq_len'},
+                    'encoded_layers': {0: 'batch', 1: 'seq_len'}}
+    with torch.no_grad():
+        torch.onnx.export(bert_lastlayer, (dummy_ids, dummy_mask), onnx_path,
+                          input_names=['input_ids', 'attention_mask'],
+                          output_names=['encoded_layers'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=10)
+    return onnx_path
+
+
+def optimize_onnx_embedder(onnx_path, optimized_path, num_heads, hidden_size, float16=True, use_gpu=True):
+    """Fuse the attention (and layernorm/gelu) subgraphs of an exported bert model with onnxruntime's transformer
+    optimizer and optionally convert it to fp16
+
+    Args:
+        onnx_path: string, path to the onnx model generated by :func:`build_onnx_embedder`
+        optimized_path: string, file path where the optimized onnx model will be written
+        num_heads: int, number of attention heads of the bert model
+        hidden_size: int, hidden size of the bert model
+        float16: bool, whether to convert the optimized model to half precision (only worth it on gpus)
+        use_gpu: bool, whether to optimize the model for the cuda execution provider
+    """
+    from onnxruntime.transformers.optimizer import optimize_model
+
+    optimized_model = optimize_model(onnx_path, model_type='bert', num_heads=num_heads, hidden_size=hidden_size,
+                                     use_gpu=use_gpu)
+    if float16:
+        optimized_model.convert_float_to_float16(keep_io_types=False)
+    # report the fused operators to check that the attention fusion actually took place
+    fused_ops = optimized_model.get_fused_operator_statistics()
+    print("fused operators in {}:".format(optimized_path))
+    for op_type, count in fused_ops.items():
+        print("{}: {}".format(op_type, count))
+    if not fused_ops.get('Attention', 0):
+        print("WARNING: no attention layer was fused")
+    optimized_model.save_model_to_file(optimized_path)
+    return optimized_path
+
+
+class OnnxBertEmbedder(object):
+    """Inference only replacement of :class:`BertEmbedder` running an exported bert model with onnxruntime
+
+    See :func:`build_onnx_embedder` for generating the onnx model.
+    """
+
+    def __init__(self, onnx_path, to_gpu=True, gpu_index=0, max_batch_tokens=8192):
+        import onnxruntime as ort
+
+        if to_gpu and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers = [('CUDAExecutionProvider', {'device_id': gpu_index}), 'CPUExecutionProvider']
+        else:
+            providers = ['CPUExecutionProvider']
+        self.session = ort.InferenceSession(onnx_path, providers=providers)
+        self.max_batch_tokens = max_batch_tokens
+        self.fdtype = torch.float32
+
+    def type(self, fdtype):
+        # the precision is fixed by the onnx model, only the returned embeddings are cast to fdtype
+        self.fdtype = fdtype
+        return self
+
+    def to(self, device):
+        # device placement is handled by the onnxruntime execution providers
+        return self
+
+    def __call__(self, doc_tensor, attention_mask, num_sents):
+        """
+        Args:
+            doc_tenosr: tensor, (sents, max_sent_len)
+            attention_mask: tensor, (sents, max_sent_len)
+            num_sents: int, actual number of sentences in the document
+        """
+        doc_tensor = doc_tensor.cpu()
+        attention_mask = attention_mask.cpu()
+        out = None
+        for sents_indx, batch_len in bucket_sents(attention_mask, num_sents, self.max_batch_tokens):
+            ort_inputs = {'input_ids': doc_tensor[sents_indx, :batch_len].numpy(),
+                          'attention_mask': attention_mask[sents_indx, :batch_len].numpy()}
+            encoded_layers = torch.from_numpy(self.session.run(None, ort_inputs)[0])
+            if out is None:
+                out = torch.zeros((num_sents, doc_tensor.size(1), encoded_layers.size(-1)), dtype=self.fdtype)
+            out[sents_indx, :batch_len] = encoded_layers.type(self.fdtype)
+        return out
+
 
 class SentenceEncoder(nn.Module):
     def __init__(self, input_dim, hidden_dim, num_hiddenlayers=1,
@@ -523,16 +693,62 @@ def restrict_grad_(mparams, mode, limit):
                 param.grad.data.clamp_(minl, maxl)
 
 
-def generate_sents_embeds_from_docs(docs_data_tensor, bertembeder, embed_dir, fdtype, to_gpu=True, gpu_index=0):
+def to_device(tensor, device):
+    """Copy `tensor` to `device`, going through pinned memory with a non blocking copy when `device` is a gpu
+
+    Pinned host buffers are cached by pytorch, so repeated calls reuse them instead of allocating new ones.
+    """
+    if device.type == 'cuda':
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+def quantize_embeds(embed_sents):
+    """Symmetric int8 quantization of embeddings with one scale per token vector
+
+    Args:
+        embed_sents: tensor, (sents, max_sent_len, embed_dim)
+
+    Returns:
+        tuple of (int8 tensor of the same shape as `embed_sents`, float16 scales of shape (sents, max_sent_len, 1))
+    """
+    embed_sents = embed_sents.float()
+    scale = embed_sents.abs().max(dim=-1, keepdim=True)[0] / 127
+    scale[scale == 0] = 1  # all zero (padding) vectors
+    quantized = torch.round(embed_sents / scale).clamp(-127, 127).to(torch.int8)
+    return quantized, scale.half()
+
+
+def dequantize_embeds(embeds, device, fdtype):
+    """Move embeddings to `device` and cast them to `fdtype`, dequantizing them if needed (see :func:`quantize_embeds`)
+
+    Args:
+        embeds: tensor or tuple of (int8 tensor, scales tensor)
+        device: torch.device, device where to dequantize the embeddings
+        fdtype: torch dtype of the returned embeddings
+    """
+    if isinstance(embeds, tuple):
+        quantized, scale = embeds
+        return quantized.to(device).type(fdtype) * scale.to(device).type(fdtype)
+    return embeds.to(device).type(fdtype)
+
+
+def generate_sents_embeds_from_docs(docs_data_tensor, bertembeder, embed_dir, fdtype, to_gpu=True, gpu_index=0,
+                                    num_io_workers=4, quantize=False):
     """Generate token embedding for sentences in docs
 
+    The embeddings are copied to cpu and dumped by a pool of `num_io_workers` threads so that writing a doc to disk
+    overlaps with embedding the next ones.
+
     Args:
         docs_data_tensor: instance of :class:`DocsDataTensor`
-        bertembeder: instance of :class:`BertEmbedder`
+        bertembeder: instance of :class:`BertEmbedder` or :class:`OnnxBertEmbedder`
         embed_dir: string, path to directory where to dump embedding per document
-        fdtype: torch dtype, {torch.float32 or torch.float64}
+        fdtype: torch dtype, {torch.float16, torch.float32 or torch.float64}, the embeddings are dumped in this dtype
         to_gpu: bool, whether to use gpu or cpu
         gpu_index: if to_gpu, which gpu index to use
+        num_io_workers: int, number of threads dumping the embeddings
+        quantize: bool, whether to dump the embeddings quantized to int8 (see :func:`quantize_embeds`)
 
     """
     bert_proc_docs = {}
@@ -541,20 +757,72 @@ def generate_sents_embeds_from_docs(docs_data_tensor, bertembeder, embed_dir, fd
     bertembeder.type(fdtype).to(device)
     samples_counter = 0
     num_iter = len(docs_data_tensor)  # number of samples
-    for doc_indx in range(num_iter):
-        print(doc_indx)
-        doc_batch, doc_len, doc_sents_len, doc_attn_mask, doc_labels, doc_id = docs_data_tensor[doc_indx]
-        # push to gpu
-        embed_sents = bertembeder(doc_batch.to(device), doc_attn_mask.to(device), doc_len.item())
-        # write to disk for now
-        embed_fpath = os.path.join(embed_dir, '{}.pkl'.format(doc_id))
-        ReaderWriter.dump_tensor(embed_sents, embed_fpath)
-        # add embedding to dict
-        bert_proc_docs[doc_id] = embed_fpath
-        # clean stuff
-        del embed_sents
-        # torch.cuda.ipc_collect()
-        # torch.cuda.empty_cache()
-        samples_counter += 1
-        print("processed doc id: {}, {}/{}".format(doc_id, samples_counter, num_iter))
+    pending_dumps = []
+    with ThreadPool(num_io_workers) as io_pool:
+        for doc_indx in range(num_iter):
+            print(doc_indx)
+            doc_batch, doc_len, doc_sents_len, doc_attn_mask, doc_labels, doc_id = docs_data_tensor[doc_indx]
+            # push to gpu
+            with torch.no_grad():
+                embed_sents = bertembeder(to_device(doc_batch, device), to_device(doc_attn_mask, device),
+                                          doc_len.item())
+            if quantize:
+                embed_sents = quantize_embeds(embed_sents)
+            # copy to host memory before queueing the dump, so the docs waiting to be written hold no gpu memory
+            # (the readers map the dumped tensors to their own device)
+            if isinstance(embed_sents, tuple):
+                embed_sents = tuple(tensor.cpu() for tensor in embed_sents)
+            else:
+                embed_sents = embed_sents.cpu()
+            # write to disk for now
+            embed_fpath = os.path.join(embed_dir, '{}.pkl'.format(doc_id))
+            pending_dumps.append(io_pool.apply_async(ReaderWriter.dump_tensor, (embed_sents, embed_fpath)))
+            # add embedding to dict
+            bert_proc_docs[doc_id] = embed_fpath
+            # clean stuff
+            del embed_sents
+            # bound the number of embeddings waiting to be written (and kept in host memory)
+            if len(pending_dumps) > 2 * num_io_workers:
+                pending_dumps.pop(0).get()
+            # torch.cuda.ipc_collect()
+            # torch.cuda.empty_cache()
+            samples_counter += 1
+            print("processed doc id: {}, {}/{}".format(doc_id, samples_counter, num_iter))
+        for pending_dump in pending_dumps:
+            pending_dump.get()
     return bert_proc_docs
+
+
+def dump_sents_embeds_memmap(bert_proc_docs, embed_dir):
+    """Copy the per doc embeddings dumped by :func:`generate_sents_embeds_from_docs` into one memory mappable file
+
+    The sentences of all docs are stacked in `sents_embeds.dat` and their position is stored in
+    `sents_embeds_index.pkl` (see :class:`neural.run_workflow.SentsEmbedsMemmap` for reading them).
+
+    Args:
+        bert_proc_docs: dict, {doc_id: path of the dumped embedding}
+        embed_dir: string, path to directory where to dump the memory mappable file and its index
+    """
+    cpu_device = torch.device('cpu')
+    doc_index = {}
+    num_sents = 0
+    sent_shape = None
+    with open(os.path.join(embed_dir, 'sents_embeds.dat'), 'wb') as f:
+        for doc_id, embed_fpath in bert_proc_docs.items():
+            embed_sents = ReaderWriter.read_tensor(embed_fpath, cpu_device)
+            if isinstance(embed_sents, tuple):
+                # quantized embeddings are stored dequantized in half precision
+                embed_sents = dequantize_embeds(embed_sents, cpu_device, torch.float16)
+            embed_sents = embed_sents.numpy()
+            if sent_shape is None:
+                sent_shape, dtype = embed_sents.shape[1:], embed_sents.dtype
+            elif embed_sents.shape[1:] != sent_shape or embed_sents.dtype != dtype:
+                raise ValueError("Embedding of doc {} has shape {} and dtype {}, expected (*, {}) and {}"
+                                 "".format(doc_id, embed_sents.shape, embed_sents.dtype, sent_shape, dtype))
+            f.write(np.ascontiguousarray(embed_sents).tobytes())
+            doc_index[doc_id] = (num_sents, embed_sents.shape[0])
+            num_sents += embed_sents.shape[0]
+    index = {'doc_index': doc_index,
+             'shape': (num_sents,) + tuple(sent_shape or ()),
+             'dtype': dtype.name if sent_shape else None}
+    ReaderWriter.dump_data(index, os.path.join(embed_dir, 'sents_embeds_index.pkl'))
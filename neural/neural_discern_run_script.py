@@ -11,15 +11,15 @@ import os
 import datetime
 import pandas as pd
 import torch
-from pytorch_pretrained_bert import BertModel, BertForPreTraining, BertConfig
+from pytorch_pretrained_bert import BertModel, BertConfig
 
-from neural.data_processor import DataDictProcessor
 from neural.dataset import generate_docpartition_per_question, validate_q_docpartitions, compute_class_weights_per_fold_
-from neural.model import BertEmbedder, generate_sents_embeds_from_docs
+from neural.model import BertEmbedder, OnnxBertEmbedder, build_onnx_embedder, optimize_onnx_embedder, \
+    generate_sents_embeds_from_docs, dump_sents_embeds_memmap
 from neural.run_workflow import generate_models_config, HyperparamConfig, hyperparam_model_search_parallel, \
     get_best_config_from_hyperparamsearch, train_val_run, train_val_run_one_question, test_run, \
-    build_q_config_map_from_train_val
-from neural.utilities import ReaderWriter, create_directory, get_device
+    build_q_config_map_from_train_val, load_sents_embeds, get_topk_attnw
+from neural.utilities import ReaderWriter, create_directory, get_device, get_inference_fdtype
 
 
 # might have to be immediately after import torch.multiprocessing as mp
@@ -44,9 +44,8 @@ def read_pickles(data_dir):
 
 def build_doc_partitions(questions, proc_articles_repr, proc_articles_dict, proc_config, docs_data_tensor, q_partitions,
                          validate=False):
-    processor = DataDictProcessor(proc_config)
-    # reassign updated articles_dict and articles_repr to processor instance
-    processor.set_instance_attr(proc_articles_repr, proc_articles_dict, proc_config)
+    # the processor state (proc_articles_repr, proc_articles_dict, proc_config) is not needed to build the partitions,
+    # they only depend on docs_data_tensor and q_partitions
 
     # turn the list of ids in q_partitions into dataset using PartitionDataTensor
     q_docpartitions = {}
@@ -66,35 +65,66 @@ def build_doc_partitions(questions, proc_articles_repr, proc_articles_dict, proc
 def load_biobert_model(biobert_pth, device):
     """Read saved state dict for biobert model on disk
 
+    The state dict is the one of a `BertForPreTraining` model, only its `bert` weights are loaded (the pre-training
+    heads are not needed).
+
     Args:
         biobert_pth: str, folder path where model state dictionary and config file are saved
+
+    Returns:
+        instance of `BertModel`
     """
     bert_config_file = os.path.join(biobert_pth, 'bert_config.json')
     config = BertConfig.from_json_file(bert_config_file)
     print("Building PyTorch model from configuration: {}".format(str(config)))
-    model = BertForPreTraining(config)
-    model.load_state_dict(torch.load(os.path.join(biobert_pth, 'biobert_statedict.pkl'), map_location=device))
+    model = BertModel(config)
+    state_dict = torch.load(os.path.join(biobert_pth, 'biobert_statedict.pkl'), map_location=device)
+    prefix = 'bert.'
+    model.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
     return model
 
 
-def write_sents_embeddings(directory, bertmodel, sents_embed_dir_name, docs_data_tensor):
+@torch.no_grad()
+def write_sents_embeddings(directory, bertmodel, sents_embed_dir_name, docs_data_tensor, onnx_path=None,
+                           optimize_onnx=False, quantize=False):
     # === Generate sents embedding ===
     # load BertModel
 
     # define BertEmbedder
-    bert_config = {'bert_train_flag': False,
-                   'bert_all_output': False}
-    bertembeder = BertEmbedder(bertmodel, bert_config)
+    if onnx_path:
+        # run the one-off embedding pass through onnxruntime, exporting the model first if needed
+        if not os.path.isfile(onnx_path):
+            build_onnx_embedder(bertmodel, onnx_path)
+        if optimize_onnx:
+            # fuse the attention layers (and convert to fp16 on gpus supporting it) once, reuse the result afterwards
+            float16 = get_inference_fdtype(get_device(to_gpu=True)) == torch.float16
+            optimized_path = '{}_fused{}.onnx'.format(os.path.splitext(onnx_path)[0], '_fp16' if float16 else '')
+            if not os.path.isfile(optimized_path):
+                optimize_onnx_embedder(onnx_path, optimized_path, bertmodel.config.num_attention_heads,
+                                       bertmodel.config.hidden_size, float16=float16,
+                                       use_gpu=torch.cuda.is_available())
+            onnx_path = optimized_path
+        bertembeder = OnnxBertEmbedder(onnx_path)
+    else:
+        bert_config = {'bert_train_flag': False,
+                       'bert_all_output': False,
+                       'bert_max_batch_tokens': 8192,
+                       'bert_jit_trace': True}
+        bertembeder = BertEmbedder(bertmodel, bert_config)
     sents_embed_dir = create_directory(sents_embed_dir_name, directory)
-    fdtype = torch.float32
+    # embeddings are computed once and only read afterwards, so run (and store them) in fp16 on gpus supporting it
+    fdtype = get_inference_fdtype(get_device(to_gpu=True))
 
     # generate and dump bert embedding for the tokens inside the specificed embedding directory
-    bert_proc_docs = generate_sents_embeds_from_docs(docs_data_tensor, bertembeder, sents_embed_dir, fdtype)
+    bert_proc_docs = generate_sents_embeds_from_docs(docs_data_tensor, bertembeder, sents_embed_dir, fdtype,
+                                                     quantize=quantize)
     ReaderWriter.dump_data(bert_proc_docs, os.path.join(sents_embed_dir, 'bert_proc_docs.pkl'))
+    # also store them in one file that can be memory mapped when preloading the embeddings
+    dump_sents_embeds_memmap(bert_proc_docs, sents_embed_dir)
 
 
 def run_hyperparam_search(questions_to_run, directory, q_docpartitions, bertmodel, sents_embed_dir, question_gpu_map,
-                          attention):
+                          attention, sents_embeds=None):
     hyperparam_search_dir = create_directory('hyperparam_search', directory)
     hyperparam_model_search_parallel(questions_to_run, q_docpartitions, bertmodel, sents_embed_dir,
                                      hyperparam_search_dir,
@@ -102,19 +132,23 @@ def run_hyperparam_search(questions_to_run, directory, q_docpartitions, bertmode
                                      fdtype=torch.float32,
                                      num_epochs=15,
                                      prob_interval_truemax=0.05,
-                                     prob_estim=0.95, random_seed=42, attention=attention)
+                                     prob_estim=0.95, random_seed=42, attention=attention,
+                                     sents_embeds=sents_embeds)
 
 
 def run_training_parallel(questions_to_run, train_val_dir, q_docpartitions, q_config_map, bertmodel, sents_embed_dir,
-                          question_gpu_map, num_epochs, max_folds):
-    queue = mp.Queue()
+                          question_gpu_map, num_epochs, max_folds, sents_embeds=None, use_amp=False):
     q_processes = []
     # create a process for each question model
+    # (each process writes its models and scores under train_val_dir, so no results are passed back to the parent)
     for q in questions_to_run:
-        q_processes.append(mp.Process(target=train_val_run_one_question, args=(queue, q, q_docpartitions, q_config_map,
+        # each process only receives the partitions of its own question
+        q_processes.append(mp.Process(target=train_val_run_one_question, args=(q, {q: q_docpartitions[q]},
+                                                                               {q: q_config_map[q]},
                                                                                bertmodel, train_val_dir,
                                                                                sents_embed_dir, question_gpu_map[q],
-                                                                               num_epochs, max_folds)))
+                                                                               num_epochs, max_folds,
+                                                                               sents_embeds, use_amp)))
 
     for q_process in q_processes:
         print(">>> spawning process")
@@ -128,26 +162,26 @@ def run_training_parallel(questions_to_run, train_val_dir, q_docpartitions, q_co
 
 
 def run_training(directory, q_docpartitions, q_config_map, bertmodel, sents_embed_dir, question_gpu_map, num_epochs,
-                 max_folds):
+                 max_folds, sents_embeds=None, use_amp=False):
     train_val_dir = create_directory('train_validation', directory)
     train_val_run(q_docpartitions, q_config_map, bertmodel, train_val_dir, sents_embed_dir, question_gpu_map,
-                  num_epochs, max_folds)
+                  num_epochs, max_folds, sents_embeds=sents_embeds, use_amp=use_amp)
     return train_val_dir
 
 
+@torch.no_grad()
 def evaluate_on_test_set(directory, q_docpartitions, q_config_map, bertmodel, train_val_dir, sents_embed_dir,
-                         gpu_index):
+                         gpu_index, sents_embeds=None):
     test_dir = create_directory('test', directory)
     test_run(q_docpartitions, q_config_map, bertmodel, train_val_dir, test_dir, sents_embed_dir, gpu_index,
-             num_epochs=1)
+             num_epochs=1, sents_embeds=sents_embeds)
     return test_dir
 
 
 def get_performance_results(question, target_dir, num_folds, dsettype):
-    all_perf = {}
-    num_metrics = 3
-    perf_dict = [{} for i in range(num_metrics)]  # track micro_f1, macro_f1, accuracy
-    question_name = ['q{}'.format(question)]
+    question_name = 'q{}'.format(question)
+    metric_names = ['micro_f1', 'macro_f1', 'accuracy']
+    fold_scores = {}
     for fold_num in range(num_folds):
 
         fold_dir = os.path.join(target_dir,
@@ -157,47 +191,38 @@ def get_performance_results(question, target_dir, num_folds, dsettype):
         score_file = os.path.join(fold_dir, 'score_{}.pkl'.format(dsettype))
         if os.path.isfile(score_file):
             mscore = ReaderWriter.read_data(score_file)
-            perf_dict[0]['fold{}'.format(fold_num)] = mscore.micro_f1
-            perf_dict[1]['fold{}'.format(fold_num)] = mscore.macro_f1
-            perf_dict[2]['fold{}'.format(fold_num)] = mscore.accuracy
-    perf_df = []
-    for i in range(num_metrics):
-        all_perf = perf_dict[i]
-        all_perf_df = pd.DataFrame(all_perf, index=question_name)
-        median = all_perf_df.median(axis=1)
-        mean = all_perf_df.mean(axis=1)
-        stddev = all_perf_df.std(axis=1)
-        all_perf_df['mean'] = mean
-        all_perf_df['median'] = median
-        all_perf_df['stddev'] = stddev
-        perf_df.append(all_perf_df.sort_values('mean', ascending=False))
-    return perf_df
+            fold_scores['fold{}'.format(fold_num)] = [mscore.micro_f1, mscore.macro_f1, mscore.accuracy]
+    # one row per metric, so that the stats of all metrics are computed at once
+    all_perf_df = pd.DataFrame(fold_scores, index=metric_names)
+    stats = [('mean', all_perf_df.mean(axis=1)), ('median', all_perf_df.median(axis=1)),
+             ('stddev', all_perf_df.std(axis=1))]
+    for stat_name, stat in stats:
+        all_perf_df[stat_name] = stat
+    return [all_perf_df.loc[[metric]].rename(index={metric: question_name}) for metric in metric_names]
 
 
 def build_accuracy_dfs(q_docpartitions, test_dir):
-    micro_f1_df = pd.DataFrame()
-    macro_f1_df = pd.DataFrame()
-    accuracy_df = pd.DataFrame()
+    # collect the per question frames and concatenate them once
+    micro_f1_dfs = [pd.DataFrame()]
+    macro_f1_dfs = [pd.DataFrame()]
+    accuracy_dfs = [pd.DataFrame()]
 
     for q in q_docpartitions:
         micro_f1, macro_f1, accuracy = get_performance_results(q, test_dir, 5, 'test')
-        micro_f1_df = pd.concat([micro_f1_df, micro_f1], sort=True)
-        macro_f1_df = pd.concat([macro_f1_df, macro_f1], sort=True)
-        accuracy_df = pd.concat([accuracy_df, accuracy], sort=True)
+        micro_f1_dfs.append(micro_f1)
+        macro_f1_dfs.append(macro_f1)
+        accuracy_dfs.append(accuracy)
 
-    return micro_f1_df, macro_f1_df, accuracy_df
+    return pd.concat(micro_f1_dfs, sort=True), pd.concat(macro_f1_dfs, sort=True), pd.concat(accuracy_dfs, sort=True)
 
 
 def highlight_attnw_over_sents(docid_attnweights_map, proc_articles_repr, topk=5):
+    docid_topk_attnw = get_topk_attnw(docid_attnweights_map, topk)
     for docid in docid_attnweights_map:
-        attnw = docid_attnweights_map[docid]
-        topk = topk if attnw.size(-1) > topk else attnw.size(-1)  # get top
-        max_val, max_indx = torch.topk(attnw, topk, dim=1)
         print(docid)
         print("attended sent:")
-        for i in range(max_indx.size(-1)):
-            target_indx = max_indx[0][i].item()
-            print("sentence num:", target_indx, "attnw:", max_val[0][i].item())
+        for target_indx, attnw in docid_topk_attnw[docid]:
+            print("sentence num:", target_indx, "attnw:", attnw)
             print(proc_articles_repr[docid]['sents'][target_indx])
         print()
 
@@ -223,6 +248,16 @@ if __name__ == '__main__':
                                                              'so as not to overwrite the current one. ')
     parser.add_argument("--base-dir", default='/opt/data/autodiscern/aa_neural', help="Base dir to and including "
                                                                                       "autodiscern/aa_neural/")
+    parser.add_argument("--onnx-model-path", default=None, help="Compute the sentence embeddings with onnxruntime "
+                                                                "using this onnx model (exported if missing)")
+    parser.add_argument("--optimize-onnx-model", action="store_true", default=False,
+                        help="Fuse the attention layers of the onnx model (and convert it to fp16 on recent gpus)")
+    parser.add_argument("--quantize-sentence-embeddings", action="store_true", default=False,
+                        help="Store the (re-)computed sentence embeddings quantized to int8")
+    parser.add_argument("--preload-sentence-embeddings", action="store_true", default=False,
+                        help="Read (or memory map) all sentence embeddings once instead of from disk at every epoch")
+    parser.add_argument("--amp", action="store_true", default=False,
+                        help="Train with automatic mixed precision (requires pytorch >= 1.6 and a gpu)")
     parser.add_argument("--disable-attention", action="store_true", default=False, help="Run with the attention layer")
     args = parser.parse_args()
 
@@ -230,6 +265,11 @@ if __name__ == '__main__':
         'test_mode': args.test_mode,
         'biobert': args.biobert,
         'rewrite_sentence_embeddings': args.rewrite_sentence_embeddings,
+        'onnx_model_path': args.onnx_model_path,
+        'optimize_onnx_model': args.optimize_onnx_model,
+        'quantize_sentence_embeddings': args.quantize_sentence_embeddings,
+        'preload_sentence_embeddings': args.preload_sentence_embeddings,
+        'amp': args.amp,
         'run_hyper_param_search': args.run_hyper_param_search,
         'experiment_to_rerun': args.experiment_to_rerun,
         'copy_exp_dir': args.copy_exp_dir,
@@ -303,14 +343,25 @@ if __name__ == '__main__':
                                            docs_data_tensor, q_partitions)
 
     if config['biobert']:
-        bert_for_pretrain = load_biobert_model(config['bert_model_dir'], default_device)
-        bertmodel = bert_for_pretrain.bert
+        bertmodel = load_biobert_model(config['bert_model_dir'], default_device)
     else:
         bertmodel = BertModel.from_pretrained(config['bert_model_dir'])
 
     if config['rewrite_sentence_embeddings']:
         verbose_print("Writing sentence embeddings...", verbose)
-        write_sents_embeddings(config['base_dir'], bertmodel, config['sents_embed_dir_name'], docs_data_tensor)
+        write_sents_embeddings(config['base_dir'], bertmodel, config['sents_embed_dir_name'], docs_data_tensor,
+                               onnx_path=config['onnx_model_path'], optimize_onnx=config['optimize_onnx_model'],
+                               quantize=config['quantize_sentence_embeddings'])
+
+    # move the large tensors to shared memory once, the spawned processes then attach to them instead of copying them
+    docs_data_tensor.share_memory_()
+    bertmodel.eval().share_memory()
+
+    if config['preload_sentence_embeddings']:
+        verbose_print("Reading sentence embeddings...", verbose)
+        sents_embeds = load_sents_embeds(config['sents_embed_dir'])
+    else:
+        sents_embeds = None
 
     if config['experiment_to_rerun']:
         verbose_print("Using hyper-parameter search results from {}".format(config['exp_dir']), verbose)
@@ -326,7 +377,8 @@ if __name__ == '__main__':
     elif config['run_hyper_param_search']:
         verbose_print("Running hyper-parameter search...", verbose)
         run_hyperparam_search(config['questions_to_run'], config['exp_dir'], q_docpartitions, bertmodel,
-                              config['sents_embed_dir'], config['question_gpu_map'], config['attention'])
+                              config['sents_embed_dir'], config['question_gpu_map'], config['attention'],
+                              sents_embeds=sents_embeds)
         hyperparam_search_dir = create_directory('hyperparam_search', exp_dir)
         q_config_map = get_best_config_from_hyperparamsearch(config['questions'], hyperparam_search_dir, num_trials=60,
                                                              metric_indx=2)
@@ -347,11 +399,12 @@ if __name__ == '__main__':
     train_val_dir = create_directory('train_validation', exp_dir)
     train_val_dir = run_training_parallel(config['questions_to_run'], train_val_dir, q_docpartitions, q_config_map,
                                           bertmodel, config['sents_embed_dir'], config['question_gpu_map'],
-                                          config['num_epochs'], config['max_folds'])
+                                          config['num_epochs'], config['max_folds'], sents_embeds=sents_embeds,
+                                          use_amp=config['amp'])
 
     verbose_print("Evaluating on test set...", verbose)
     test_dir = evaluate_on_test_set(config['exp_dir'], q_docpartitions, q_config_map, bertmodel, train_val_dir,
-                                    config['sents_embed_dir'], gpu_index=1)
+                                    config['sents_embed_dir'], gpu_index=1, sents_embeds=sents_embeds)
 
     micro_f1_df, macro_f1_df, accuracy_df = build_accuracy_dfs(q_docpartitions, test_dir)
     print("micro_f1_df: {}".format(micro_f1_df))
@@ -139,8 +139,7 @@ def biobert_predict(data_dict: dict, questions, experiment_dir, question_fold_ma
 
     # load BERT model
     pytorch_dump_path = pkg_resources.resource_filename('autodiscern', 'package_data/pytorch_biobert')
-    bert_for_pretrain = load_biobert_model(pytorch_dump_path, default_device)
-    bertmodel = bert_for_pretrain.bert
+    bertmodel = load_biobert_model(pytorch_dump_path, default_device)
 
     processor = build_DataDictProcessor(transformed_data, vocab_path, processor_config)
     tokenizer = BertTokenizer.from_pretrained(vocab_path, do_lower_case=False)
@@ -1,14 +1,16 @@
 import os
 import itertools
+import contextlib
 from .utilities import get_device, create_directory, ReaderWriter, perfmetric_report, plot_loss
 from .model import Attention, SentenceEncoder, DocEncoder, DocEncoder_MeanPooling, DocCategScorer, BertEmbedder,\
-    restrict_grad_
+    restrict_grad_, dequantize_embeds
 from .dataset import construct_load_dataloaders
 import numpy as np
 import pandas as pd
 import torch
 from torch import nn
 import torch.multiprocessing as mp
+from torch.nn.utils.rnn import pad_sequence
 
 
 class HyperparamConfig:
@@ -120,8 +122,66 @@ def dump_dict_content(dsettype_content_map, dsettypes, desc, wrk_dir):
         ReaderWriter.dump_data(dsettype_content_map[dsettype], path)
 
 
+class SentsEmbedsMemmap(object):
+    """Read only {doc_id: embedding} mapping over the file written by :func:`dump_sents_embeds_memmap`
+
+    The file is memory mapped lazily in each process (only the path and the index are pickled when passed to a
+    spawned process), so docs are paged in on access and the pages are shared by all processes through the page cache.
+    """
+
+    def __init__(self, sents_embed_dir):
+        self.fpath = os.path.join(sents_embed_dir, 'sents_embeds.dat')
+        index = ReaderWriter.read_data(os.path.join(sents_embed_dir, 'sents_embeds_index.pkl'))
+        self.doc_index = index['doc_index']  # dict, {doc_id: (first sentence, number of sentences)}
+        self.shape = index['shape']
+        self.dtype = index['dtype']
+        self.memmap = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memmap'] = None
+        return state
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_index
+
+    def __getitem__(self, doc_id):
+        if self.memmap is None:
+            # copy-on-write mapping, pages are only copied if a tensor is modified in-place
+            self.memmap = np.memmap(self.fpath, dtype=self.dtype, mode='c', shape=self.shape)
+        start, num_sents = self.doc_index[doc_id]
+        return torch.from_numpy(self.memmap[start:start+num_sents])
+
+
+def load_sents_embeds(sents_embed_dir):
+    """Read all the sentence embeddings dumped by :func:`generate_sents_embeds_from_docs` into shared memory
+
+    The embeddings are then read once instead of once per epoch, fold and question. Processes receiving the returned
+    dict attach to the same memory instead of copying the tensors. If the embeddings were also stored with
+    :func:`dump_sents_embeds_memmap`, they are memory mapped instead of read (see :class:`SentsEmbedsMemmap`).
+
+    Args:
+        sents_embed_dir: string, path to the directory where the embeddings and `bert_proc_docs.pkl` are dumped
+
+    Returns:
+        dict, {doc_id: torch.Tensor of shape (sents, max_sent_len, embed_dim)} with cpu tensors
+    """
+    if(os.path.isfile(os.path.join(sents_embed_dir, 'sents_embeds_index.pkl'))):
+        return SentsEmbedsMemmap(sents_embed_dir)
+    bert_proc_docs = ReaderWriter.read_data(os.path.join(sents_embed_dir, 'bert_proc_docs.pkl'))
+    cpu_device = torch.device('cpu')
+    sents_embeds = {}
+    for doc_id, embed_fpath in bert_proc_docs.items():
+        embed_sents = ReaderWriter.read_tensor(embed_fpath, cpu_device)
+        # quantized embeddings are (int8 tensor, scales) tuples, see :func:`quantize_embeds`
+        for tensor in (embed_sents if isinstance(embed_sents, tuple) else (embed_sents,)):
+            tensor.share_memory_()
+        sents_embeds[doc_id] = embed_sents
+    return sents_embeds
+
+
 def run_neural_discern(data_partition, dsettypes, bertmodel, config, options, wrk_dir, sents_embed_dir,
-                       state_dict_dir=None, to_gpu=True, gpu_index=0):
+                       state_dict_dir=None, to_gpu=True, gpu_index=0, sents_embeds=None):
     pid = "{}".format(os.getpid())  # process id description
     # get data loader config
     dataloader_config = config['dataloader_config']
@@ -227,6 +287,11 @@ def run_neural_discern(data_partition, dsettypes, bertmodel, config, options, wr
         cyc_scheduler = torch.optim.lr_scheduler.CyclicLR(optimizer, base_lr, max_lr, step_size_up=c_step_size,
                                                           mode='triangular', cycle_momentum=False)
 
+    # mixed precision (torch.cuda.amp needs pytorch >= 1.6 and a gpu), the model weights are kept in fdtype
+    use_amp = options.get('use_amp', False) and device.type == 'cuda' and hasattr(torch.cuda, 'amp')
+    if(use_amp and 'train' in data_loaders):
+        grad_scaler = torch.cuda.amp.GradScaler()
+
     # store attention weights for validation and test set
     if attnmodel_config:
         docid_attnweights_map = {dsettype: {} for dsettype in data_loaders if dsettype in {'validation', 'test'}}
@@ -300,9 +365,14 @@ def run_neural_discern(data_partition, dsettypes, bertmodel, config, options, wr
                         # print('doc_indx', doc_indx)
                         doc_id = docs_id[doc_indx].item()
                         doc_ids.append(doc_id)
-                        if(doc_id in bert_proc_docs):
+                        if(sents_embeds is not None and doc_id in sents_embeds):
+                            # preloaded in the parent process, see :func:`load_sents_embeds`
+                            embed_sents = dequantize_embeds(sents_embeds[doc_id], device, fdtype)
+                        elif(doc_id in bert_proc_docs):
                             # due to GPU limit
-                            embed_sents = ReaderWriter.read_tensor(bert_proc_docs[doc_id], device=device)
+                            # embeddings may have been dumped in half precision or quantized
+                            embed_sents = dequantize_embeds(ReaderWriter.read_tensor(bert_proc_docs[doc_id],
+                                                                                     device=device), device, fdtype)
                             # embed_sents = embed_sents.to(device)  # send to gpu device
                         else:
                             print('===NOT=== READING BERT EMBEDS 2')
@@ -313,22 +383,23 @@ def run_neural_discern(data_partition, dsettypes, bertmodel, config, options, wr
                             ReaderWriter.dump_tensor(embed_sents, embed_fpath)
                             bert_proc_docs[doc_id] = embed_fpath
 
-                        sents_rnn_hidden = sent_encoder(embed_sents, docs_sents_len[doc_indx],
-                                                        docs_len[doc_indx].item())
-
-                        # # remove the embedding from GPU
-                        # bert_proc_docs[doc_id].to(cpu_device)
-                        # print('sents_rnn_hidden', sents_rnn_hidden.shape)
-                        enc_sents = sents_rnn_hidden
-                        # print('enc_sents', enc_sents.shape)
-                        doc_out, doc_attn_weights = doc_encoder(enc_sents)
-                        # print('doc_out', doc_out.shape)
-                        # print('doc_attn_weights', doc_attn_weights.shape)
-                        # tracking attention weight for validation and test examples
-                        if(dsettype in docid_attnweights_map):
-                            docid_attnweights_map[dsettype][doc_id] = doc_attn_weights
-
-                        logsoftmax_scores = doc_categ_scorer(doc_out)
+                        with (torch.cuda.amp.autocast() if use_amp else contextlib.ExitStack()):
+                            sents_rnn_hidden = sent_encoder(embed_sents, docs_sents_len[doc_indx],
+                                                            docs_len[doc_indx].item())
+
+                            # # remove the embedding from GPU
+                            # bert_proc_docs[doc_id].to(cpu_device)
+                            # print('sents_rnn_hidden', sents_rnn_hidden.shape)
+                            enc_sents = sents_rnn_hidden
+                            # print('enc_sents', enc_sents.shape)
+                            doc_out, doc_attn_weights = doc_encoder(enc_sents)
+                            # print('doc_out', doc_out.shape)
+                            # print('doc_attn_weights', doc_attn_weights.shape)
+                            # tracking attention weight for validation and test examples
+                            if(dsettype in docid_attnweights_map):
+                                docid_attnweights_map[dsettype][doc_id] = doc_attn_weights
+
+                            logsoftmax_scores = doc_categ_scorer(doc_out)
                         __, pred_classindx = torch.max(logsoftmax_scores, 1)  # apply max on row level
 
                         # print('logsoftmax_scores', logsoftmax_scores.shape)
@@ -351,7 +422,17 @@ def run_neural_discern(data_partition, dsettypes, bertmodel, config, options, wr
                     # print("b_logprob_scores", b_logprob_scores.shape)
                     # print("b_target_class", b_target_class.shape)
                     loss = loss_func(b_logprob_scores, b_target_class)
-                    if(dsettype == 'train'):
+                    if(dsettype == 'train' and use_amp):
+                        # scale the loss to avoid underflow of fp16 gradients
+                        grad_scaler.scale(loss).backward()
+                        if(rgrad_mode):
+                            grad_scaler.unscale_(optimizer)
+                            restrict_grad_(models_param, rgrad_mode, rgrad_limit)
+                        # skips the update if the gradients overflowed
+                        grad_scaler.step(optimizer)
+                        grad_scaler.update()
+                        cyc_scheduler.step()
+                    elif(dsettype == 'train'):
                         # print("computing loss")
                         # backward step (i.e. compute gradients)
                         loss.backward()
@@ -422,33 +503,49 @@ def build_predictions_df(ids, true_class, pred_class, logprob_scores):
     return predictions_df
 
 
+def get_topk_attnw(docid_attnweights_map, topk=5):
+    """Get the `topk` most attended sentences of each doc using one topk call over all docs
+
+    Args:
+        docid_attnweights_map: dict, {docid: attention weights tensor of shape (1, sents)}
+        topk: int, number of sentences to return per doc (fewer if the doc has less sentences)
+
+    Returns:
+        dict, {docid: list of (sentence index, attention weight) tuples sorted by decreasing weight}
+    """
+    if not docid_attnweights_map:
+        return {}
+    docids = list(docid_attnweights_map)
+    attnws = [docid_attnweights_map[docid].reshape(-1) for docid in docids]
+    # pad with -inf so that padding never makes it into the top attended sentences
+    padded_attnws = pad_sequence(attnws, batch_first=True, padding_value=float('-inf'))
+    max_val, max_indx = torch.topk(padded_attnws, min(topk, padded_attnws.size(1)), dim=1)
+    max_val, max_indx = max_val.tolist(), max_indx.tolist()
+    return {docid: list(zip(max_indx[i], max_val[i]))[:attnws[i].size(0)] for i, docid in enumerate(docids)}
+
+
 def highlight_attnw_over_sents(docid_attnweights_map, proc_articles_repr, topk=5):
+    docid_topk_attnw = get_topk_attnw(docid_attnweights_map, topk)
     for docid in docid_attnweights_map:
-        attnw = docid_attnweights_map[docid]
-        topk = topk if attnw.size(-1) > topk else attnw.size(-1)  # get top
-        max_val, max_indx = torch.topk(attnw, topk, dim=1)
         print(docid)
         print("attended sent:")
-        for i in range(max_indx.size(-1)):
-            target_indx = max_indx[0][i].item()
-            print("sentence num:", target_indx, "attnw:", max_val[0][i].item())
+        for target_indx, attnw in docid_topk_attnw[docid]:
+            print("sentence num:", target_indx, "attnw:", attnw)
             print(proc_articles_repr[docid]['sents_tok'][target_indx])
         print()
 
 
 def return_attnw_over_sents(docid_attnweights_map, proc_articles_repr, topk=5):
     attended_sents = {}
+    docid_topk_attnw = get_topk_attnw(docid_attnweights_map, topk)
     for docid in docid_attnweights_map:
         attended_sents[docid] = []
         attnw = docid_attnweights_map[docid]
         print('docid_attnweights_map: {}'.format(docid_attnweights_map))
         print('attnw: {}'.format(attnw))
-        topk = topk if attnw.size(-1) > topk else attnw.size(-1)  # get top
-        max_val, max_indx = torch.topk(attnw, topk, dim=1)
-        for i in range(max_indx.size(-1)):
-            target_indx = max_indx[0][i].item()
+        for target_indx, weight in docid_topk_attnw[docid]:
             sentence = proc_articles_repr[docid]['sents'][target_indx]
-            attended_sents[docid].append({'sentence': sentence, 'weight': max_val[0][i].item()})
+            attended_sents[docid].append({'sentence': sentence, 'weight': weight})
     return attended_sents
 
 
@@ -513,7 +610,8 @@ def get_random_question_fold_per_hyperparam_exp(questions, random_seed=42):
 
 
 def hyperparam_model_search(q_docpartitions, bertmodel, sents_embed_dir, root_dir, fdtype=torch.float32, num_epochs=15,
-                            prob_interval_truemax=0.05, prob_estim=0.95, random_seed=42, attention=True):
+                            prob_interval_truemax=0.05, prob_estim=0.95, random_seed=42, attention=True,
+                            sents_embeds=None):
     questions = list(q_docpartitions.keys())
     # questions = [4]  # TODO: update this
     q_fold_map = get_random_question_fold_per_hyperparam_exp(questions, random_seed=random_seed)
@@ -529,12 +627,13 @@ def hyperparam_model_search(q_docpartitions, bertmodel, sents_embed_dir, root_di
             path = os.path.join(root_dir, 'question_{}'.format(q), 'fold_{}'.format(fold_num),
                                 'config_{}'.format(counter))
             wrk_dir = create_directory(path)
-            run_neural_discern(data_partition, dsettypes, bertmodel, mconfig, options, wrk_dir, sents_embed_dir)
+            run_neural_discern(data_partition, dsettypes, bertmodel, mconfig, options, wrk_dir, sents_embed_dir,
+                               sents_embeds=sents_embeds)
 
 
-def run_one_questions_hyperparam_search(queue, q, fold_num, data_partition, bertmodel, sents_embed_dir, root_dir,
+def run_one_questions_hyperparam_search(q, fold_num, data_partition, bertmodel, sents_embed_dir, root_dir,
                                         gpu_index, fdtype=torch.float32, num_epochs=15, prob_interval_truemax=0.05,
-                                        prob_estim=0.95, random_seed=42, attention=True):
+                                        prob_estim=0.95, random_seed=42, attention=True, sents_embeds=None):
     # get list of hyperparam configs
     hyperparam_options = get_hyperparam_options(prob_interval_truemax, prob_estim)
     dsettypes = ['train', 'validation']
@@ -545,34 +644,68 @@ def run_one_questions_hyperparam_search(queue, q, fold_num, data_partition, bert
         wrk_dir = create_directory(os.path.join(root_dir, 'question_{}'.format(q), 'fold_{}'.format(fold_num),
                                                 'config_{}'.format(counter)))
         run_neural_discern(data_partition, dsettypes, bertmodel, mconfig, options, wrk_dir, sents_embed_dir,
-                           gpu_index=gpu_index)
+                           gpu_index=gpu_index, sents_embeds=sents_embeds)
+
+
+def run_hyperparam_search_worker(job_queue, q_docpartitions, bertmodel, sents_embed_dir, root_dir, gpu_index,
+                                 fdtype=torch.float32, attention=True, sents_embeds=None):
+    """Run hyperparam search trials pulled from `job_queue` on one gpu until a `None` job is received
+
+    Args:
+        job_queue: multiprocessing queue of (question, fold_num, config_num, hyperparam_config) jobs
+        q_docpartitions: dict, {question: {fold_num: data_partition}}
+        gpu_index: int, gpu on which all the trials of this worker run
+    """
+    dsettypes = ['train', 'validation']
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        q, fold_num, counter, hyperparam_config = job
+        mconfig, options = generate_models_config(hyperparam_config, q, fold_num, fdtype, attention)
+        print("Running q{} hyperparam search #{} on gpu {}".format(q, counter, gpu_index))
+        wrk_dir = create_directory(os.path.join(root_dir, 'question_{}'.format(q), 'fold_{}'.format(fold_num),
+                                                'config_{}'.format(counter)))
+        run_neural_discern(q_docpartitions[q][fold_num], dsettypes, bertmodel, mconfig, options, wrk_dir,
+                           sents_embed_dir, gpu_index=gpu_index, sents_embeds=sents_embeds)
 
 
 def hyperparam_model_search_parallel(questions_to_run, q_docpartitions, bertmodel, sents_embed_dir, root_dir,
                                      question_gpu_map, fdtype=torch.float32, num_epochs=15, prob_interval_truemax=0.05,
-                                     prob_estim=0.95, random_seed=42, attention=True):
-    q_fold_map = get_random_question_fold_per_hyperparam_exp(questions_to_run, random_seed=random_seed)
-    queue = mp.Queue()
-    q_processes = []
+                                     prob_estim=0.95, random_seed=42, attention=True, sents_embeds=None):
+    """Run the hyperparam search of all questions, scheduling every (question, trial) on the next free gpu
 
-    # create a process for each question's hyperparam search
+    One worker process is started per question, on the gpu `question_gpu_map` maps it to (see
+    :func:`run_hyperparam_search_worker`), so a gpu shared by several questions runs as many trials at once as before,
+    and workers whose question finished early keep running trials of the other questions.
+    """
+    q_fold_map = get_random_question_fold_per_hyperparam_exp(questions_to_run, random_seed=random_seed)
+    # one worker per question mapped to each gpu
+    gpu_indices = sorted(question_gpu_map[q] for q in q_fold_map)
+    job_queue = mp.Queue()
     for q, fold_num in q_fold_map.items():
-        data_partition = q_docpartitions[q][fold_num]
-        q_processes.append(mp.Process(target=run_one_questions_hyperparam_search, args=(queue, q, fold_num,
-                                                                                        data_partition, bertmodel,
-                                                                                        sents_embed_dir, root_dir,
-                                                                                        question_gpu_map[q],
-                                                                                        fdtype, num_epochs,
-                                                                                        prob_interval_truemax,
-                                                                                        prob_estim, random_seed,
-                                                                                        attention)))
-
-    for q_process in q_processes:
+        hyperparam_options = get_hyperparam_options(prob_interval_truemax, prob_estim)
+        for counter, hyperparam_config in enumerate(hyperparam_options):
+            job_queue.put((q, fold_num, counter, hyperparam_config))
+    # one stop signal per worker
+    for __ in gpu_indices:
+        job_queue.put(None)
+
+    # only ship the partitions used in the search to the workers
+    search_docpartitions = {q: {fold_num: q_docpartitions[q][fold_num]} for q, fold_num in q_fold_map.items()}
+    gpu_processes = []
+    for gpu_index in gpu_indices:
+        gpu_processes.append(mp.Process(target=run_hyperparam_search_worker, args=(job_queue, search_docpartitions,
+                                                                                   bertmodel, sents_embed_dir,
+                                                                                   root_dir, gpu_index, fdtype,
+                                                                                   attention, sents_embeds)))
+
+    for gpu_process in gpu_processes:
         print(">>> spawning hyperparam search process")
-        q_process.start()
+        gpu_process.start()
 
-    for q_process in q_processes:
-        q_process.join()
+    for gpu_process in gpu_processes:
+        gpu_process.join()
         print("<<< joined hyperparam search process")
 
     return
@@ -592,6 +725,9 @@ def get_index_argmax(score_matrix, target_indx):
 def get_best_config_from_hyperparamsearch(questions, hyperparam_search_dir, num_trials=60, metric_indx=2):
     """Read best models config from all models tested in hyperparamsearch phase
 
+    The result is cached in `best_config_map.pkl` inside `hyperparam_search_dir` and reused as long as the arguments and
+    the score files of the tested models (and their modification times) are unchanged.
+
     Args:
         questions: list, of questions [4,5,9,10,11]
         hyperparam_search_dir: string, path root directory where hyperparam models are stored
@@ -601,6 +737,22 @@ def get_best_config_from_hyperparamsearch(questions, hyperparam_search_dir, num_
     """
     # determine best config from hyperparam search
     q_fold_map = get_random_question_fold_per_hyperparam_exp(questions, random_seed=42)
+    score_files = {}
+    for question, fold_num in q_fold_map.items():
+        fold_dir = os.path.join(hyperparam_search_dir, 'question_{}'.format(question), 'fold_{}'.format(fold_num))
+        for config_num in range(num_trials):
+            score_file = os.path.join(fold_dir, 'config_{}'.format(config_num), 'score_validation.pkl')
+            score_files[(question, config_num)] = score_file
+
+    cache_file = os.path.join(hyperparam_search_dir, 'best_config_map.pkl')
+    cache_key = (list(questions), num_trials, metric_indx,
+                 [(score_file, os.path.getmtime(score_file)) for score_file in score_files.values()
+                  if os.path.isfile(score_file)])
+    if(os.path.isfile(cache_file)):
+        cached_key, q_fold_config_map = ReaderWriter.read_data(cache_file)
+        if(cached_key == cache_key):
+            return q_fold_config_map
+
     q_fold_config_map = {}
     for question, fold_num in q_fold_map.items():
         scores = np.ones((num_trials, 5))*-1
@@ -608,7 +760,7 @@ def get_best_config_from_hyperparamsearch(questions, hyperparam_search_dir, num_
         for config_num in range(num_trials):
             fold_dir = os.path.join(hyperparam_search_dir, 'question_{}'.format(question), 'fold_{}'.format(fold_num))
 
-            score_file = os.path.join(fold_dir, 'config_{}'.format(config_num), 'score_validation.pkl')
+            score_file = score_files[(question, config_num)]
             if(os.path.isfile(score_file)):
                 mscore = ReaderWriter.read_data(score_file)
                 scores[config_num, 0] = mscore.best_epoch_indx
@@ -623,6 +775,7 @@ def get_best_config_from_hyperparamsearch(questions, hyperparam_search_dir, num_
             argmax_indx = get_index_argmax(scores, metric_indx)
             mconfig, options = get_saved_config(os.path.join(fold_dir, 'config_{}'.format(argmax_indx), 'config'))
             q_fold_config_map[question] = (mconfig, options, argmax_indx)
+    ReaderWriter.dump_data((cache_key, q_fold_config_map), cache_file)
     return q_fold_config_map
 
 
@@ -637,11 +790,12 @@ def build_q_config_map_from_train_val(train_val_dir, questions=[4, 5, 9, 10, 11]
 
 
 def train_val_run(q_docpartitions, q_fold_config_map, bertmodel, train_val_dir, sents_embed_dir, question_gpu_map,
-                  num_epochs=25, max_folds=None):
+                  num_epochs=25, max_folds=None, sents_embeds=None, use_amp=False):
     dsettypes = ['train', 'validation']
     for question in q_fold_config_map:
         mconfig, options, __ = q_fold_config_map[question]
         options['num_epochs'] = num_epochs  # override number of epochs using user specified value
+        options['use_amp'] = use_amp
         for fold_num in q_docpartitions[question]:
             if max_folds is None or fold_num < max_folds:
                 # update options fold num to the current fold
@@ -650,14 +804,15 @@ def train_val_run(q_docpartitions, q_fold_config_map, bertmodel, train_val_dir,
                 path = os.path.join(train_val_dir, 'question_{}'.format(question), 'fold_{}'.format(fold_num))
                 wrk_dir = create_directory(path)
                 run_neural_discern(data_partition, dsettypes, bertmodel, mconfig, options, wrk_dir, sents_embed_dir,
-                                   gpu_index=question_gpu_map[question])
+                                   gpu_index=question_gpu_map[question], sents_embeds=sents_embeds)
 
 
-def train_val_run_one_question(queue, question, q_docpartitions, q_fold_config_map, bertmodel, train_val_dir,
-                               sents_embed_dir, gpu_index, num_epochs=25, max_folds=None):
+def train_val_run_one_question(question, q_docpartitions, q_fold_config_map, bertmodel, train_val_dir, sents_embed_dir,
+                               gpu_index, num_epochs=25, max_folds=None, sents_embeds=None, use_amp=False):
     dsettypes = ['train', 'validation']
     mconfig, options, __ = q_fold_config_map[question]
     options['num_epochs'] = num_epochs  # override number of epochs using user specified value
+    options['use_amp'] = use_amp
     for fold_num in q_docpartitions[question]:
         if max_folds is None or fold_num < max_folds:
             # update options fold num to the current fold
@@ -666,11 +821,11 @@ def train_val_run_one_question(queue, question, q_docpartitions, q_fold_config_m
             path = os.path.join(train_val_dir, 'question_{}'.format(question), 'fold_{}'.format(fold_num))
             wrk_dir = create_directory(path)
             run_neural_discern(data_partition, dsettypes, bertmodel, mconfig, options, wrk_dir, sents_embed_dir,
-                               gpu_index=gpu_index)
+                               gpu_index=gpu_index, sents_embeds=sents_embeds)
 
 
 def test_run(q_docpartitions, q_fold_config_map, bertmodel, train_val_dir, test_dir, sents_embed_dir, gpu_index,
-             num_epochs=1):
+             num_epochs=1, sents_embeds=None):
     dsettypes = ['test']
     for question in q_fold_config_map:
         mconfig, options, __ = q_fold_config_map[question]
@@ -690,7 +845,8 @@ def test_run(q_docpartitions, q_fold_config_map, bertmodel, train_val_dir, test_
                 test_wrk_dir = create_directory(path)
 
                 run_neural_discern(data_partition, dsettypes, bertmodel, mconfig, options, test_wrk_dir,
-                                   sents_embed_dir, state_dict_dir=state_dict_pth, gpu_index=gpu_index)
+                                   sents_embed_dir, state_dict_dir=state_dict_pth, gpu_index=gpu_index,
+                                   sents_embeds=sents_embeds)
             else:
                 print('WARNING: test dir not found: {}'.format(path))
 
@@ -823,7 +979,8 @@ def predict_neural_discern(data_partition, bertmodel, config, options, wrk_dir,
                 doc_id = docs_id[doc_indx].item()
                 if(doc_id in bert_proc_docs):
                     # due to GPU limit
-                    embed_sents = ReaderWriter.read_tensor(bert_proc_docs[doc_id], device)
+                    embed_sents = dequantize_embeds(ReaderWriter.read_tensor(bert_proc_docs[doc_id], device), device,
+                                                    fdtype)
                 else:
                     embed_sents = bert_encoder(docs_batch[doc_indx], docs_attn_mask[doc_indx],
                                                docs_len[doc_indx].item())
@@ -130,6 +130,20 @@ def get_device(to_gpu, index=0):
     return torch.device(target_device)
 
 
+def get_inference_fdtype(device):
+    """Return the float dtype to use for inference-only passes on `device`
+
+    Half precision is only used on gpus with tensor cores (compute capability >= 7.0, i.e. Volta and later) since fp16
+    is slower than fp32 on older architectures and is not supported for most ops on cpu.
+
+    Args:
+        device: torch.device, the device the model will run on
+    """
+    if device.type == 'cuda' and torch.cuda.get_device_capability(device) >= (7, 0):
+        return torch.float16
+    return torch.float32
+
+
 def report_available_cuda_devices():
     n_gpu = torch.cuda.device_count()
     print('number of GPUs available:', n_gpu)
@@ -12,7 +12,10 @@ setup(name='autodiscern',
             'flake8',
             'flask',
             'gitpython',
+            'joblib',
             'jsonnet==0.10.0',
+            'lxml',
+            'lz4',
             'nltk',
             'numpy>=1.15.0',
             'pandas==0.24.1',
@@ -23,7 +26,9 @@ setup(name='autodiscern',
             'torch==1.2',
             'pyyaml',
       ],
-      extras_requires={
+      extras_require={
             'dev': ['jupyter', 'sacred', 'matplotlib'],
+            'fast': ['selectolax', 'blingfire', 'pysbd', 'google-re2'],
+            'feather': ['pyarrow'],
       },
       zip_safe=False)
@@ -1,6 +1,12 @@
 import unittest
 import autodiscern.annotations as ada
 
+try:
+    import re2  # noqa: F401
+    RE2_INSTALLED = True
+except ImportError:
+    RE2_INSTALLED = False
+
 
 class TestAnnotations(unittest.TestCase):
 
@@ -211,6 +217,13 @@ class TestAnnotations(unittest.TestCase):
         expected_output = []
         self.assertEqual(ada.apply_inline_citation_regex(test_input), expected_output)
 
+    @unittest.skipUnless(RE2_INSTALLED, "requires google-re2")
+    def test_apply_inline_citation_regex_unclosed_parens_many_citations_no_match(self):
+        # takes exponential time with python's re
+        test_input = "text (" + "Frood 1942; " * 100 + "and more text."
+        expected_output = []
+        self.assertEqual(ada.apply_inline_citation_regex(test_input), expected_output)
+
     def test_apply_inline_citation_regex_lone_year_square_brackets(self):
         test_input = "text [1942]."
         expected_output = ["[1942]"]
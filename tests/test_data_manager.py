@@ -1,7 +1,66 @@
+import sys
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
+import dill
+import autodiscern.data_manager as addm
 
 
 class TestDataManager(unittest.TestCase):
 
     def test_example(self):
         self.assertEqual('foo'.upper(), 'FOO')
+
+
+class TestDataInterfaceManager(unittest.TestCase):
+
+    def test_select_by_extension(self):
+        self.assertIsInstance(addm.DataInterfaceManager.select('pkl'), addm.PickleDataInterface)
+
+    def test_select_by_file_name(self):
+        self.assertIsInstance(addm.DataInterfaceManager.select('data.csv'), addm.CSVDataInterface)
+
+    def test_select_by_file_name_with_multiple_dots(self):
+        self.assertIsInstance(addm.DataInterfaceManager.select('data.v2.txt'), addm.TextDataInterface)
+
+    def test_select_falls_back_to_default(self):
+        self.assertIsInstance(addm.DataInterfaceManager.select('123', default_file_type='dill'),
+                              addm.DillDataInterface)
+
+    def test_select_unknown_raises(self):
+        with self.assertRaises(ValueError):
+            addm.DataInterfaceManager.select('123')
+
+
+class TestDataInterface(unittest.TestCase):
+
+    def test_construct_file_path_adds_extension(self):
+        self.assertEqual(addm.PickleDataInterface.construct_file_path('data', 'dir'), Path('dir', 'data.pkl'))
+
+    def test_construct_file_path_keeps_extension(self):
+        self.assertEqual(addm.PickleDataInterface.construct_file_path('data.pkl', 'dir'), Path('dir', 'data.pkl'))
+
+    def test_pickle_written_with_protocol_4(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            addm.PickleDataInterface.save({'a': [1, 2]}, 'data', tmp_dir)
+            with open(Path(tmp_dir, 'data.pkl'), 'rb') as f:
+                # PROTO opcode followed by the protocol number
+                self.assertEqual(f.read(2), b'\x80\x04')
+
+    def test_dill_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            addm.DillDataInterface.save({'a': [1, 2]}, 'data', tmp_dir)
+            self.assertEqual(addm.DillDataInterface.load('data', tmp_dir), {'a': [1, 2]})
+
+    def test_dill_loads_uncompressed_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(Path(tmp_dir, 'data.dill'), 'wb') as f:
+                dill.dump({'a': [1, 2]}, f)
+            self.assertEqual(addm.DillDataInterface.load('data', tmp_dir), {'a': [1, 2]})
+
+    def test_feather_without_pyarrow_raises(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with mock.patch.dict(sys.modules, {'pyarrow': None}):
+                with self.assertRaisesRegex(ImportError, 'pyarrow'):
+                    addm.FeatherDataInterface.load('data', tmp_dir)
@@ -1,5 +1,13 @@
+import copyreg
+import pickle
 import unittest
+from unittest import mock
+import numpy as np
+from scipy.sparse import coo_matrix
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
 import autodiscern.experiment as ade
+from autodiscern.experiments import DocExperiment
 
 
 class TestExperiment(unittest.TestCase):
@@ -31,6 +39,12 @@ class TestExperiment(unittest.TestCase):
         output = ade.PartitionedExperiment.partition_document_ids(doc_ids, 4)
         self.assertEqual(sum([len(output[partition_name]) for partition_name in output]), len(doc_ids))
 
+    def test_partition_document_ids_random_state_is_reproducible(self):
+        doc_ids = list(range(20))
+        output_1 = ade.PartitionedExperiment.partition_document_ids(doc_ids, 4, random_state=7)
+        output_2 = ade.PartitionedExperiment.partition_document_ids(doc_ids, 4, random_state=7)
+        self.assertEqual(output_1, output_2)
+
     def test_partition_document_ids_stratified_all_elements_preserved(self):
         doc_ids = list(range(20))
         labels = [1]*10 + [2]*10
@@ -100,3 +114,140 @@ class TestExperiment(unittest.TestCase):
             ],
         )
         self.assertEqual(ade.PartitionedExperiment.materialize_partition(partition_ids, data_dict), expected_output)
+
+    def test_materialize_partition_with_entity_index(self):
+        partition_ids = [1]
+        data_dict = {
+            0: {'entity_id': 0, 'sub_id': 0},
+            1: {'entity_id': 1, 'sub_id': 0},
+            2: {'entity_id': 0, 'sub_id': 1},
+            3: {'entity_id': 1, 'sub_id': 1},
+        }
+        entity_index = ade.PartitionedExperiment.build_entity_index(data_dict)
+        expected_output = (
+            [
+                {'entity_id': 0, 'sub_id': 0},
+                {'entity_id': 0, 'sub_id': 1},
+            ],
+            [
+                {'entity_id': 1, 'sub_id': 0},
+                {'entity_id': 1, 'sub_id': 1},
+            ],
+        )
+        self.assertEqual(ade.PartitionedExperiment.materialize_partition(partition_ids, data_dict, entity_index),
+                         expected_output)
+
+
+class _PreSlotsModelRunPickle:
+    """Pickles like a ModelRun from before `__slots__` were added: its instance `__dict__` is the pickled state. """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __reduce__(self):
+        return copyreg._reconstructor, (ade.ModelRun, object, None), self.state
+
+
+class TestModelRunPickling(unittest.TestCase):
+
+    def test_load_model_run_pickled_before_slots(self):
+        state = {
+            'train_set': None, 'test_set': None, 'label_key': 'label', 'encoders': {}, 'model': None,
+            'hyperparams': {}, 'feature_subset': ['html'], 'reduce_features': False, 'x_train': None, 'x_test': None,
+            'y_train': [0, 1], 'y_test': [1], 'y_train_predicted': [0, 1], 'y_test_predicted': [1],
+            'feature_cols': ['a'], 'evaluation': {'f1': 1.0}, 'rfecv': None, 'preprocessing_func': None,
+        }
+        model_run = pickle.loads(pickle.dumps(_PreSlotsModelRunPickle(state)))
+
+        self.assertIsInstance(model_run, ade.ModelRun)
+        self.assertEqual(model_run.evaluation, {'f1': 1.0})
+        self.assertEqual(model_run._feature_subset_set, frozenset(['html']))
+        self.assertEqual(model_run.n_jobs_search, -1)
+        self.assertIsNone(model_run.cache_dir)
+        self.assertFalse(model_run.retain_matrices)
+
+    def test_model_run_pickle_round_trip(self):
+        model_run = ade.ModelRun(train_set=[], test_set=[], label_key='label', model=SVC(), hyperparams={},
+                                 preprocessing_func=None, feature_subset=['html'], cache_dir='cache')
+        loaded = pickle.loads(pickle.dumps(model_run))
+        for attr in ade.ModelRun.__slots__:
+            if attr != 'model':
+                self.assertEqual(getattr(loaded, attr), getattr(model_run, attr))
+        self.assertIsInstance(loaded.model, SVC)
+
+
+class TestPredictFromProba(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.normal(size=(40, 3))
+        self.y = (self.x[:, 0] + rng.normal(scale=0.8, size=40) > 0).astype(int)
+
+    def test_forest_matches_predict(self):
+        forest = RandomForestClassifier(n_estimators=10, random_state=0).fit(self.x, self.y)
+        np.testing.assert_array_equal(ade.predict_from_proba(forest, self.x, forest.predict_proba(self.x)),
+                                      forest.predict(self.x))
+
+    def test_svc_uses_predict(self):
+        svc = SVC(probability=True, random_state=0).fit(self.x, self.y)
+        # probabilities that disagree with the model must not decide its prediction
+        flipped_proba = svc.predict_proba(self.x)[:, ::-1]
+        np.testing.assert_array_equal(ade.predict_from_proba(svc, self.x, flipped_proba), svc.predict(self.x))
+
+
+class _ContentLengthModelRun(ade.ModelRun):
+    """Uses each document's precomputed content length as its only feature, and records the features it built."""
+
+    built_features = {}
+
+    @classmethod
+    def precompute(cls, data_set, previous=None):
+        return {(d['entity_id'], d['content']): len(d['content']) for d in data_set}
+
+    @classmethod
+    def attach_precomputed(cls, data_set, precomputed):
+        return [dict(d, content_length=precomputed[(d['entity_id'], d['content'])]) for d in data_set]
+
+    @classmethod
+    def train_encoders(cls, train_set):
+        return {}
+
+    @classmethod
+    def build_x_features(cls, data_set, encoders):
+        features = {d['entity_id']: d['content_length'] for d in data_set}
+        cls.built_features.update(features)
+        return coo_matrix(np.array([[features[d['entity_id']]] for d in data_set], dtype=float)), ['content_length']
+
+
+class TestPrecompute(unittest.TestCase):
+
+    def test_changed_content_changes_features_between_runs(self):
+        data_dict = {i: {'entity_id': i, 'content': 'x' * i, 'label': i % 2} for i in range(1, 9)}
+        experiment = ade.PartitionedExperiment('precompute', data_dict, label_key='label',
+                                               preprocessing_func=None, model_run_class=_ContentLengthModelRun,
+                                               model=RandomForestClassifier(n_estimators=2), hyperparams={},
+                                               n_partitions=2, n_jobs=1, verbose=False)
+        _ContentLengthModelRun.built_features = {}
+        experiment.run(num_partitions_to_run=1, run_hyperparam_search=False)
+        self.assertEqual(_ContentLengthModelRun.built_features[1], 1)
+
+        data_dict[1]['content'] = 'x' * 20
+        _ContentLengthModelRun.built_features = {}
+        experiment.run(num_partitions_to_run=1, run_hyperparam_search=False)
+        self.assertEqual(_ContentLengthModelRun.built_features[1], 20)
+        # the precomputed data is kept by the experiment, not written into the data dicts
+        self.assertNotIn('content_length', data_dict[1])
+
+    def test_doc_level_lemmas_follow_content(self):
+        lemmatizer = mock.Mock()
+        lemmatizer.lemmatize.side_effect = str.lower
+        data_set = [{'entity_id': 1, 'content': 'Cats'}, {'entity_id': 2, 'content': 'Dogs'}]
+        with mock.patch.object(DocExperiment.lemmatization, 'Lemmatizer', return_value=lemmatizer):
+            lemmas = DocExperiment.DocLevelModelRun.precompute(data_set)
+            data_set[0]['content'] = 'Birds'
+            lemmas = DocExperiment.DocLevelModelRun.precompute(data_set, previous=lemmas)
+
+        self.assertEqual(lemmatizer.lemmatize.call_count, 3)
+        attached = DocExperiment.DocLevelModelRun.attach_precomputed(data_set, lemmas)
+        self.assertEqual([d['content_lemmas'] for d in attached], ['birds', 'dogs'])
+        self.assertNotIn('content_lemmas', data_set[0])
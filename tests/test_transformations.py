@@ -2,6 +2,18 @@ from bs4 import BeautifulSoup
 import unittest
 import autodiscern.transformations as adt
 
+try:
+    import selectolax  # noqa: F401
+    SELECTOLAX_INSTALLED = True
+except ImportError:
+    SELECTOLAX_INSTALLED = False
+
+try:
+    import blingfire  # noqa: F401
+    BLINGFIRE_INSTALLED = True
+except ImportError:
+    BLINGFIRE_INSTALLED = False
+
 
 class TestTransformations(unittest.TestCase):
 
@@ -185,6 +197,24 @@ class TestTransformations(unittest.TestCase):
                                                include_link_domains=True)
         self.assertEqual(test_output, expected_output)
 
+    def test_html_to_text_with_tags_skips_parsing_plain_text(self):
+        test_input = '\n  A plain title. By Some Author  '
+        expected_output = 'A plain title. By Some Author  '
+
+        transformer = adt.Transformer()
+        test_output = transformer.html_to_text_with_tags(test_input, set(), set(), {}, '')
+        self.assertEqual(test_output, expected_output)
+
+    def test_replace_html_stream_closes_unclosed_tags_and_drops_non_rendered(self):
+        test_input = '<p>There is a <a href="google.com">link &amp; here</a>.<script>x</script><!-- comment -->'
+        expected_output = '\nThere is a thisisalinktaggoogle link & here.\n'
+
+        tags_to_replace_with_str = {'a': ('thisisalinktag ', ''), 'p': ('\n', '\n')}
+        transformer = adt.Transformer()
+        test_output = transformer.replace_html_stream(test_input, set(), set(), tags_to_replace_with_str, '',
+                                                      include_link_domains=True)
+        self.assertEqual(test_output, expected_output)
+
     def test_flatten_text_dicts(self):
         test_input = [
             {'id': 0, 'content': ['word0', 'word1']},
@@ -402,6 +432,51 @@ class TestAcceptanceTransformation(unittest.TestCase):
         output = transformer.apply(test_input)
         self.assertEqual(output, self.expected_output)
 
+    def test_html_to_text_threading_backend(self):
+        with adt.Transformer(leave_some_html=False, parallelism=True, num_cores=2, threading_backend=True,
+                             min_parallel_inputs=1) as transformer:
+            test_input = self.test_input_1
+            self.expected_output[0]['content'] = """Antidepressants. Antidepressants are medications primarily used for treating depression. What Are Antidepressants? Antidepressants are medications used to treat depression. Some of these medications are blue. (Click Antidepressant Uses for more information on what they are used for, including possible off-label uses.). Types of Antidepressants. There are several types of antidepressants available to treat depression."""
+
+            output = transformer.apply(test_input)
+        self.assertEqual(output, self.expected_output)
+
+    def test_html_to_text_parallel_few_inputs_runs_in_series(self):
+        with adt.Transformer(leave_some_html=False, parallelism=True, num_cores=2) as transformer:
+            test_input = self.test_input_1
+            self.expected_output[0]['content'] = """Antidepressants. Antidepressants are medications primarily used for treating depression. What Are Antidepressants? Antidepressants are medications used to treat depression. Some of these medications are blue. (Click Antidepressant Uses for more information on what they are used for, including possible off-label uses.). Types of Antidepressants. There are several types of antidepressants available to treat depression."""
+
+            output = transformer.apply(test_input)
+            self.assertIsNone(transformer._pool)
+        self.assertEqual(output, self.expected_output)
+
+    @unittest.skipUnless(SELECTOLAX_INSTALLED, "requires selectolax")
+    def test_html_to_text_fast_parser(self):
+        transformer = adt.Transformer(leave_some_html=False, html_backend='selectolax')
+
+        test_input = self.test_input_1
+        self.expected_output[0]['content'] = """Antidepressants. Antidepressants are medications primarily used for treating depression. What Are Antidepressants? Antidepressants are medications used to treat depression. Some of these medications are blue. (Click Antidepressant Uses for more information on what they are used for, including possible off-label uses.). Types of Antidepressants. There are several types of antidepressants available to treat depression."""
+
+        output = transformer.apply(test_input)
+        self.assertEqual(output, self.expected_output)
+
+    @unittest.skipUnless(SELECTOLAX_INSTALLED, "requires selectolax")
+    def test_html_to_limited_html_plain_text_fast_parser(self):
+        transformer = adt.Transformer(leave_some_html=True, html_to_plain_text=True, html_backend='selectolax')
+
+        test_input = self.test_input_1
+        self.expected_output[0]['content'] = """thisisah1tag Antidepressants. thisisah3tag Antidepressants are medications primarily used for treating depression. thisisalinktagemedtv thisisah2tag What Are Antidepressants? Antidepressants are medications used to treat thisisalinktagemedtv depression . Some of these medications are blue. (Click thisisalinktagemedtv Antidepressant Uses for more information on what they are used for, including possible thisisalinktagemedtv off-label uses.). thisisalinktagemedtv thisisah2tag Types of Antidepressants. There are several types of antidepressants available to treat depression."""
+        output = transformer.apply(test_input)
+        self.assertEqual(output, self.expected_output)
+
+    def test_html_to_limited_html_plain_text_stream_backend(self):
+        transformer = adt.Transformer(leave_some_html=True, html_to_plain_text=True, html_backend='stream')
+
+        test_input = self.test_input_1
+        self.expected_output[0]['content'] = """thisisah1tag Antidepressants. thisisah3tag Antidepressants are medications primarily used for treating depression. thisisalinktagemedtv thisisah2tag What Are Antidepressants? Antidepressants are medications used to treat thisisalinktagemedtv depression . Some of these medications are blue. (Click thisisalinktagemedtv Antidepressant Uses for more information on what they are used for, including possible thisisalinktagemedtv off-label uses.). thisisalinktagemedtv thisisah2tag Types of Antidepressants. There are several types of antidepressants available to treat depression."""
+        output = transformer.apply(test_input)
+        self.assertEqual(output, self.expected_output)
+
     # skipping test because requires allennlp, which is slow on travis
     # def test_html_to_text_to_words(self):
     #     transformer = adt.Transformer(leave_some_html=False, segment_into='words',
@@ -442,6 +517,26 @@ class TestAcceptanceTransformation(unittest.TestCase):
         output = transformer.apply(test_input)
         self.assertEqual(output, self.expected_output)
 
+    @unittest.skipUnless(BLINGFIRE_INSTALLED, "requires blingfire")
+    def test_html_to_text_to_sentences_blingfire(self):
+        transformer = adt.Transformer(leave_some_html=False, segment_into='sentences',
+                                      remove_newlines=False, sentence_backend='blingfire')
+
+        test_input = self.test_input_1
+        self.expected_output[0]['content'] = [
+            "Antidepressants.",
+            "Antidepressants are medications primarily used for treating depression.",
+            "What Are Antidepressants?",
+            "Antidepressants are medications used to treat depression.",
+            "Some of these medications are blue.",
+            "(Click Antidepressant Uses for more information on what they are used for, including possible off-label uses.).",
+            "Types of Antidepressants.",
+            "There are several types of antidepressants available to treat depression.",
+        ]
+
+        output = transformer.apply(test_input)
+        self.assertEqual(output, self.expected_output)
+
     def test_html_to_text_to_paragraphs(self):
         transformer = adt.Transformer(leave_some_html=False, segment_into='paragraphs',
                                       remove_newlines=False)